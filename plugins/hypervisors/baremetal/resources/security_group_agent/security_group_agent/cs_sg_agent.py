@@ -29,6 +29,8 @@ import uuid
 import os.path
 import sys
 import os
+import hashlib
+import threading
 
 class SGRule(object):
     def __init__(self):
@@ -39,46 +41,103 @@ class SGRule(object):
 
 class IPSet(object):
     IPSET_TYPE = 'hash:ip'
+    MAX_NAME_LEN = 31
+
+    # name of every set this agent created -> the vm it belongs to. Sets that
+    # were there when the agent started belong to no vm
+    registry = None
+
     def __init__(self, setname, ips):
         self.ips = ips
         self.name = setname
-    
-    def create(self):
+
+    @staticmethod
+    def set_name(chainname, protocol, start_port, end_port):
+        name = '_'.join([chainname, protocol, start_port, end_port])
+        if len(name) > IPSet.MAX_NAME_LEN:
+            name = chainname[:18] + '_' + hashlib.md5(name).hexdigest()[:12]
+        return name
+
+    def restore_commands(self):
+        """ Fills a temporary set and swaps it with the real one, so the
+        real set is never seen half filled """
         tmpname = str(uuid.uuid4()).replace('-', '')[0:30]
-        sglib.ShellCmd('ipset -N %s %s' % (tmpname, self.IPSET_TYPE))()
+        cmds = ['create %s %s' % (tmpname, self.IPSET_TYPE)]
+        cmds.extend(['add %s %s' % (tmpname, ip) for ip in self.ips])
+        cmds.append('create %s %s -exist' % (self.name, self.IPSET_TYPE))
+        cmds.append('swap %s %s' % (tmpname, self.name))
+        cmds.append('destroy %s' % tmpname)
+        return cmds
+
+    @staticmethod
+    def load_registry():
+        if IPSet.registry is not None:
+            return
+        IPSet.registry = {}
         try:
-            for ip in self.ips:
-                sglib.ShellCmd('ipset -A %s %s' % (tmpname, ip))()
-            
-            try:
-                sglib.ShellCmd('ipset -N %s %s' % (self.name, self.IPSET_TYPE))()
-                cherrypy.log('created new ipset: %s' % self.name)
-            except Exception:
-                cherrypy.log('%s already exists, no need to create new' % self.name)
-        finally:
-            sglib.ShellCmd('ipset -W %s %s' % (tmpname, self.name))()
-            sglib.ShellCmd('ipset -F %s' % tmpname)()
-            sglib.ShellCmd('ipset -X %s' % tmpname)()
-            
-    @staticmethod 
-    def destroy_sets(sets_to_keep):
-        sets = sglib.ShellCmd('ipset list')()
-        for s in sets.split('\n'):
-            if 'Name:' in s:
-                set_name = s.split(':', 1)[1].strip()
-                if not set_name in sets_to_keep:
-                    sglib.ShellCmd('ipset destroy %s' % set_name)()
-                    cherrypy.log('destroyed unused ipset: %s' % set_name)
-        
+            names = sglib.ShellCmd('ipset list -n')().split('\n')
+        except sglib.ShellError:
+            # ipset without -n, every member is listed as well
+            names = [s.split(':', 1)[1] for s in sglib.ShellCmd('ipset list')().split('\n') if 'Name:' in s]
+        for name in names:
+            if name.strip():
+                IPSet.registry[name.strip()] = None
+
+    @staticmethod
+    def create_sets(vm_name, sets):
+        """ Creates or refills all sets with a single ipset restore """
+        IPSet.load_registry()
+        if not sets:
+            return
+        cmds = []
+        for ipset in sets:
+            cmds.extend(ipset.restore_commands())
+        sglib.ShellCmd('ipset restore')(input='\n'.join(cmds) + '\n')
+        for ipset in sets:
+            if ipset.name not in IPSet.registry:
+                cherrypy.log('created new ipset: %s' % ipset.name)
+            IPSet.registry[ipset.name] = vm_name
+
+    @staticmethod
+    def destroy_sets(vm_name, sets_to_keep):
+        """ Destroys the sets of the vm, and the ones found at start, that are
+        not in sets_to_keep """
+        IPSet.load_registry()
+        unused = [name for name, owner in IPSet.registry.items()
+                  if owner in (vm_name, None) and name not in sets_to_keep]
+        if not unused:
+            return
+        sglib.ShellCmd('ipset restore')(input=''.join(['destroy %s\n' % name for name in unused]))
+        for name in unused:
+            del IPSet.registry[name]
+            cherrypy.log('destroyed unused ipset: %s' % name)
+
 class SGAgent(object):
     def __init__(self):
-        pass
+        # vm name -> (vm id, ip, mac, signature, sequence number) last programmed
+        self.programmed = {}
+        self.lock = threading.Lock()
     
     def _self_list(self, obj):
         if isinstance(obj, types.ListType):
             return obj
         else:
             return [obj]
+
+    def _is_programmed(self, vm_name, state):
+        last = self.programmed.get(vm_name)
+        if last is None:
+            return False
+        if last == state:
+            cherrypy.log('rules of %s are already programmed with signature %s' % (vm_name, state[3]))
+            return True
+        try:
+            if long(state[4]) < long(last[4]):
+                cherrypy.log('ignored rules of %s with sequence number %s, %s is already programmed' % (vm_name, state[4], last[4]))
+                return True
+        except ValueError:
+            pass
+        return False
         
     def set_rules(self, req):
         body = req.body
@@ -89,7 +148,19 @@ class SGAgent(object):
         vm_mac = doc.vmMac.text_
         sig = doc.signature.text_
         seq = doc.sequenceNumber.text_
-        
+        state = (vm_id, vm_ip, vm_mac, sig, seq)
+
+        self.lock.acquire()
+        try:
+            if self._is_programmed(vm_name, state):
+                return
+            self.programmed.pop(vm_name, None)
+            self._apply_rules(doc, vm_name)
+            self.programmed[vm_name] = state
+        finally:
+            self.lock.release()
+
+    def _apply_rules(self, doc, vm_name):
         def parse_rules(rules, lst):
             for i in self._self_list(rules):
                 r = SGRule()
@@ -108,67 +179,64 @@ class SGAgent(object):
         e_rules = []
         if hasattr(doc, 'egressRules'):
             parse_rules(doc.egressRules, e_rules)
-            
-        def create_chain(name):
-            try:
-                sglib.ShellCmd('iptables -F %s' % name)()
-            except Exception:
-                sglib.ShellCmd('iptables -N %s' % name)()
-            
-        def apply_rules(rules, chainname, direction, action, current_set_names):
-            create_chain(chainname)
-            for r in i_rules:
-                allow_any = False
-                if '0.0.0.0/0' in r.allowed_ips:
-                    allow_any = True
-                    r.allowed_ips.remove('0.0.0.0/0')
+
+        def render_rules(rules, chainname, direction, action, sets):
+            # the rules used to be inserted one by one at the head of the
+            # chain, they are appended in that same final order
+            cmds = []
+            for r in rules:
+                allowed_ips = [ip for ip in r.allowed_ips if ip != '0.0.0.0/0']
+                allow_any = len(allowed_ips) != len(r.allowed_ips)
                 
-                if r.allowed_ips:
-                    setname = '_'.join([chainname, r.protocol, r.start_port, r.end_port])
-                    ipset = IPSet(setname, r.allowed_ips)
-                    ipset.create()
-                    current_set_names.append(setname)
+                if allowed_ips:
+                    setname = IPSet.set_name(chainname, r.protocol, r.start_port, r.end_port)
+                    sets.append(IPSet(setname, allowed_ips))
                     
                     if r.protocol == 'all':
-                        cmd = ['iptables -I', chainname, '-m state --state NEW -m set --set', setname, direction, '-j', action]
-                        sglib.ShellCmd(' '.join(cmd))()
+                        cmd = ['-A', chainname, '-m state --state NEW -m set --set', setname, direction, '-j', action]
                     elif r.protocol != 'icmp':
                         port_range = ":".join([r.start_port, r.end_port])
-                        cmd = ['iptables', '-I', chainname, '-p', r.protocol, '-m', r.protocol, '--dport', port_range, '-m state --state NEW -m set --set', setname, direction, '-j', action]
-                        sglib.ShellCmd(' '.join(cmd))()
+                        cmd = ['-A', chainname, '-p', r.protocol, '-m', r.protocol, '--dport', port_range, '-m state --state NEW -m set --set', setname, direction, '-j', action]
                     else:
                         port_range = "/".join([r.start_port, r.end_port])
                         if r.start_port == "-1":
                             port_range = "any"
-                        cmd = ['iptables', '-I', i_chain_name, '-p', 'icmp', '--icmp-type', port_range, '-m set --set', setname, direction, '-j', action]
-                        sglib.ShellCmd(' '.join(cmd))()
-                        
+                        cmd = ['-A', chainname, '-p', 'icmp', '--icmp-type', port_range, '-m set --set', setname, direction, '-j', action]
+                    cmds.insert(0, ' '.join(cmd))
                     
                 if allow_any and r.protocol != 'all':
                     if r.protocol != 'icmp':
                         port_range = ":".join([r.start_port, r.end_port])
-                        cmd = ['iptables', '-I', chainname, '-p', r.protocol, '-m', r.protocol, '--dport', port_range, '-m', 'state', '--state', 'NEW', '-j', action]
-                        sglib.ShellCmd(' '.join(cmd))()
+                        cmd = ['-A', chainname, '-p', r.protocol, '-m', r.protocol, '--dport', port_range, '-m', 'state', '--state', 'NEW', '-j', action]
                     else:
                         port_range = "/".join([r.start_port, r.end_port])
                         if r.start_port == "-1":
                             port_range = "any"
-                        cmd = ['iptables', '-I', i_chain_name, '-p', 'icmp', '--icmp-type', port_range, '-j', action]
-                        sglib.ShellCmd(' '.join(cmd))()
+                        cmd = ['-A', chainname, '-p', 'icmp', '--icmp-type', port_range, '-j', action]
+                    cmds.insert(0, ' '.join(cmd))
+            return cmds
         
-        current_sets = []
+        sets = []
         i_chain_name = vm_name + '-in'
-        apply_rules(i_rules, i_chain_name, 'src', 'ACCEPT', current_sets)
         e_chain_name = vm_name + '-eg'
-        apply_rules(e_rules, e_chain_name, 'dst', 'RETURN', current_sets)
+        # declaring a chain creates it, or flushes it as --noflush keeps
+        # every other chain untouched
+        cmds = ['*filter', ':%s - [0:0]' % i_chain_name, ':%s - [0:0]' % e_chain_name]
+        cmds.extend(render_rules(i_rules, i_chain_name, 'src', 'ACCEPT', sets))
+        cmds.extend(render_rules(e_rules, e_chain_name, 'dst', 'RETURN', sets))
         
         if e_rules:
-            sglib.ShellCmd('iptables -A %s -j RETURN' % e_chain_name)
+            cmds.append('-A %s -j RETURN' % e_chain_name)
         else:
-            sglib.ShellCmd('iptables -A %s -j DROP' % e_chain_name)
+            cmds.append('-A %s -j DROP' % e_chain_name)
         
-        sglib.ShellCmd('iptables -A %s -j DROP' % i_chain_name)
-        IPSet.destroy_sets(current_sets)
+        cmds.append('-A %s -j DROP' % i_chain_name)
+        cmds.append('COMMIT')
+
+        # the sets have to exist before rules can match them
+        IPSet.create_sets(vm_name, sets)
+        sglib.ShellCmd('iptables-restore --noflush')(input='\n'.join(cmds) + '\n')
+        IPSet.destroy_sets(vm_name, [ipset.name for ipset in sets])
                 
         
     def echo(self, req):
@@ -22,6 +22,7 @@
 
 import web
 import socket, struct
+import os, signal, threading
 import cloud_utils
 from cloud_utils import Command
 urls = ("/ipallocator", "ipallocator")
@@ -29,13 +30,24 @@ app = web.application(urls, globals())
 
 augtool = Command("augtool")
 service = Command("service")
+pidof = Command("pidof")
+
+DATA_DIR = "/var/lib/cloudstack/ipallocator"
+# allocations, replayed at start so dnsmasq.conf is not parsed again
+JOURNAL = os.path.join(DATA_DIR, "allocations")
+# dhcp-host entries, dnsmasq reads it again on SIGHUP
+HOSTSFILE = os.path.join(DATA_DIR, "dhcp-hosts")
+DNSMASQ_PIDFILES = ["/var/run/dnsmasq.pid", "/var/run/dnsmasq/dnsmasq.pid"]
+
 class dhcp:
 	_instance = None
+	_instanceLock = threading.Lock()
 	def __init__(self):
-		self.availIP=[]
 		self.router=None
 		self.netmask=None
 		self.initialized=False
+		# web.py serves each request in its own thread
+		self.lock = threading.Lock()
 
 		options = augtool.match("/files/etc/dnsmasq.conf/dhcp-option").stdout.strip()
 		for option in options.splitlines():
@@ -49,16 +61,17 @@ class dhcp:
 		self.netmask = dhcp_range.split("=")[1].strip().split(",")[2]
 		print dhcp_start, dhcp_end, self.netmask
 
- 		start_ip_num = self.ipToNum(dhcp_start);
-		end_ip_num =  self.ipToNum(dhcp_end)
-		print start_ip_num, end_ip_num
-	
-		for ip in range(start_ip_num, end_ip_num + 1):
-			self.availIP.append(ip)	
-		print self.availIP[0], self.availIP[len(self.availIP) - 1]	
-		
-		#load the ip already allocated
-		self.reloadAllocatedIP()
+		self.pool = cloud_utils.IPPool(dhcp_start, dhcp_end)
+		print "%d addresses in the range" % self.pool.size
+
+		if not os.path.isdir(DATA_DIR):
+			os.makedirs(DATA_DIR)
+		journaled = os.path.exists(JOURNAL)
+		self.pool.open(JOURNAL)
+		if not journaled:
+			#load the ip already allocated
+			self.reloadAllocatedIP()
+		self.useHostsfile()
 
 	def ipToNum(self, ip):
 		return struct.unpack("!I", socket.inet_aton(ip))[0]
@@ -66,13 +79,8 @@ class dhcp:
 	def numToIp(self, num):
 		return socket.inet_ntoa(struct.pack('!I', num))
 
-	def getFreeIP(self):
-		if len(self.availIP) > 0:
-			ip = self.numToIp(self.availIP[0])
-			self.availIP.remove(self.availIP[0])	
-			return ip
-		else:
-			return None
+	def getFreeIP(self, mac):
+		return self.pool.allocate(mac)
 
 	def getNetmask(self):
 		return self.netmask
@@ -81,9 +89,13 @@ class dhcp:
 		return self.router
 
 	def getInstance():
-		if not dhcp._instance:
-			dhcp._instance = dhcp()
-		return dhcp._instance
+		dhcp._instanceLock.acquire()
+		try:
+			if not dhcp._instance:
+				dhcp._instance = dhcp()
+			return dhcp._instance
+		finally:
+			dhcp._instanceLock.release()
 	getInstance = staticmethod(getInstance)
 
 	def reloadAllocatedIP(self):
@@ -91,41 +103,77 @@ class dhcp:
 		
 		for host in dhcp_hosts:
 			if host.find("dhcp-host") != -1:
-				allocatedIP = self.ipToNum(host.split("=")[1].strip().split(",")[1])
-				if allocatedIP in self.availIP:	
-					self.availIP.remove(allocatedIP)
-		
-	def allocateIP(self, mac):
-		newIP = self.getFreeIP()
-		dhcp_host = augtool.match("/files/etc/dnsmasq.conf/dhcp-host").stdout.strip()
-		cnt = len(dhcp_host.splitlines()) + 1
-		script = """set %s %s
-			    save"""%("/files/etc/dnsmasq.conf/dhcp-host[" + str(cnt) + "]", str(mac) + "," + newIP)
+				mac, allocatedIP = host.split("=")[1].strip().split(",")[0:2]
+				self.pool.reserve(allocatedIP, mac)
+
+	def useHostsfile(self):
+		"""Moves the dhcp-host entries of dnsmasq.conf to the hosts file,
+		this is the only time dnsmasq has to be restarted"""
+		self.writeHostsfile()
+		hostsfile = augtool.get("/files/etc/dnsmasq.conf/dhcp-hostsfile").stdout.strip()
+		if hostsfile.find(HOSTSFILE) != -1:
+			return
+		script = """rm /files/etc/dnsmasq.conf/dhcp-host
+			    set /files/etc/dnsmasq.conf/dhcp-hostsfile %s
+			    save"""%(HOSTSFILE)
 		augtool < script
-		#reset dnsmasq
 		service("dnsmasq", "restart", stdout=None, stderr=None)
-		return newIP
 
-	def releaseIP(self, ip):
-		dhcp_host = augtool.match("/files/etc/dnsmasq.conf/dhcp-host").stdout.strip()
-		path = None
-		for host in dhcp_host.splitlines():
-			if host.find(ip) != -1:
-				path = host.split("=")[0].strip()
-				
-		if path == None:
-			print "Can't find " + str(ip) + " in conf file"
+	def writeHostsfile(self):
+		"""Rewrites the whole hosts file, only needed when an address is freed"""
+		hosts = ["%s,%s\n" % (mac, ip) for ip, mac in self.pool.allocated()]
+		tmp = HOSTSFILE + ".tmp"
+		f = file(tmp, "w")
+		f.write("".join(hosts))
+		f.close()
+		# dnsmasq never reads a half written file
+		os.rename(tmp, HOSTSFILE)
+
+	def getDnsmasqPid(self):
+		for pidfile in DNSMASQ_PIDFILES:
+			if os.path.exists(pidfile):
+				pid = file(pidfile).read().strip()
+				if pid and os.path.exists("/proc/" + pid):
+					return int(pid)
+		try:
+			return int(pidof("dnsmasq").stdout.split()[0])
+		except:
 			return None
 
-		print path
-		script = """rm %s
-			    save"""%(path)
-		augtool < script
-		
-		self.availIP.remove(ip)
-		
-		#reset dnsmasq
-		service("dnsmasq", "restart", stdout=None, stderr=None)
+	def appendHost(self, mac, ip):
+		# a single short write, dnsmasq never reads half of the line
+		f = file(HOSTSFILE, "a")
+		f.write("%s,%s\n" % (mac, ip))
+		f.close()
+
+	def reloadHosts(self):
+		pid = self.getDnsmasqPid()
+		if pid:
+			os.kill(pid, signal.SIGHUP)
+		else:
+			service("dnsmasq", "restart", stdout=None, stderr=None)
+
+	def allocateIP(self, mac):
+		self.lock.acquire()
+		try:
+			newIP = self.getFreeIP(mac)
+			if newIP:
+				self.appendHost(mac, newIP)
+				self.reloadHosts()
+			return newIP
+		finally:
+			self.lock.release()
+
+	def releaseIP(self, ip):
+		self.lock.acquire()
+		try:
+			if not self.pool.release(ip):
+				print "Can't find " + str(ip) + " in allocated addresses"
+				return None
+			self.writeHostsfile()
+			self.reloadHosts()
+		finally:
+			self.lock.release()
 
 class ipallocator:
 	def GET(self):
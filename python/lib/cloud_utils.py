@@ -28,6 +28,7 @@ import urllib2
 import xml.dom.minidom
 import logging
 import socket
+import struct
 
 # exit() error constants
 E_GENERIC= 1
@@ -1051,6 +1052,105 @@ def setup_consoleproxy_config(configfile, host, zone, pod):
 	text = "\n".join(lines)
 	file(fn,"w").write(text)
 
+# =========================== IP ADDRESS POOL ===================
+
+class IPPool:
+	"""A range of IPv4 addresses with one bit per address, so allocating or
+	releasing does not depend on the size of the range.
+
+	Every change is appended to a journal, which is replayed and compacted
+	when the pool is opened again."""
+	def __init__(self,start,end):
+		self.start = self.ipToNum(start)
+		self.size = self.ipToNum(end) - self.start + 1
+		self.bitmap = bytearray((self.size + 7) / 8)
+		# the bits past the end of the range are never free
+		for index in range(self.size,len(self.bitmap) * 8): self.__set(index)
+		self.free = self.size
+		self.cursor = 0
+		self.owners = {}
+		self.journal = None
+
+	def ipToNum(self,ip):
+		return struct.unpack("!I",socket.inet_aton(ip))[0]
+
+	def numToIp(self,num):
+		return socket.inet_ntoa(struct.pack("!I",num))
+
+	def __set(self,index): self.bitmap[index >> 3] |= 1 << (index & 7)
+	def __clear(self,index): self.bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xff
+	def __isset(self,index): return self.bitmap[index >> 3] & (1 << (index & 7))
+
+	def __index(self,ip):
+		index = self.ipToNum(ip) - self.start
+		if index < 0 or index >= self.size: return None
+		return index
+
+	def __log(self,line):
+		if self.journal:
+			self.journal.write(line + "\n")
+			self.journal.flush()
+
+	def reserve(self,ip,owner):
+		"""Marks ip as given to owner, returns False if it is out of the range or already taken"""
+		index = self.__index(ip)
+		if index is None or self.__isset(index): return False
+		self.__set(index)
+		self.free -= 1
+		self.owners[index] = owner
+		self.__log("+ %s %s" % (ip,owner))
+		return True
+
+	def allocate(self,owner):
+		"""Gives the next free address after the last one allocated to owner"""
+		if not self.free: return None
+		# bytes with all their bits set are skipped whole
+		pos = self.cursor
+		while self.bitmap[pos] == 0xff:
+			pos += 1
+			if pos == len(self.bitmap): pos = 0
+		self.cursor = pos
+		byte = self.bitmap[pos]
+		bit = 0
+		while byte & (1 << bit): bit += 1
+		ip = self.numToIp(self.start + pos * 8 + bit)
+		self.reserve(ip,owner)
+		return ip
+
+	def release(self,ip):
+		"""Frees ip, returns False if it was not allocated"""
+		index = self.__index(ip)
+		if index is None or not self.__isset(index): return False
+		self.__clear(index)
+		self.free += 1
+		del self.owners[index]
+		self.__log("- %s" % ip)
+		return True
+
+	def allocated(self):
+		"""(ip, owner) of every allocated address"""
+		return [ (self.numToIp(self.start + index),owner) for index,owner in self.owners.items() ]
+
+	def open(self,journal):
+		"""Replays journal into the pool, then keeps appending to it"""
+		if os.path.exists(journal):
+			for line in file(journal):
+				fields = line.split()
+				if len(fields) == 3 and fields[0] == "+": self.reserve(fields[1],fields[2])
+				elif len(fields) == 2 and fields[0] == "-": self.release(fields[1])
+		# compact it to the current allocations
+		tmp = journal + ".tmp"
+		f = file(tmp,"w")
+		for ip,owner in self.allocated(): f.write("+ %s %s\n" % (ip,owner))
+		f.close()
+		os.rename(tmp,journal)
+		self.journal = file(journal,"a")
+
+	def close(self):
+		if self.journal:
+			self.journal.close()
+			self.journal = None
+
 # =========================== DATABASE MIGRATION SUPPORT CODE ===================
 
 # Migrator, Migratee and Evolvers -- this is the generic infrastructure.
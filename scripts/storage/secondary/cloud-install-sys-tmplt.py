@@ -19,14 +19,130 @@
 
 import argparse
 import sys
-import urllib
+import urllib2
+import urlparse
 import uuid
 import subprocess
 import os
 import shutil
-import gzip
 import zipfile
 import bz2
+import zlib
+import hashlib
+import time
+
+# Bytes read or decompressed at once, bounds the memory in use
+CHUNK_SIZE = 1024 * 1024
+# Granularity at which runs of zeros are left as holes in the template
+SPARSE_BLOCK_SIZE = 64 * 1024
+# bz2 can not bound its output, so it is fed small pieces of input
+BZ2_FEED_SIZE = 16 * 1024
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 60
+
+
+class SparseWriter(object):
+  """ Writes a stream to a file, seeking over blocks of zeros so they stay
+  holes, and keeps the size and md5 of what was written """
+
+  def __init__(self, path):
+    self.file = open(path, 'wb')
+    self.pending = []
+    self.pendingSize = 0
+    self.size = 0
+    self.md5 = hashlib.md5()
+    self.zeros = '\0' * SPARSE_BLOCK_SIZE
+
+  def write(self, data):
+    self.md5.update(data)
+    self.pending.append(data)
+    self.pendingSize += len(data)
+    if self.pendingSize >= SPARSE_BLOCK_SIZE:
+      self.writeBlocks(False)
+
+  def writeBlocks(self, final):
+    data = ''.join(self.pending)
+    end = len(data)
+    if not final:
+      end -= end % SPARSE_BLOCK_SIZE
+    for offset in xrange(0, end, SPARSE_BLOCK_SIZE):
+      block = data[offset:offset + SPARSE_BLOCK_SIZE]
+      if block == self.zeros[:len(block)]:
+        self.file.seek(len(block), os.SEEK_CUR)
+      else:
+        self.file.write(block)
+    self.size += end
+    self.pending = [data[end:]]
+    self.pendingSize = len(data) - end
+
+  def close(self):
+    self.writeBlocks(True)
+    # a trailing hole is only allocated by setting the size
+    self.file.truncate(self.size)
+    self.file.close()
+
+
+class StreamDecompressor(object):
+  """ Decompresses gz or bz2 data given chunk by chunk, including files made
+  of several concatenated streams as written by pigz or pbzip2 """
+
+  def __init__(self, extension):
+    self.extension = extension
+    self.decompressor = self.create()
+
+  def create(self):
+    if self.extension == 'gz':
+      return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return bz2.BZ2Decompressor()
+
+  def decompress(self, data):
+    while data:
+      if self.extension == 'gz':
+        output = self.decompressor.decompress(data, CHUNK_SIZE)
+        data = self.decompressor.unconsumed_tail
+        if self.decompressor.unused_data:
+          # the input after the end of the stream is in both
+          data = ''
+      else:
+        piece, data = data[:BZ2_FEED_SIZE], data[BZ2_FEED_SIZE:]
+        try:
+          output = self.decompressor.decompress(piece)
+        except EOFError:
+          # the previous stream ended right at the end of a piece
+          self.decompressor = self.create()
+          output = self.decompressor.decompress(piece)
+      if output:
+        yield output
+      if self.decompressor.unused_data:
+        data = self.decompressor.unused_data + data
+        if not data.strip('\0'):
+          # padding after the last stream
+          return
+        self.decompressor = self.create()
+
+  def ended(self):
+    """ Whether the last stream was read up to its end, so a truncated or
+    corrupt file is not taken for a complete one """
+    if hasattr(self.decompressor, 'eof'):
+      return self.decompressor.eof
+    # a finished decompressor keeps any more input as unused data, or raises
+    # EOFError for bz2, where an unfinished one consumes it
+    try:
+      self.decompressor.decompress('\0')
+    except EOFError:
+      return True
+    except (IOError, zlib.error):
+      return False
+    return bool(self.decompressor.unused_data)
+
+  def flush(self):
+    if not self.ended():
+      raise IOError('The %s data ends before the end of its stream, the file is truncated or corrupt' % self.extension)
+    if self.extension == 'gz':
+      output = self.decompressor.flush()
+      if output:
+        yield output
+
 
 class InstallSysTemplate(object):
   parser = None
@@ -46,6 +162,7 @@ class InstallSysTemplate(object):
   templateName = None
   destDir = None
   fileSize = None
+  checksum = None
   dictionary = None
 
   def __init__(self):
@@ -136,16 +253,118 @@ for full help
     self.template = int(self.runMysql(mysqlQuery%ht))
 
   def downloadTemplate(self):
-    self.systemvmtemplatepath = self.templateName + "." + self.fileextension
+    # The name only depends on the url, so a download interrupted in an
+    # earlier run is found again and resumed
+    fileName = os.path.basename(urlparse.urlparse(self.systemvmtemplateurl).path) or "systemvmtemplate"
+    self.systemvmtemplatepath = fileName + ".part"
     print 'Downloading template from %s To %s' % (self.systemvmtemplateurl, self.systemvmtemplatepath)
+
+  def report(self, current, size):
+    if size:
+      sys.stdout.write("\rDownloading completed: {0:.2f}%".format(100.0*current/size))
+      sys.stdout.flush()
+
+  def openUrl(self, offset, validator):
+    request = urllib2.Request(self.systemvmtemplateurl)
+    if offset:
+      request.add_header('Range', 'bytes=%d-' % offset)
+      if validator:
+        # the server sends the whole file if it changed in between
+        request.add_header('If-Range', validator)
     try:
-      templateFileDownloadUrl = urllib.urlretrieve(self.systemvmtemplateurl, self.systemvmtemplatepath, reporthook=self.report)
-    except Exception:
-      self.errorAndExit("Failed to download template file from %s" % self.systemvmtemplateurl)
+      return urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except urllib2.HTTPError, e:
+      if e.code != 416 or not offset:
+        raise
+      # the range is past the end, this is not the file we have a part of
+      return urllib2.urlopen(urllib2.Request(self.systemvmtemplateurl), timeout=DOWNLOAD_TIMEOUT)
+
+  def downloadChunks(self):
+    """ Yields the template file as it downloads. It is also appended to
+    systemvmtemplatepath: what an earlier run left there is replayed
+    first and only the rest is requested, and a broken connection is
+    resumed from where it stopped """
+    partPath = self.systemvmtemplatepath
+    validatorPath = partPath + ".validator"
+    offset = 0
+    validator = None
+    if os.path.exists(partPath) and os.path.exists(validatorPath):
+      offset = os.path.getsize(partPath)
+      validator = file(validatorPath).read().strip() or None
 
-  def report(tmp, blocknr, blocksize, size):
-    current = blocknr*blocksize
-    sys.stdout.write("\rDownloading completed: {0:.2f}%".format(100.0*current/size))
+    response = self.openUrl(offset, validator)
+    if response.getcode() != 206:
+      offset = 0
+    size = response.info().getheader('Content-Length')
+    if size is not None:
+      size = int(size) + offset
+    validator = response.info().getheader('ETag') or response.info().getheader('Last-Modified') or ''
+    validatorFile = file(validatorPath, 'wb')
+    validatorFile.write(validator)
+    validatorFile.close()
+
+    partFile = file(partPath, 'ab')
+    try:
+      partFile.truncate(offset)
+      if offset:
+        print 'Resuming the download at %d bytes' % offset
+        replay = file(partPath, 'rb')
+        try:
+          remaining = offset
+          while remaining > 0:
+            data = replay.read(min(CHUNK_SIZE, remaining))
+            if not data:
+              break
+            remaining -= len(data)
+            yield data
+        finally:
+          replay.close()
+
+      done = offset
+      retries = 0
+      while size is None or done < size:
+        try:
+          data = response.read(CHUNK_SIZE)
+        except Exception, e:
+          data = None
+          error = e
+        if data:
+          partFile.write(data)
+          done += len(data)
+          self.report(done, size)
+          yield data
+          continue
+        if data is not None and size is None:
+          break
+        if data is not None:
+          error = "connection closed at %d of %d bytes" % (done, size)
+        retries += 1
+        if retries > DOWNLOAD_RETRIES:
+          raise Exception("Failed to download template file from %s: %s" % (self.systemvmtemplateurl, error))
+        print '\nDownload interrupted (%s), resuming at %d bytes' % (error, done)
+        partFile.flush()
+        time.sleep(retries)
+        response = self.openUrl(done, validator)
+        if response.getcode() != 206:
+          raise Exception("The server can not resume the download of %s" % self.systemvmtemplateurl)
+      print ''
+    finally:
+      partFile.close()
+
+  def compressedChunks(self):
+    if self.systemvmtemplateurl:
+      for data in self.downloadChunks():
+        yield data
+      return
+    compressedFile = file(self.systemvmtemplatepath, 'rb')
+    try:
+      while True:
+        data = compressedFile.read(CHUNK_SIZE)
+        if not data:
+          break
+        yield data
+    finally:
+      compressedFile.close()
 
   def installTemplate(self):
     destDir = self.mountpoint + os.sep + "template" + os.sep + "tmpl" + os.sep + "1" + os.sep + str(self.template)
@@ -160,47 +379,58 @@ for full help
     except Exception, e:
       self.errorAndExit('Failed to create directories on the mounted path.. %s' % str (e))
     print 'Installing Template to : %s' % destDir
-    tmpFile = self.templateName + "." + "tmp"
-    self.uncompressFile(tmpFile)
-    print 'Moving the decompressed file to destination directory %s... which could take a long time, please wait' % destDir
-    shutil.move(tmpFile, destDir + os.sep + self.templateName)
+    # Decompressed straight into the destination, so the final rename does
+    # not copy the template across file systems
+    tmpFile = destDir + os.sep + self.templateName + "." + "tmp"
+    try:
+      self.uncompressFile(tmpFile)
+    except Exception, e:
+      if os.path.exists(tmpFile):
+        os.remove(tmpFile)
+      self.errorAndExit('Failed to install the template: %s' % str(e))
+    os.rename(tmpFile, destDir + os.sep + self.templateName)
+    if self.systemvmtemplateurl:
+      os.remove(self.systemvmtemplatepath)
+      os.remove(self.systemvmtemplatepath + ".validator")
 
   def uncompressFile(self, fileName):
     print 'Uncompressing the file %s... which could take a long time, please wait' % self.systemvmtemplatepath
-    if self.fileextension == 'gz':
-      compressedFile = gzip.GzipFile(self.systemvmtemplatepath, 'rb')
-      decompressedData = compressedFile.read()
-      compressedFile.close()
-      decompressedFile = file(fileName, 'wb')
-      decompressedFile.write(decompressedData)
-      decompressedFile.close()
-    elif self.fileextension == 'bz2':
-      compressedFile = bz2.BZ2File(self.systemvmtemplatepath)
-      decompressedData = compressedFile.read()
-      compressedFile.close()
-      decompressedFile = file(fileName, 'wb')
-      decompressedFile.write(decompressedData)
-      decompressedFile.close()
-      print ''
-    elif self.fileextension == 'zip':
-      zippedFile = zipfile.ZipFile(self.systemvmtemplatepath, 'r')
-      zippedFiles = zippedFile.namelist()
-      compressedFile = zippedFiles[0]
-      decompressedData = zippedFile.read(compressedFile)
-      decompressedFile = file(fileName, 'wb')
-      decompressedFile.write(decompressedData)
-      decompressedFile.close()
-      zippedFile.close()
-      print ''
-    else:
+    if self.fileextension not in ('gz', 'bz2', 'zip'):
       self.errorAndExit('Not supported file type %s to decompress' % self.fileextension)
-    self.fileSize = os.path.getsize(fileName)
+    decompressedFile = SparseWriter(fileName)
+    try:
+      if self.fileextension == 'zip':
+        # The zip directory is at the end, so the archive is complete
+        # before its first member can be read
+        if self.systemvmtemplateurl:
+          for data in self.compressedChunks():
+            pass
+        zippedFile = zipfile.ZipFile(self.systemvmtemplatepath, 'r')
+        compressedFile = zippedFile.open(zippedFile.namelist()[0])
+        while True:
+          data = compressedFile.read(CHUNK_SIZE)
+          if not data:
+            break
+          decompressedFile.write(data)
+        compressedFile.close()
+        zippedFile.close()
+      else:
+        decompressor = StreamDecompressor(self.fileextension)
+        for data in self.compressedChunks():
+          for decompressedData in decompressor.decompress(data):
+            decompressedFile.write(decompressedData)
+        for decompressedData in decompressor.flush():
+          decompressedFile.write(decompressedData)
+    finally:
+      decompressedFile.close()
+    self.fileSize = decompressedFile.size
+    self.checksum = decompressedFile.md5.hexdigest()
 
   def writeProperties(self):
     propertiesFile = file(self.destDir + os.sep + 'template.properties', 'wb')
     propertiesFile.write('filename=%s\n'%self.templateName)
     propertiesFile.write('description=SystemVM Template\n')
-    propertiesFile.write('checksum=\n')
+    propertiesFile.write('checksum=%s\n'%self.checksum)
     propertiesFile.write('hvm=false\n')
     propertiesFile.write('size=%s\n'%str(self.fileSize))
     propertiesFile.write('%s=true\n'%self.templatesuffix)
@@ -23,6 +23,7 @@ import os
 import subprocess
 import simplejson as json
 import copy
+import re
 
 from time import localtime, asctime
 
@@ -38,6 +39,7 @@ OVS_DAEMON_PATH = "ovs-vswitchd"
 VSCTL_PATH = "/usr/bin/ovs-vsctl"
 OFCTL_PATH = "/usr/bin/ovs-ofctl"
 XE_PATH = "/opt/xensource/bin/xe"
+OFSPEC_DIR = "/var/run/cloud"
 
 # OpenFlow tables set in a pipeline processing fashion for the bridge created for a VPC's that are enabled for
 # distributed routing.
@@ -108,28 +110,138 @@ def setup_logging(log_file=None):
     root_logger.addHandler(logfile_handler)
 
 
-def do_cmd(cmd):
+def do_cmd(cmd, input=None):
     """Abstracts out the basics of issuing system commands. If the command
     returns anything in stderr, a PluginError is raised with that information.
-    Otherwise, the output from stdout is returned.
+    Otherwise, the output from stdout is returned. input is written to the
+    standard input of the command.
     """
 
     pipe = subprocess.PIPE
     logging.debug("Executing:%s", cmd)
+    spawned()
     proc = subprocess.Popen(cmd, shell=False, stdin=pipe, stdout=pipe,
                             stderr=pipe, close_fds=True)
-    ret_code = proc.wait()
-    err = proc.stderr.read()
+    # read both pipes while waiting, a large output would block the command
+    output, err = proc.communicate(input)
+    ret_code = proc.returncode
     if ret_code:
         logging.debug("The command exited with the error code: " +
                       "%s (stderr output:%s)" % (ret_code, err))
         raise PluginError(err)
-    output = proc.stdout.read()
     if output.endswith('\n'):
         output = output[:-1]
     return output
 
 
+# Number of commands spawned since the plugin call started
+_spawn_count = [0]
+
+
+def spawned():
+    _spawn_count[0] += 1
+
+
+def spawn_count():
+    return _spawn_count[0]
+
+
+class Inventory(object):
+    """Snapshot of the VIFs and OVS interfaces of this host, taken with one
+    xe and one ovs-vsctl call. Lookups that miss it fall back to querying
+    xe or ovs-vsctl directly.
+    """
+
+    def __init__(self):
+        self.vif_by_mac = {}
+        self.ofport_by_interface = {}
+        self.network_by_interface = {}
+
+    def load(self):
+        networks = {}
+        macs = {}
+        for record in self._xe_records(do_cmd([XE_PATH, "vif-list", "params=uuid,MAC,other-config"])):
+            macs[record.get("uuid")] = record.get("MAC", "").lower()
+            other_config = self._xe_map(record.get("other-config", ""))
+            if "cloudstack-network-id" in other_config:
+                networks[record.get("uuid")] = other_config["cloudstack-network-id"]
+
+        output = json.loads(do_cmd([VSCTL_PATH, "--format=json", "--columns=name,ofport,external_ids,options",
+                                    "list", "Interface"]))
+        headings = output["headings"]
+        for row in output["data"]:
+            interface = dict(zip(headings, [self._ovs_value(value) for value in row]))
+            name = str(interface["name"])
+            if not isinstance(interface["ofport"], list):
+                self.ofport_by_interface[name] = str(interface["ofport"])
+            if "cloudstack-network-id" in interface["options"]:
+                # keep the quoting of ovs-vsctl get
+                self.network_by_interface[name] = '"%s"' % interface["options"]["cloudstack-network-id"]
+            vif_uuid = interface["external_ids"].get("xs-vif-uuid")
+            if name.startswith("vif") and vif_uuid in macs:
+                self.vif_by_mac[macs[vif_uuid]] = name
+                if vif_uuid in networks:
+                    self.network_by_interface[name] = networks[vif_uuid]
+        return self
+
+    def _xe_records(self, output):
+        records = []
+        record = {}
+        for line in output.split("\n"):
+            if not line.strip():
+                if record:
+                    records.append(record)
+                record = {}
+                continue
+            key, value = line.split(":", 1)
+            record[key.split("(")[0].strip()] = value.strip()
+        if record:
+            records.append(record)
+        return records
+
+    def _xe_map(self, value):
+        result = {}
+        for item in value.split(";"):
+            if ":" in item:
+                key, val = item.split(":", 1)
+                result[key.strip()] = val.strip()
+        return result
+
+    def _ovs_value(self, value):
+        if isinstance(value, list):
+            if value[0] == "map":
+                return dict(value[1])
+            if value[0] == "set":
+                return value[1]
+            return value[1]
+        return value
+
+
+_inventory = [None]
+
+
+def inventory():
+    return _inventory[0]
+
+
+def with_inventory(fn):
+    """Run a plugin call with an inventory snapshot and log the number of
+    commands it spawned"""
+    def wrapped(*args, **kwargs):
+        _spawn_count[0] = 0
+        try:
+            _inventory[0] = Inventory().load()
+        except Exception, e:
+            logging.debug("Failed to take the VIF inventory, looking up every port: %s" % str(e))
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _inventory[0] = None
+            logging.debug("%s spawned %d commands" % (fn.__name__, spawn_count()))
+    wrapped.__name__ = fn.__name__
+    return wrapped
+
+
 def _is_process_run(pidFile, name):
     try:
         fpid = open(pidFile, "r")
@@ -229,6 +341,136 @@ def del_flows(bridge, **kwargs):
     do_cmd(delFlow)
 
 
+# Fields of dump-flows output that are statistics rather than part of a flow
+FLOW_STATS = ("cookie", "duration", "n_packets", "n_bytes", "idle_age", "hard_age")
+FLOW_PROTOCOLS = {"tcp": "6", "udp": "17", "icmp": "1"}
+FLOW_DEFAULT_PRIORITY = "32768"
+
+
+def _split_flow(flow):
+    """Split a flow in its match tokens and its actions"""
+    parts = flow.strip().split("actions=", 1)
+    actions = ""
+    if len(parts) == 2:
+        actions = parts[1].strip()
+    return [token for token in re.split("[ ,]+", parts[0]) if token], actions
+
+
+def _split_field(token):
+    parts = token.split("=", 1)
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    return parts[0], ""
+
+
+def _normalize_flow(flow):
+    """Key of a flow that is the same for the ofspec we write and for the
+    way ovs-ofctl dump-flows prints it back"""
+    tokens, actions = _split_flow(flow)
+    table = "0"
+    match = set()
+    for token in tokens:
+        name, value = _split_field(token)
+        if name in FLOW_STATS or (name in ("idle_timeout", "hard_timeout") and value == "0"):
+            continue
+        if name == "priority" and value == FLOW_DEFAULT_PRIORITY:
+            continue
+        if name == "table":
+            table = value
+        elif name in FLOW_PROTOCOLS:
+            match.update(["ip", "nw_proto=" + FLOW_PROTOCOLS[name]])
+        elif value == "*":
+            continue
+        elif name in ("nw_src", "nw_dst") and value.endswith("/32"):
+            match.add(name + "=" + value[:-3])
+        else:
+            match.add(token.lower())
+    return table, frozenset(match), actions.lower()
+
+
+def _dump_flows(bridge):
+    """Flows of a bridge as (table, flow without statistics) tuples"""
+    flows = []
+    for line in do_cmd([OFCTL_PATH, "dump-flows", bridge]).split("\n"):
+        if "actions=" not in line:
+            continue
+        tokens, actions = _split_flow(line)
+        table = "0"
+        match = []
+        for token in tokens:
+            name, value = _split_field(token)
+            if name == "table":
+                table = value
+            if name not in FLOW_STATS or name == "cookie":
+                match.append(token)
+        flows.append((table, ",".join(match) + " actions=" + actions))
+    return flows
+
+
+def _write_flows(filename, lines):
+    flowfile = open(filename, "w")
+    try:
+        flowfile.write("\n".join(lines) + "\n")
+    finally:
+        flowfile.close()
+
+
+def replace_table_flows(bridge, tables, flows, filename):
+    """Make the given tables of a bridge hold exactly the flows meant for
+    them, flows for other tables are only added
+
+    Only the difference with the flows the bridge has is applied, in one
+    OpenFlow 1.4 bundle. Switches without bundles get the adds first, which
+    replace the changed flows in place, and then the deletes of the flows
+    no add replaced, so traffic is not dropped in between.
+    """
+    tables = [str(table) for table in tables]
+    wanted = {}
+    for flow in flows:
+        if flow.strip():
+            wanted[_normalize_flow(flow)] = flow.strip()
+
+    # Flows wanted in other tables are only added when missing
+    installed = {}
+    removed = []
+    for table, flow in _dump_flows(bridge):
+        key = _normalize_flow(flow)
+        if key in wanted:
+            installed[key] = flow
+        elif table in tables:
+            removed.append((key, flow))
+    added = [flow for key, flow in wanted.items() if key not in installed]
+
+    logging.debug("Flows of tables %s on bridge %s: %d unchanged, %d to add, %d to remove" %
+                  (",".join(tables), bridge, len(installed), len(added), len(removed)))
+    if not added and not removed:
+        return
+
+    # deletes only take the match of a flow
+    matches = []
+    for key, flow in removed:
+        match = [token for token in _split_flow(flow)[0] if not token.startswith("cookie=")]
+        matches.append((key, ",".join(match)))
+    _write_flows(filename, ["delete_strict " + match for key, match in matches] +
+                 ["add " + flow for flow in added])
+    try:
+        do_cmd([OFCTL_PATH, "-O", "OpenFlow14", "--bundle", "add-flows", bridge, filename])
+        return
+    except PluginError, e:
+        logging.debug("Bundles are not available on bridge %s, applying the changes one by one: %s" %
+                      (bridge, str(e)))
+
+    # an add with the match and priority of an installed flow replaces it
+    replaced = set([key[:2] for key in wanted if key not in installed])
+    if added:
+        _write_flows(filename, added)
+        do_cmd([OFCTL_PATH, "add-flows", bridge, filename])
+    deleted = [match for key, match in matches if key[:2] not in replaced]
+    if deleted:
+        # del-flows only reads flows from its standard input
+        do_cmd([OFCTL_PATH, "--strict", "del-flows", bridge, "-"], "\n".join(deleted) + "\n")
+
+
 def del_all_flows(bridge):
     delFlow = [OFCTL_PATH, "del-flows", bridge]
     do_cmd(delFlow)
@@ -242,6 +484,8 @@ def del_port(bridge, port):
     do_cmd(delPort)
 
 def get_network_id_for_vif(vif_name):
+    if inventory() and vif_name in inventory().network_by_interface:
+        return inventory().network_by_interface[vif_name]
     domain_id, device_id = vif_name[3:len(vif_name)].split(".")
     hostname = do_cmd(["/bin/bash", "-c", "hostname"])
     this_host_uuid = do_cmd([XE_PATH, "host-list", "hostname=%s" % hostname, "--minimal"])
@@ -252,6 +496,8 @@ def get_network_id_for_vif(vif_name):
     return vnet
 
 def get_network_id_for_tunnel_port(tunnelif_name):
+    if inventory() and tunnelif_name in inventory().network_by_interface:
+        return inventory().network_by_interface[tunnelif_name]
     vnet = do_cmd([VSCTL_PATH, "get", "interface", tunnelif_name, "options:cloudstack-network-id"])
     return vnet
 
@@ -266,6 +512,8 @@ def add_flooding_rules_for_port(bridge, in_ofport, out_ofports):
         add_flow(bridge, cookie=111, priority=1100, in_port=in_ofport, table=L2_FLOOD_TABLE, actions=action)
 
 def get_ofport_for_vif(vif_name):
+    if inventory() and vif_name in inventory().ofport_by_interface:
+        return inventory().ofport_by_interface[vif_name]
     return do_cmd([VSCTL_PATH, "get", "interface", vif_name, "ofport"])
 
 def get_macaddress_of_vif(vif_name):
@@ -276,6 +524,8 @@ def get_macaddress_of_vif(vif_name):
     return mac
 
 def get_vif_name_from_macaddress(macaddress):
+    if inventory() and macaddress.lower() in inventory().vif_by_mac:
+        return inventory().vif_by_mac[macaddress.lower()]
     vif_uuid = do_cmd([XE_PATH, "vif-list", "MAC=%s" % macaddress, "--minimal"])
     vif_device_id = do_cmd([XE_PATH, "vif-param-get", "uuid=%s" % vif_uuid,  "param-name=device"])
     vm_uuid = do_cmd([XE_PATH, "vif-param-get", "uuid=%s" % vif_uuid,  "param-name=vm-uuid"])
@@ -466,6 +716,7 @@ def create_tunnel(bridge, remote_ip, gre_key, src_host, dst_host, network_uuid):
 # Configures the bridge created for a VPC that is enabled for distributed routing. Management server sends VPC
 # physical topology details (which VM from which tier running on which host etc). Based on the VPC physical topology L2
 # lookup table and L3 lookup tables are updated by this function.
+@with_inventory
 def configure_vpc_bridge_for_network_topology(bridge, this_host_id, json_config, sequence_no):
 
     vpconfig = jsonLoader(json.loads(json_config)).vpc
@@ -474,11 +725,11 @@ def configure_vpc_bridge_for_network_topology(bridge, this_host_id, json_config,
         return "FAILURE:IMPROPER_JSON_CONFG_FILE"
 
     try:
-        if not os.path.exists('/var/run/cloud'):
-            os.makedirs('/var/run/cloud')
+        if not os.path.exists(OFSPEC_DIR):
+            os.makedirs(OFSPEC_DIR)
 
         # create a temporary file to store OpenFlow rules corresponding to L2 and L3 lookup table updates
-        ofspec_filename = "/var/run/cloud/" + bridge + sequence_no + ".ofspec"
+        ofspec_filename = OFSPEC_DIR + "/" + bridge + sequence_no + ".ofspec"
         ofspec = open(ofspec_filename, 'w+')
 
         # get the list of VM's in all the tiers of VPC running in this host from the JSON config
@@ -562,16 +813,13 @@ def configure_vpc_bridge_for_network_topology(bridge, this_host_id, json_config,
         # is fallback option to send the packet to VPC VR, when routing can not be performed at the host
         ofspec.write("table=%s "%L3_LOOKUP_TABLE + " priority=0 " + " actions=resubmit(,%s)"%L2_LOOKUP_TABLE + "\n")
 
-        # First flush current L2_LOOKUP_TABLE & L3_LOOKUP_TABLE before re-applying L2 & L3 lookup entries
-        del_flows(bridge, table=L2_LOOKUP_TABLE)
-        del_flows(bridge, table=L3_LOOKUP_TABLE)
-
         ofspec.seek(0)
-        logging.debug("Adding below flows rules in L2 & L3 lookup tables:\n" + ofspec.read())
+        flows = ofspec.read()
+        logging.debug("Setting below flows rules in L2 & L3 lookup tables:\n" + flows)
         ofspec.close()
 
-        # update bridge with the flow-rules for L2 lookup and L3 lookup in the file in one attempt
-        do_cmd([OFCTL_PATH, 'add-flows', bridge, ofspec_filename])
+        # update the L2 lookup and L3 lookup tables with the flow-rules that changed in one attempt
+        replace_table_flows(bridge, [L2_LOOKUP_TABLE, L3_LOOKUP_TABLE], flows.split("\n"), ofspec_filename)
 
         # now that we updated the bridge with flow rules close and delete the file.
         os.remove(ofspec_filename)
@@ -598,11 +846,11 @@ def configure_vpc_bridge_for_routing_policies(bridge, json_config, sequence_no):
 
     try:
 
-        if not os.path.exists('/var/run/cloud'):
-            os.makedirs('/var/run/cloud')
+        if not os.path.exists(OFSPEC_DIR):
+            os.makedirs(OFSPEC_DIR)
 
         # create a temporary file to store OpenFlow rules corresponding to ingress and egress ACL table updates
-        ofspec_filename = "/var/run/cloud/" + bridge + sequence_no + ".ofspec"
+        ofspec_filename = OFSPEC_DIR + "/" + bridge + sequence_no + ".ofspec"
         ofspec = open(ofspec_filename, 'w+')
 
         tiers = vpconfig.tiers
@@ -737,16 +985,13 @@ def configure_vpc_bridge_for_routing_policies(bridge, json_config, sequence_no):
         # add a default rule in ingress table to drop packets
         ofspec.write("table=%s " %INGRESS_ACL_TABLE + " priority=0 actions=drop" + "\n")
 
-        # First flush current ingress and egress ACL's before re-applying the ACL's
-        del_flows(bridge, table=EGRESS_ACL_TABLE)
-        del_flows(bridge, table=INGRESS_ACL_TABLE)
-
         ofspec.seek(0)
-        logging.debug("Adding below flows rules Ingress & Egress ACL tables:\n" + ofspec.read())
+        flows = ofspec.read()
+        logging.debug("Setting below flows rules Ingress & Egress ACL tables:\n" + flows)
         ofspec.close()
 
-        # update bridge with the flow-rules for ingress and egress ACL's added in the file in one attempt
-        do_cmd([OFCTL_PATH, 'add-flows', bridge, ofspec_filename])
+        # update the ingress and egress ACL tables with the flow-rules that changed in one attempt
+        replace_table_flows(bridge, [EGRESS_ACL_TABLE, INGRESS_ACL_TABLE], flows.split("\n"), ofspec_filename)
 
         # now that we updated the bridge with flow rules delete the file.
         os.remove(ofspec_filename)
@@ -765,6 +1010,7 @@ def configure_vpc_bridge_for_routing_policies(bridge, json_config, sequence_no):
 # configures bridge L2 flooding rules stored in table=2. Single bridge is used for all the tiers of VPC. So controlled
 # flooding is required to restrict the broadcast to only to the ports (vifs and tunnel interfaces) in the tier. Also
 # packets arrived from the tunnel ports should not be flooded on the other tunnel ports.
+@with_inventory
 def update_flooding_rules_on_port_plug_unplug(bridge, interface, command, if_network_id):
 
     class tier_ports:
@@ -776,11 +1022,11 @@ def update_flooding_rules_on_port_plug_unplug(bridge, interface, command, if_net
                   " is %s"%command + " now.")
     try:
 
-        if not os.path.exists('/var/run/cloud'):
-            os.makedirs('/var/run/cloud')
+        if not os.path.exists(OFSPEC_DIR):
+            os.makedirs(OFSPEC_DIR)
 
         # create a temporary file to store OpenFlow rules corresponding L2 flooding table
-        ofspec_filename = "/var/run/cloud/" + bridge + "-" +interface + "-" + command + ".ofspec"
+        ofspec_filename = OFSPEC_DIR + "/" + bridge + "-" +interface + "-" + command + ".ofspec"
         ofspec = open(ofspec_filename, 'w+')
 
         all_tiers = dict()
@@ -790,7 +1036,7 @@ def update_flooding_rules_on_port_plug_unplug(bridge, interface, command, if_net
 
         for port in ports:
 
-            if_ofport = do_cmd([VSCTL_PATH, 'get', 'Interface', port, 'ofport'])
+            if_ofport = get_ofport_for_vif(port)
 
             if port.startswith('vif'):
                 network_id = get_network_id_for_vif(port)
@@ -832,15 +1078,13 @@ def update_flooding_rules_on_port_plug_unplug(bridge, interface, command, if_net
         # add a default rule in L2 flood table to drop packet
         ofspec.write("table=%s " %L2_FLOOD_TABLE + " priority=0 actions=drop")
 
-        # First flush current L2 flooding table before re-populating the tables
-        del_flows(bridge, table=L2_FLOOD_TABLE)
-
         ofspec.seek(0)
-        logging.debug("Adding below flows rules L2 flooding table: \n" + ofspec.read())
+        flows = ofspec.read()
+        logging.debug("Setting below flows rules L2 flooding table: \n" + flows)
         ofspec.close()
 
-        # update bridge with the flow-rules for broadcast rules added in the file in one attempt
-        do_cmd([OFCTL_PATH, 'add-flows', bridge, ofspec_filename])
+        # update the L2 flooding table with the flow-rules that changed in one attempt
+        replace_table_flows(bridge, [L2_FLOOD_TABLE], flows.split("\n"), ofspec_filename)
 
         # now that we updated the bridge with flow rules delete the file.
         os.remove(ofspec_filename)
@@ -860,6 +1104,7 @@ def is_regular_tunnel_network(xs_nw_uuid):
     cmd = [XE_PATH,"network-param-get", "uuid=%s" % xs_nw_uuid, "param-name=other-config",
                             "param-key=is-ovs-tun-network", "--minimal"]
     logging.debug("Executing:%s", cmd)
+    spawned()
     pipe = subprocess.PIPE
     proc = subprocess.Popen(cmd, shell=False, stdin=pipe, stdout=pipe,
                             stderr=pipe, close_fds=True)
@@ -877,6 +1122,7 @@ def is_vpc_network_with_distributed_routing(xs_nw_uuid):
     cmd = [XE_PATH,"network-param-get", "uuid=%s" % xs_nw_uuid, "param-name=other-config",
                             "param-key=is-ovs-vpc-distributed-vr-network", "--minimal"]
     logging.debug("Executing:%s", cmd)
+    spawned()
     pipe = subprocess.PIPE
     proc = subprocess.Popen(cmd, shell=False, stdin=pipe, stdout=pipe,
                             stderr=pipe, close_fds=True)
@@ -22,12 +22,23 @@ import urllib
 from xml.dom import minidom
 import time
 import commands
+import sys
+import threading
+from array import array
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    try:
+        import cElementTree as ElementTree
+    except ImportError:
+        ElementTree = None
 
 # Per VM dictionary (used by RRDUpdates to look up column numbers by variable names)
 class VMReport(dict):
     """Used internally by RRDUpdates"""
     def __init__(self, uuid):
         self.uuid = uuid
+        self.rrd = None     # RRDData holding the columns of this VM
         super(dict, self).__init__()
 
 
@@ -51,6 +62,94 @@ class UsageException(Exception):
     pass
 
 
+class RRDData:
+    """ The samples of one rrd_updates document
+
+    Values are kept column by column in one array of doubles, in
+    chronological order, so a window of a variable is a single slice.
+    """
+    def __init__(self):
+        self.rows = 0
+        self.columns = 0
+        self.start_time = 0
+        self.step_time = 0
+        self.end_time = 0
+        self.legend = []
+        self.times = array('l')
+        self.data = array('d')
+
+    def allocate(self):
+        self.times = array('l', [0]) * self.rows
+        self.data = array('d', [0.0]) * (self.rows * self.columns)
+
+    def value(self, col, row):
+        return self.data[col * self.rows + row]
+
+    def sum(self, col, first_row, last_row):
+        """ Sum of the samples of col in rows [first_row, last_row) """
+        offset = col * self.rows
+        return sum(self.data[offset + max(first_row, 0):offset + last_row])
+
+    def parse(self, source):
+        """ Parse a document from a file like object """
+        if ElementTree is None:
+            self.parse_dom(minidom.parse(source))
+            return
+
+        # <row> nodes are in reverse chronological order and comprise
+        # a timestamp <t> node followed by self.columns <v> nodes
+        meta = {}
+        row = -1
+        col = 0
+        for event, elem in ElementTree.iterparse(source):
+            tag = elem.tag
+            if tag == 'v':
+                self.data[col * self.rows + row] = float(elem.text)
+                col += 1
+            elif tag == 't':
+                if row == -1:
+                    row = self.rows
+                    self.allocate()
+                row -= 1
+                col = 0
+                self.times[row] = int(elem.text)
+            elif tag == 'row':
+                elem.clear()
+            elif tag == 'entry':
+                self.legend.append(elem.text)
+            elif tag in ('rows', 'columns', 'start', 'step', 'end'):
+                meta[tag] = int(elem.text)
+                if tag == 'columns':
+                    self.rows = meta['rows']
+                    self.columns = meta['columns']
+        self.set_meta(meta)
+
+    def parse_dom(self, xmldoc):
+        # The 1st node contains meta data (description of the data)
+        # The 2nd node contains the data
+        meta_node = xmldoc.firstChild.childNodes[0]
+        data_node = xmldoc.firstChild.childNodes[1]
+        meta = {}
+        for name in ('rows', 'columns', 'start', 'step', 'end'):
+            meta[name] = int(meta_node.getElementsByTagName(name)[0].firstChild.data)
+        self.rows = meta['rows']
+        self.columns = meta['columns']
+        self.set_meta(meta)
+        self.legend = [node.firstChild.data for node in meta_node.getElementsByTagName('legend')[0].childNodes]
+        self.allocate()
+        for i in xrange(self.rows):
+            row = self.rows - 1 - i
+            nodes = data_node.childNodes[i].childNodes
+            self.times[row] = int(nodes[0].firstChild.data)
+            for col in xrange(self.columns):
+                self.data[col * self.rows + row] = float(nodes[col + 1].firstChild.data)
+
+    def set_meta(self, meta):
+        self.start_time = meta['start']
+        self.step_time = meta['step']
+        self.end_time = meta['end']
+
+
 class RRDUpdates:
     """ Object used to get and parse the output the http://localhost/rrd_udpates?...
     """
@@ -61,8 +160,16 @@ class RRDUpdates:
         self.params['host'] = 'false'   # include data for host (as well as for VMs)
         self.params['cf'] = 'AVERAGE'  # consolidation function, each sample averages 12 from the 5 second RRD
         self.params['interval'] = '60'
+        self.rrd = RRDData()
+        self.rows = 0
+        # vm_reports matches uuid to per VM report
+        self.vm_reports = {}
+        # There is just one host_report and its uuid should not change!
+        self.host_report = None
 
-    def get_nrows(self):
+    def get_nrows(self, uuid=None):
+        if uuid is not None:
+            return self.vm_reports[uuid].rrd.rows
         return self.rows
 
     def get_vm_list(self):
@@ -75,7 +182,7 @@ class RRDUpdates:
         return report.keys()
 
     def get_total_cpu_core(self, uuid):
-	report = self.vm_reports[uuid]
+        report = self.vm_reports[uuid]
         if not report:
             return 0
         else:
@@ -87,11 +194,13 @@ class RRDUpdates:
             return result
 
     def get_vm_data(self, uuid, param, row):
-	#pp = pprint.PrettyPrinter(indent=4) 
-	#pp.pprint(self.vm_reports)
         report = self.vm_reports[uuid]
-        col = report[param]
-        return self.__lookup_data(col, row)
+        return report.rrd.value(report[param], row)
+
+    def get_vm_sum(self, uuid, param, first_row, last_row):
+        """ Sum of the samples of a VM variable over rows [first_row, last_row) """
+        report = self.vm_reports[uuid]
+        return report.rrd.sum(report[param], first_row, last_row)
 
     def get_host_uuid(self):
         report = self.host_report
@@ -108,24 +217,10 @@ class RRDUpdates:
     def get_host_data(self, param, row):
         report = self.host_report
         col = report[param]
-        return self.__lookup_data(col, row)
+        return self.rrd.value(col, row)
 
     def get_row_time(self, row):
-        return self.__lookup_timestamp(row)
-
-    # extract float from value (<v>) node by col,row
-    def __lookup_data(self, col, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[col + 1]
-        return float(node.firstChild.toxml())  # node.firstChild should have nodeType TEXT_NODE
-
-    # extract int from value (<t>) node by row
-    def __lookup_timestamp(self, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[0]
-        return int(node.firstChild.toxml())  # node.firstChild should have nodeType TEXT_NODE
+        return self.rrd.times[row]
 
     def refresh(self, login, starttime, session, override_params):
         self.params['start'] = starttime
@@ -133,40 +228,51 @@ class RRDUpdates:
         params['session_id'] = session
         params.update(self.params)
         paramstr = "&".join(["%s=%s" % (k, params[k]) for k in params])
-        # this is better than urllib.urlopen() as it raises an Exception on http 401 'Unauthorised' error
-        # rather than drop into interactive mode
-	for host in login.host.get_all():
-		#print "http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr
-        	sock = urllib.URLopener().open("http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr)
-	        xmlsource = sock.read()
-        	sock.close()
-        	xmldoc = minidom.parseString(xmlsource)
-        	self.__parse_xmldoc(xmldoc)
-        	# Update the time used on the next run
-        	self.params['start'] = self.end_time + 1  # avoid retrieving same data twice
-
-    def __parse_xmldoc(self, xmldoc):
-        # The 1st node contains meta data (description of the data)
-        # The 2nd node contains the data
-        self.meta_node = xmldoc.firstChild.childNodes[0]
-        self.data_node = xmldoc.firstChild.childNodes[1]
-
-        def lookup_metadata_bytag(name):
-            return int(self.meta_node.getElementsByTagName(name)[0].firstChild.toxml())
-            # rows = number of samples per variable
+        addresses = [str(login.host.get_address(host)) for host in login.host.get_all()]
+
+        # Every host is fetched and parsed in its own thread
+        documents = [None] * len(addresses)
+        errors = []
+        def fetch(i):
+            try:
+                # this is better than urllib.urlopen() as it raises an Exception on http 401 'Unauthorised' error
+                # rather than drop into interactive mode
+                sock = urllib.URLopener().open("http://" + addresses[i] + "/rrd_updates?%s" % paramstr)
+                try:
+                    rrd = RRDData()
+                    rrd.parse(sock)
+                    documents[i] = rrd
+                finally:
+                    sock.close()
+            except:
+                errors.append(sys.exc_info())
+
+        threads = []
+        for i in range(len(addresses)):
+            thread = threading.Thread(target=fetch, args=(i,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+        for rrd in documents:
+            self.parse_rrd(rrd)
+        if documents:
+            # Update the time used on the next run
+            self.params['start'] = max([rrd.end_time for rrd in documents]) + 1  # avoid retrieving same data twice
+
+    def parse_rrd(self, rrd):
+        self.rrd = rrd
+        # rows = number of samples per variable
         # columns = number of variables
-        self.rows = lookup_metadata_bytag('rows')
-        self.columns = lookup_metadata_bytag('columns')
+        self.rows = rrd.rows
+        self.columns = rrd.columns
         # These indicate the period covered by the data
-        self.start_time = lookup_metadata_bytag('start')
-        self.step_time = lookup_metadata_bytag('step')
-        self.end_time = lookup_metadata_bytag('end')
-        # the <legend> Node describes the variables
-        self.legend = self.meta_node.getElementsByTagName('legend')[0]
-        # vm_reports matches uuid to per VM report
-        if not hasattr(self,'vm_reports'):
-		self.vm_reports = {}
-        # There is just one host_report and its uuid should not change!
+        self.start_time = rrd.start_time
+        self.step_time = rrd.step_time
+        self.end_time = rrd.end_time
         self.host_report = None
         # Handle each column.  (I.e. each variable)
         for col in range(self.columns):
@@ -174,7 +280,7 @@ class RRDUpdates:
 
     def __handle_col(self, col):
         # work out how to interpret col from the legend
-        col_meta_data = self.legend.childNodes[col].firstChild.toxml()
+        col_meta_data = self.rrd.legend[col]
         # vm_or_host will be 'vm' or 'host'.  Note that the Control domain counts as a VM!
         (cf, vm_or_host, uuid, param) = col_meta_data.split(':')
         if vm_or_host == 'vm':
@@ -183,6 +289,7 @@ class RRDUpdates:
                 self.vm_reports[uuid] = VMReport(uuid)
                 # Update the VMReport with the col data and meta data
             vm_report = self.vm_reports[uuid]
+            vm_report.rrd = self.rrd
             vm_report[param] = col
         elif vm_or_host == 'host':
             # Create a report for the host if it doesn't exist
@@ -198,13 +305,23 @@ class RRDUpdates:
 def getuuid(vm_name):
     status, output = commands.getstatusoutput("xe vm-list | grep "+vm_name+" -B 1 | head -n 1 | awk -F':' '{print $2}' | tr -d ' '")
     if (status != 0):
-	raise PerfMonException("Invalid vm name: %s" % vm_name)
+        raise PerfMonException("Invalid vm name: %s" % vm_name)
     return output
 
+def get_vm_uuids(login):
+    """ Map of VM name to uuid from a single XenAPI call, templates,
+    snapshots and dom0 can share the name of a VM and are left out """
+    uuids = {}
+    for record in login.VM.get_all_records().values():
+        if record['is_a_template'] or record['is_a_snapshot'] or record['is_control_domain']:
+            continue
+        uuids[record['name_label']] = record['uuid']
+    return uuids
+
 def get_vm_group_perfmon(args={}):
     login = XenAPI.xapi_local()
     login.login_with_password("","")
-    result = ""
+    result = []
 
     total_vm = int(args['total_vm'])
     total_counter = int(args['total_counter'])
@@ -225,37 +342,30 @@ def get_vm_group_perfmon(args={}):
 
     rrd_updates = RRDUpdates()
     rrd_updates.refresh(login.xenapi, now * 60 - max_duration, session, {})
+    uuids = get_vm_uuids(login.xenapi)
 
     #for uuid in rrd_updates.get_vm_list():
     for vm_count in xrange(1, total_vm + 1):
-	vm_name = args['vmname' + str(vm_count)]
-        vm_uuid = getuuid(vm_name)
+        vm_name = args['vmname' + str(vm_count)]
+        vm_uuid = uuids.get(vm_name)
+        if vm_uuid is None:
+            vm_uuid = getuuid(vm_name)
         #print "Got values for VM: " + str(vm_count) + " " + vm_uuid
+        total_row = rrd_updates.get_nrows(vm_uuid)
         for counter_count in xrange(1, total_counter + 1):
-	    #refresh average
-	    average_cpu = 0
-	    average_memory = 0
             counter = args['counter' + str(counter_count)]
-            total_row = rrd_updates.get_nrows()
             duration = int(args['duration' + str(counter_count)]) / 60
             duration_diff = total_row - duration
             if counter == "cpu":
-		total_cpu = rrd_updates.get_total_cpu_core(vm_uuid)
-                for row in xrange(duration_diff, total_row):
-                    for cpu in xrange(0, total_cpu):
-                        average_cpu += rrd_updates.get_vm_data(vm_uuid, "cpu" + str(cpu), row)
+                total_cpu = rrd_updates.get_total_cpu_core(vm_uuid)
+                average_cpu = 0
+                for cpu in xrange(0, total_cpu):
+                    average_cpu += rrd_updates.get_vm_sum(vm_uuid, "cpu" + str(cpu), duration_diff, total_row)
                 average_cpu /= (duration * total_cpu)
-                if result == "":
-                    result += str(vm_count) + '.' +  str(counter_count) + ':' + str(average_cpu)
-                else:
-                    result += ',' + str(vm_count) +  '.' + str(counter_count) + ':' + str(average_cpu)
+                result.append(str(vm_count) + '.' + str(counter_count) + ':' + str(average_cpu))
             elif counter == "memory":
-                for row in xrange(duration_diff, total_row):
-                    average_memory += rrd_updates.get_vm_data(vm_uuid, "memory_target", row) / 1048576 - rrd_updates.get_vm_data(vm_uuid, "memory_internal_free", row) / 1024
+                average_memory = rrd_updates.get_vm_sum(vm_uuid, "memory_target", duration_diff, total_row) / 1048576 - \
+                    rrd_updates.get_vm_sum(vm_uuid, "memory_internal_free", duration_diff, total_row) / 1024
                 average_memory /= duration
-                if result == "":
-                    result += str(vm_count) +  '.' +  str(counter_count) + ':' + str(average_memory)
-                else:
-                    result += ',' + str(vm_count) +  '.' +  str(counter_count) + ':' + str(average_memory)
-    return result
-
+                result.append(str(vm_count) + '.' + str(counter_count) + ':' + str(average_memory))
+    return ','.join(result)
@@ -28,6 +28,8 @@ import re
 import libvirt
 import fcntl
 import time
+import hashlib
+import subprocess
 
 logpath = "/var/run/cloud/"        # FIXME: Logs should reside in /var/log/cloud
 lock_file = "/var/lock/cloudstack_security_group.lock"
@@ -35,6 +37,9 @@ iptables = Command("iptables")
 bash = Command("/bin/bash")
 ebtables = Command("ebtables")
 driver = "qemu:///system"
+# Load the chains of a vm with ipset/iptables-restore/ebtables-restore
+# instead of one process per rule. Falls back to the per rule commands.
+batch_rules = True
 cfo = configFileOps("/etc/cloudstack/agent/agent.properties")
 hyper = cfo.getEntry("hypervisor.type")
 if hyper == "lxc":
@@ -58,6 +63,14 @@ def execute(cmd):
     logging.debug(cmd)
     return bash("-c", cmd).stdout
 
+def restore(cmd, data):
+    """ Feed data to one of the *-restore commands, raises if it fails """
+    logging.debug(cmd + "\n" + data)
+    p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = p.communicate(data)[1]
+    if p.returncode != 0:
+        raise Exception("%s failed with %s: %s" % (cmd, p.returncode, err.strip()))
+
 def can_bridge_firewall(privnic):
     try:
         execute("which iptables")
@@ -208,6 +221,11 @@ def destroy_network_rules_for_vm(vm_name, vif=None):
     except:
         logging.debug("Ignoring failure to delete ipset " + vmchain)
 
+    try:
+        destroy_rule_ipsets(vm_name, [])
+    except:
+        logging.debug("Ignoring failure to delete rule ipsets of " + vm_name)
+
     if vif is not None:
         try:
             dnats = execute("""iptables -t nat -S | awk '/%s/ { sub(/-A/, "-D", $1) ; print }'""" % vif ).split("\n")
@@ -305,6 +323,80 @@ def default_ebtables_rules(vm_name, vm_ip, vm_mac, vif):
         logging.debug("Failed to program default ebtables OUT rules")
         return 'false'
 
+def ebtables_vm_chains(vm_name):
+    return [vm_name + "-in", vm_name + "-out", vm_name + "-in-ips", vm_name + "-out-ips"]
+
+def render_ebtables_rules(vm_name, vm_ip, vm_mac, vif, sec_ips):
+    """ The nat rules of a vm in the order default_ebtables_rules and
+    ebtables_rules_vmip leave them in """
+    [vmchain_in, vmchain_out, vmchain_in_ips, vmchain_out_ips] = ebtables_vm_chains(vm_name)
+    sec_ips = [ip for ip in filter(None, sec_ips) if ip != "0"]
+    sec_ips.reverse()
+
+    rules = ["-A PREROUTING -i " + vif + " -j " + vmchain_in,
+             "-A POSTROUTING -o " + vif + " -j " + vmchain_out]
+
+    rules += ["-A " + vmchain_in + " -s ! " + vm_mac + " -j DROP",
+              "-A " + vmchain_in + " -p ARP -s ! " + vm_mac + " -j DROP",
+              "-A " + vmchain_in + " -p ARP --arp-mac-src ! " + vm_mac + " -j DROP"]
+    if vm_ip is not None:
+        rules.append("-A " + vmchain_in + " -p ARP -j " + vmchain_in_ips)
+    rules += ["-A " + vmchain_in + " -p ARP --arp-op Request -j ACCEPT",
+              "-A " + vmchain_in + " -p ARP --arp-op Reply -j ACCEPT",
+              "-A " + vmchain_in + " -p ARP -j DROP"]
+
+    rules.append("-A " + vmchain_out + " -p ARP --arp-op Reply --arp-mac-dst ! " + vm_mac + " -j DROP")
+    if vm_ip is not None:
+        rules.append("-A " + vmchain_out + " -p ARP -j " + vmchain_out_ips)
+    rules += ["-A " + vmchain_out + " -p ARP --arp-op Request -j ACCEPT",
+              "-A " + vmchain_out + " -p ARP --arp-op Reply -j ACCEPT",
+              "-A " + vmchain_out + " -p ARP -j DROP"]
+
+    for ip in sec_ips:
+        rules.append("-A " + vmchain_in_ips + " -p ARP --arp-ip-src " + ip + " -j RETURN")
+    if vm_ip is not None:
+        rules.append("-A " + vmchain_in_ips + " -p ARP --arp-ip-src " + vm_ip + " -j RETURN")
+    rules.append("-A " + vmchain_in_ips + " -j DROP")
+
+    for ip in sec_ips:
+        rules.append("-A " + vmchain_out_ips + " -p ARP --arp-ip-dst " + ip + " -j RETURN")
+    if vm_ip is not None:
+        rules.append("-A " + vmchain_out_ips + " -p ARP --arp-ip-dst " + vm_ip + " -j RETURN")
+    rules.append("-A " + vmchain_out_ips + " -j DROP")
+    return rules
+
+def apply_ebtables_rules(vm_name, vm_ip, vm_mac, vif, sec_ips):
+    """ Replace the nat chains of a vm with a single ebtables-restore
+
+    ebtables-restore always replaces a whole table, so the current nat
+    table is saved, stripped of the chains of this vm and of the rules
+    jumping to them and loaded again together with the new chains.
+    """
+    chains = ebtables_vm_chains(vm_name)
+    policies = []
+    rules = []
+    table = None
+    for line in execute("ebtables-save").split("\n"):
+        if line.startswith("*"):
+            table = line[1:].strip()
+            continue
+        if table != "nat" or not line.strip() or line.startswith("#"):
+            continue
+        tokens = line.split()
+        if line.startswith(":"):
+            if tokens[0][1:] not in chains:
+                policies.append(line)
+        elif line.startswith("-A"):
+            target = tokens[tokens.index("-j") + 1] if "-j" in tokens[:-1] else None
+            if tokens[1] not in chains and target not in chains:
+                rules.append(line)
+    if not policies:
+        raise Exception("No nat table in ebtables-save output")
+
+    policies += [":" + chain + " ACCEPT" for chain in chains]
+    rules += render_ebtables_rules(vm_name, vm_ip, vm_mac, vif, sec_ips)
+    restore("ebtables-restore", "\n".join(["*nat"] + policies + rules) + "\n")
+
 
 def default_network_rules_systemvm(vm_name, localbrname):
     bridges = getBridges(vm_name)
@@ -427,6 +519,48 @@ def ebtables_rules_vmip (vmname, ips, action):
         except:
             logging.debug("Failed to program ebtables rules for secondary ip %s for vm %s with action %s" % (ip, vmname, action))
 
+def default_iptables_rules(vm_name, vm_ip, vif, brfw):
+    vmchain = vm_name
+    vmchain_egress = egress_chain_name(vm_name)
+    vmchain_default = '-'.join(vmchain.split('-')[:-1]) + "-def"
+    vmipsetName = vm_name
+
+    rules = ["-A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain_default,
+             "-A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain_default,
+             "-A " + vmchain_default + " -m state --state RELATED,ESTABLISHED -j ACCEPT"]
+    #allow dhcp
+    rules += ["-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -p udp --dport 67 --sport 68 -j ACCEPT",
+              "-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -p udp --dport 68 --sport 67 -j ACCEPT"]
+
+    #don't let vm spoof its ip address
+    if vm_ip is not None:
+        rules += ["-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set ! --set " + vmipsetName + " src -j DROP",
+                  "-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p udp --dport 53 -j RETURN",
+                  "-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -j " + vmchain_egress]
+    rules += ["-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain,
+              "-A " + vmchain + " -j DROP"]
+    return rules
+
+def apply_default_network_rules(vm_name, vm_ip, vm_mac, vif, brfw, ips):
+    """ Program the default rules of a vm with one ipset restore,
+    one iptables-restore and one ebtables-restore """
+    vmchain = vm_name
+    vmchain_egress = egress_chain_name(vm_name)
+    vmchain_default = '-'.join(vmchain.split('-')[:-1]) + "-def"
+    vmipsetName = vm_name
+
+    sets = ["create " + vmipsetName + " hash:ip -exist", "flush " + vmipsetName]
+    sets += ["add " + vmipsetName + " " + ip + " -exist" for ip in filter(None, [vm_ip] + ips)]
+    restore("ipset restore", "\n".join(sets) + "\n")
+
+    # Declaring a chain creates it or flushes it when it already exists
+    data = ["*filter"] + [":" + chain + " - [0:0]" for chain in [vmchain, vmchain_egress, vmchain_default]]
+    data += default_iptables_rules(vm_name, vm_ip, vif, brfw)
+    data.append("COMMIT")
+    restore("iptables-restore --noflush", "\n".join(data) + "\n")
+
+    apply_ebtables_rules(vm_name, vm_ip, vm_mac, vif, ips)
+
 def default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, sec_ips):
     if not addFWFramework(brname):
         return False
@@ -439,35 +573,6 @@ def default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, sec_ips):
     vmchain_egress = egress_chain_name(vm_name)
     vmchain_default = '-'.join(vmchain.split('-')[:-1]) + "-def"
 
-    destroy_ebtables_rules(vmName, vif)
-
-    try:
-        execute("iptables -N " + vmchain)
-    except:
-        execute("iptables -F " + vmchain)
-
-    try:
-        execute("iptables -N " + vmchain_egress)
-    except:
-        execute("iptables -F " + vmchain_egress)
-
-    try:
-        execute("iptables -N " + vmchain_default)
-    except:
-        execute("iptables -F " + vmchain_default)
-
-    action = "-A"
-    vmipsetName = vm_name
-    #create ipset and add vm ips to that ip set
-    if create_ipset_forvm(vmipsetName) == False:
-       logging.debug(" failed to create ipset for rule " + str(tokens))
-       return 'false'
-
-    #add primary nic ip to ipset
-    if add_to_ipset(vmipsetName, [vm_ip], action ) == False:
-       logging.debug(" failed to add vm " + vm_ip + " ip to set ")
-       return 'false'
-
     #add secodnary nic ips to ipset
     secIpSet = "1"
     ips = sec_ips.split(':')
@@ -475,35 +580,63 @@ def default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, sec_ips):
     if ips[0] == "0":
         secIpSet = "0";
 
+    programmed = False
+    if batch_rules:
+        try:
+            apply_default_network_rules(vm_name, vm_ip, vm_mac, vif, brfw, ips if secIpSet == "1" else [])
+            programmed = True
+        except:
+            logging.exception("Failed to restore default rules for vm " + vm_name + ", programming them one by one")
+
+    if not programmed:
+        destroy_ebtables_rules(vmName, vif)
+
+        try:
+            execute("iptables -N " + vmchain)
+        except:
+            execute("iptables -F " + vmchain)
+
+        try:
+            execute("iptables -N " + vmchain_egress)
+        except:
+            execute("iptables -F " + vmchain_egress)
+
+        try:
+            execute("iptables -N " + vmchain_default)
+        except:
+            execute("iptables -F " + vmchain_default)
+
+        action = "-A"
+        vmipsetName = vm_name
+        #create ipset and add vm ips to that ip set
+        if create_ipset_forvm(vmipsetName) == False:
+           logging.debug(" failed to create ipset for rule " + str(tokens))
+           return 'false'
+
+        #add primary nic ip to ipset
+        if add_to_ipset(vmipsetName, [vm_ip], action ) == False:
+           logging.debug(" failed to add vm " + vm_ip + " ip to set ")
+           return 'false'
+
+        if secIpSet == "1":
+            logging.debug("Adding ipset for secondary ips")
+            add_to_ipset(vmipsetName, ips, action)
+
+        try:
+            for rule in default_iptables_rules(vm_name, vm_ip, vif, brfw):
+                execute("iptables " + rule)
+        except:
+            logging.debug("Failed to program default rules for vm " + vm_name)
+            return 'false'
+
+        default_ebtables_rules(vmchain, vm_ip, vm_mac, vif)
+        #default ebtables rules for vm secondary ips
+        ebtables_rules_vmip(vm_name, ips, "-I")
+
     if secIpSet == "1":
-        logging.debug("Adding ipset for secondary ips")
-        add_to_ipset(vmipsetName, ips, action)
         if write_secip_log_for_vm(vm_name, sec_ips, vm_id) == False:
             logging.debug("Failed to log default network rules, ignoring")
 
-    try:
-        execute("iptables -A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain_default)
-        execute("iptables -A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain_default)
-        execute("iptables -A " + vmchain_default + " -m state --state RELATED,ESTABLISHED -j ACCEPT")
-        #allow dhcp
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -p udp --dport 67 --sport 68 -j ACCEPT")
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -p udp --dport 68 --sport 67  -j ACCEPT")
-
-        #don't let vm spoof its ip address
-        if vm_ip is not None:
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set ! --set " + vmipsetName + " src -j DROP")
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p udp --dport 53  -j RETURN ")
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -j " + vmchain_egress)
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
-        execute("iptables -A " + vmchain + " -j DROP")
-    except:
-        logging.debug("Failed to program default rules for vm " + vm_name)
-        return 'false'
-
-    default_ebtables_rules(vmchain, vm_ip, vm_mac, vif)
-    #default ebtables rules for vm secondary ips
-    ebtables_rules_vmip(vm_name, ips, "-I")
-
     if vm_ip is not None:
         if write_rule_log_for_vm(vmName, vm_id, vm_ip, domID, '_initial_', '-1') == False:
             logging.debug("Failed to log default network rules, ignoring")
@@ -808,35 +941,29 @@ def remove_rule_log_for_vm(vmName):
 def egress_chain_name(vm_name):
     return vm_name + "-eg"
 
-def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif, brname, sec_ips):
-  try:
-    vmName = vm_name
-    domId = getvmId(vmName)
-
-    changes = []
-    changes = check_rule_log_for_vm(vmName, vm_id, vm_ip, domId, signature, seqno)
-
-    if not 1 in changes:
-        logging.debug("Rules already programmed for vm " + vm_name)
-        return 'true'
-
-    if changes[0] or changes[1] or changes[2] or changes[3]:
-        default_network_rules(vmName, vm_id, vm_ip, vmMac, vif, brname, sec_ips)
-
-    if rules == "" or rules == None:
-        lines = []
-    else:
-        lines = rules.split(';')[:-1]
-
-    logging.debug("    programming network rules for IP: " + vm_ip + " vmname=" + vm_name)
-    try:
-      vmchain = vm_name
-      execute("iptables -F " + vmchain)
-      egress_vmchain = egress_chain_name(vm_name)
-      execute("iptables -F " + egress_vmchain)
-    except:
-      logging.debug("Error flushing iptables rules for " + vmchain + ". Presuming firewall rules deleted, re-initializing." )
-      default_network_rules(vm_name, vm_id, vm_ip, vmMac, vif, brname, sec_ips)
+def rule_ipset_prefix(vm_name):
+    # ipset names are at most 31 characters long, the prefix leaves room
+    # for "-", the rule type, the rule hash and the "t" of the temporary set
+    if len(vm_name) > 16:
+        return vm_name[:8] + hashlib.md5(vm_name).hexdigest()[:8]
+    return vm_name
+
+def rule_ipset_name(vm_name, ruletype, protocol, start, end):
+    """ The set of a rule is named after what the rule matches, so a set
+    loaded for a changed rule never swaps its cidrs into a set the rules
+    still installed in the chains of the vm match on """
+    key = ':'.join([ruletype, protocol, start, end])
+    return "%s-%s%s" % (rule_ipset_prefix(vm_name), ruletype, hashlib.md5(key).hexdigest()[:12])
+
+def render_network_rules(vm_name, lines, use_ipsets):
+    """ Returns the iptables commands for the rules of a vm in the order
+    they are inserted, the ipsets they match on and the number of egress rules
+
+    With use_ipsets the cidrs of a rule are put in a hash:net set matched
+    by a single rule instead of one rule per cidr.
+    """
+    commands = []
+    ipsets = {}
     egressrule = 0
     for line in lines:
         tokens = line.split(':')
@@ -863,43 +990,137 @@ def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif
             i = ips.index('0.0.0.0/0')
             del ips[i]
             allow_any = True
-        range = start + ":" + end
-        if ips:
-            if protocol == 'all':
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -m state --state NEW " + direction + " " + ip + " -j "+action)
-            elif protocol != 'icmp':
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -p " + protocol + " -m " + protocol + " --dport " + range + " -m state --state NEW " + direction + " " + ip + " -j "+ action)
+        if protocol == 'all':
+            match = "-m state --state NEW"
+        elif protocol != 'icmp':
+            match = "-p " + protocol + " -m " + protocol + " --dport " + start + ":" + end + " -m state --state NEW"
+        else:
+            range = start + "/" + end
+            if start == "-1":
+                range = "any"
+            match = "-p icmp --icmp-type " + range
+
+        if ips and use_ipsets:
+            setname = rule_ipset_name(vm_name, ruletype, protocol, start, end)
+            if setname in ipsets:
+                # a second rule with the same match only adds cidrs to the set
+                ipsets[setname] += ips
             else:
-                range = start + "/" + end
-                if start == "-1":
-                    range = "any"
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -p icmp --icmp-type " + range + " " + direction + " " + ip + " -j "+ action)
+                ipsets[setname] = ips
+                flag = "dst" if ruletype == 'E' else "src"
+                commands.append("-I " + vmchain + " " + match + " -m set --match-set " + setname + " " + flag + " -j " + action)
+        else:
+            for ip in ips:
+                commands.append("-I " + vmchain + " " + match + " " + direction + " " + ip + " -j " + action)
 
         if allow_any:
             if protocol == 'all':
-                execute("iptables -I " + vmchain + " -m state --state NEW " + direction + " 0.0.0.0/0 -j "+action)
-            elif protocol != 'icmp':
-                execute("iptables -I " + vmchain + " -p " + protocol + " -m " + protocol + " --dport " + range + " -m state --state NEW -j "+ action)
+                commands.append("-I " + vmchain + " " + match + " " + direction + " 0.0.0.0/0 -j " + action)
             else:
-                range = start + "/" + end
-                if start == "-1":
-                    range = "any"
-                execute("iptables -I " + vmchain + " -p icmp --icmp-type " + range + " -j "+action)
+                commands.append("-I " + vmchain + " " + match + " -j " + action)
+
+    return commands, ipsets, egressrule
+
+def load_rule_ipsets(ipsets):
+    """ Fill the sets through a temporary set swapped in place, so rules
+    matching on them never see a half filled set """
+    data = []
+    for name, ips in ipsets.items():
+        tmp = name + "t"
+        data += ["create " + name + " hash:net -exist",
+                 "create " + tmp + " hash:net -exist",
+                 "flush " + tmp]
+        data += ["add " + tmp + " " + ip + " -exist" for ip in ips]
+        data += ["swap " + tmp + " " + name, "destroy " + tmp]
+    if data:
+        restore("ipset restore", "\n".join(data) + "\n")
+
+def destroy_rule_ipsets(vm_name, keep):
+    """ Destroy the rule sets of a vm that are not in keep """
+    prefix = rule_ipset_prefix(vm_name) + "-"
+    pattern = re.compile("^" + re.escape(prefix) + "[EI][0-9a-f]+t?$")
+    stale = [name for name in execute("ipset list -n").split("\n") if pattern.match(name) and name not in keep]
+    if stale:
+        restore("ipset restore", "\n".join(["destroy " + name for name in stale]) + "\n")
+
+def apply_network_rules(vm_name, lines):
+    """ Replace the rules of a vm in one iptables-restore transaction
+
+    The chains are flushed by the same transaction, if they are missing
+    the restore fails and the caller falls back to the per rule path.
+    """
+    commands, ipsets, egressrule = render_network_rules(vm_name, lines, True)
+    load_rule_ipsets(ipsets)
 
+    vmchain = vm_name
     egress_vmchain = egress_chain_name(vm_name)
-    if egressrule == 0 :
-        iptables = "iptables -A " + egress_vmchain + " -j RETURN"
-        execute(iptables)
+    data = ["*filter", "-F " + vmchain, "-F " + egress_vmchain] + commands
+    if egressrule == 0:
+        data.append("-A " + egress_vmchain + " -j RETURN")
     else:
-        iptables = "iptables -A " + egress_vmchain + " -j DROP"
-        execute(iptables)
+        data.append("-A " + egress_vmchain + " -j DROP")
+    data += ["-A " + vmchain + " -j DROP", "COMMIT"]
+    restore("iptables-restore --noflush", "\n".join(data) + "\n")
 
-    vmchain = vm_name
-    iptables = "iptables -A " + vmchain + " -j DROP"
-    execute(iptables)
+    try:
+        destroy_rule_ipsets(vm_name, ipsets)
+    except:
+        logging.debug("Ignoring failure to delete unused rule ipsets of " + vm_name)
+
+def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif, brname, sec_ips):
+  try:
+    vmName = vm_name
+    domId = getvmId(vmName)
+
+    changes = []
+    changes = check_rule_log_for_vm(vmName, vm_id, vm_ip, domId, signature, seqno)
+
+    if not 1 in changes:
+        logging.debug("Rules already programmed for vm " + vm_name)
+        return 'true'
+
+    if changes[0] or changes[1] or changes[2] or changes[3]:
+        default_network_rules(vmName, vm_id, vm_ip, vmMac, vif, brname, sec_ips)
+
+    if rules == "" or rules == None:
+        lines = []
+    else:
+        lines = rules.split(';')[:-1]
+
+    logging.debug("    programming network rules for IP: " + vm_ip + " vmname=" + vm_name)
+    programmed = False
+    if batch_rules:
+        try:
+            apply_network_rules(vm_name, lines)
+            programmed = True
+        except:
+            logging.exception("Failed to restore network rules for vm " + vm_name + ", programming them one by one")
+
+    if not programmed:
+        try:
+          vmchain = vm_name
+          execute("iptables -F " + vmchain)
+          egress_vmchain = egress_chain_name(vm_name)
+          execute("iptables -F " + egress_vmchain)
+        except:
+          logging.debug("Error flushing iptables rules for " + vmchain + ". Presuming firewall rules deleted, re-initializing." )
+          default_network_rules(vm_name, vm_id, vm_ip, vmMac, vif, brname, sec_ips)
+
+        commands, ipsets, egressrule = render_network_rules(vm_name, lines, False)
+        for command in commands:
+            execute("iptables " + command)
+
+        egress_vmchain = egress_chain_name(vm_name)
+        if egressrule == 0 :
+            iptables = "iptables -A " + egress_vmchain + " -j RETURN"
+            execute(iptables)
+        else:
+            iptables = "iptables -A " + egress_vmchain + " -j DROP"
+            execute(iptables)
+
+        vmchain = vm_name
+        iptables = "iptables -A " + vmchain + " -j DROP"
+        execute(iptables)
 
     if write_rule_log_for_vm(vmName, vm_id, vm_ip, domId, signature, seqno) == False:
         return 'false'
@@ -19,6 +19,8 @@
 import sys
 import os
 import base64
+import hashlib
+import json
 
 from merge import DataBag
 from pprint import pprint
@@ -33,14 +35,16 @@ from fcntl import flock, LOCK_EX, LOCK_UN
 
 from cs.CsDatabag import CsDataBag, CsCmdLine
 import cs.CsHelper
+import cs.CsKernel
 from cs.CsNetfilter import CsNetfilters
 from cs.CsDhcp import CsDhcp
 from cs.CsRedundant import *
 from cs.CsFile import CsFile
-from cs.CsApp import CsApache, CsDnsmasq
+from cs.CsApp import CsApache, CsDnsmasq, CsPasswdSvc
 from cs.CsMonitor import CsMonitor
 from cs.CsLoadBalancer import CsLoadBalancer
 from cs.CsConfig import CsConfig
+from cs.CsConverge import CsConverge
 from cs.CsProcess import CsProcess
 from cs.CsStaticRoutes import CsStaticRoutes
 
@@ -63,16 +67,13 @@ class CsPassword(CsDataBag):
         except IOError:
             logging.debug("File %s does not exist" % self.TOKEN_FILE)
 
-        ips_cmd = "ip addr show | grep inet | awk '{print $2}'"
-        ips = CsHelper.execute(ips_cmd)
-        for ip in ips:
-            server_ip = ip.split('/')[0]
-            proc = CsProcess(['/opt/cloud/bin/passwd_server_ip.py', server_ip])
-            if proc.find():
-                update_command = 'curl --header "DomU_Request: save_password" "http://{SERVER_IP}:8080/" -F "ip={VM_IP}" -F "password={PASSWORD}" ' \
-                '-F "token={TOKEN}" >/dev/null 2>/dev/null &'.format(SERVER_IP=server_ip, VM_IP=vm_ip, PASSWORD=password, TOKEN=token)
-                result = CsHelper.execute(update_command)
-                logging.debug("Update password server result ==> %s" % result)
+        # one server listens on all the addresses and keeps one set of passwords
+        server_ips = CsPasswdSvc.addresses()
+        if server_ips and CsPasswdSvc.pid():
+            update_command = 'curl --header "DomU_Request: save_password" "http://{SERVER_IP}:8080/" -F "ip={VM_IP}" -F "password={PASSWORD}" ' \
+            '-F "token={TOKEN}" >/dev/null 2>/dev/null &'.format(SERVER_IP=server_ips[0], VM_IP=vm_ip, PASSWORD=password, TOKEN=token)
+            result = CsHelper.execute(update_command)
+            logging.debug("Update password server result ==> %s" % result)
 
 
 class CsAcl(CsDataBag):
@@ -281,11 +282,25 @@ class CsAcl(CsDataBag):
 
 class CsVmMetadata(CsDataBag):
 
+    WWW = "/var/www/html"
+    HTACCESS = WWW + "/latest/.htaccess"
+
     def process(self):
+        # Digest of the metadata each vm was last published with
+        digests = DataBag()
+        digests.setKey("vmdatadigest")
+        digests.load()
+        published = digests.getDataBag()
+        self.rewrites = []
+
         for ip in self.dbag:
             if ("id" == ip):
                 continue
+            digest = hashlib.md5(json.dumps(self.dbag[ip], sort_keys=True)).hexdigest()
+            if published.get(ip) == digest and self.__is_published(ip):
+                continue
             logging.info("Processing metadata for %s" % ip)
+            folders = set()
             for item in self.dbag[ip]:
                 folder = item[0]
                 file = item[1]
@@ -298,22 +313,35 @@ class CsVmMetadata(CsDataBag):
                 if file == "":
                     continue
 
-                self.__htaccess(ip, folder, file)
+                self.__rewrite(folder, file)
+                if folder not in folders:
+                    self.__htaccess(ip, folder)
+                    folders.add(folder)
 
                 if data == "":
                     self.__deletefile(ip, folder, file)
                 else:
                     self.__createfile(ip, folder, file, data)
+            published[ip] = digest
+
+        self.__write_rewrites()
+        for ip in published.keys():
+            if ip != "id" and ip not in self.dbag:
+                del published[ip]
+        digests.save(published)
+
+    def __is_published(self, ip):
+        return any(os.path.isfile("%s/%s/%s/.htaccess" % (self.WWW, folder, ip)) for folder in ["metadata", "userdata"])
 
     def __deletefile(self, ip, folder, file):
-        datafile = "/var/www/html/" + folder + "/" + ip + "/" + file
+        datafile = self.WWW + "/" + folder + "/" + ip + "/" + file
 
         if os.path.exists(datafile):
             os.remove(datafile)
 
     def __createfile(self, ip, folder, file, data):
-        dest = "/var/www/html/" + folder + "/" + ip + "/" + file
-        metamanifestdir = "/var/www/html/" + folder + "/" + ip
+        dest = self.WWW + "/" + folder + "/" + ip + "/" + file
+        metamanifestdir = self.WWW + "/" + folder + "/" + ip
         metamanifest = metamanifestdir + "/meta-data"
 
         # base64 decode userdata
@@ -359,30 +387,29 @@ class CsVmMetadata(CsDataBag):
         if os.path.exists(metamanifest):
             os.chmod(metamanifest, 0644)
 
-    def __htaccess(self, ip, folder, file):
-        entry = "RewriteRule ^" + file + "$  ../" + folder + "/%{REMOTE_ADDR}/" + file + " [L,NC,QSA]"
-        htaccessFolder = "/var/www/html/latest"
-        htaccessFile = htaccessFolder + "/.htaccess"
-
-        CsHelper.mkdir(htaccessFolder, 0755, True)
-
-        if os.path.exists(htaccessFile):
-            fh = open(htaccessFile, "r+a")
-            self.__exflock(fh)
-            if entry not in fh.read():
-                fh.write(entry + '\n')
-            self.__unflock(fh)
-            fh.close()
-        else:
-            fh = open(htaccessFile, "w")
-            self.__exflock(fh)
-            fh.write("Options +FollowSymLinks\nRewriteEngine On\n\n")
-            fh.write(entry + '\n')
-            self.__unflock(fh)
-            fh.close()
+    def __rewrite(self, folder, file):
+        """ The rewrite rules only depend on the file name, not on the vm """
+        self.rewrites.append("RewriteRule ^" + file + "$  ../" + folder + "/%{REMOTE_ADDR}/" + file + " [L,NC,QSA]")
+        if folder == "metadata" or folder == "meta-data":
+            self.rewrites.append("RewriteRule ^meta-data/(.+)$  ../" + folder + "/%{REMOTE_ADDR}/$1 [L,NC,QSA]")
+            self.rewrites.append("RewriteRule ^meta-data/$  ../" + folder + "/%{REMOTE_ADDR}/meta-data [L,NC,QSA]")
 
+    def __write_rewrites(self):
+        """ Add the missing rewrite rules in one go """
+        if not self.rewrites:
+            return
+        CsHelper.mkdir(os.path.dirname(self.HTACCESS), 0755, True)
+        htaccess = CsFile(self.HTACCESS)
+        if not htaccess.new_config:
+            htaccess.append("Options +FollowSymLinks")
+            htaccess.append("RewriteEngine On")
+            htaccess.append("")
+        htaccess.add_all(self.rewrites)
+        htaccess.commit()
+
+    def __htaccess(self, ip, folder):
         entry = "Options -Indexes\nOrder Deny,Allow\nDeny from all\nAllow from " + ip
-        htaccessFolder = "/var/www/html/" + folder + "/" + ip
+        htaccessFolder = self.WWW + "/" + folder + "/" + ip
         htaccessFile = htaccessFolder+"/.htaccess"
 
         try:
@@ -399,24 +426,6 @@ class CsVmMetadata(CsDataBag):
         self.__unflock(fh)
         fh.close()
 
-        if folder == "metadata" or folder == "meta-data":
-            entry = "RewriteRule ^meta-data/(.+)$  ../" + folder + "/%{REMOTE_ADDR}/$1 [L,NC,QSA]"
-            htaccessFolder = "/var/www/html/latest"
-            htaccessFile = htaccessFolder + "/.htaccess"
-
-            fh = open(htaccessFile, "r+a")
-            self.__exflock(fh)
-            if entry not in fh.read():
-                fh.write(entry + '\n')
-
-            entry = "RewriteRule ^meta-data/$  ../" + folder + "/%{REMOTE_ADDR}/meta-data [L,NC,QSA]"
-
-            fh.seek(0)
-            if entry not in fh.read():
-                fh.write(entry + '\n')
-            self.__unflock(fh)
-            fh.close()
-
     def __exflock(self, file):
         try:
             flock(file, LOCK_EX)
@@ -901,16 +910,23 @@ class CsForwardingRules(CsDataBag):
 
 
 def main(argv):
-    # The file we are currently processing, if it is "cmd_line.json" everything will be processed.
-    process_file = argv[1]
+    # The files we are currently processing, if one is "cmd_line.json" everything will be processed.
+    # The converge daemon passes every file it coalesced into this run.
+    process_files = [f for f in argv[1:] if f is not None]
 
-    # process_file can be None, if so assume cmd_line.json
-    if process_file is None:
-        process_file = "cmd_line.json"
+    # process_files can be empty, if so assume cmd_line.json
+    if not process_files:
+        process_files = ["cmd_line.json"]
+
+    def processing(files):
+        return any(f in process_files for f in files)
 
     # Track if changes need to be committed to NetFilter
     iptables_change = False
 
+    # The kernel state seen by the previous run may be stale by now
+    cs.CsKernel.state.invalidate()
+
     # The "GLOBAL" Configuration object
     config = CsConfig()
 
@@ -921,83 +937,106 @@ def main(argv):
         # Load stored ip adresses from disk to CsConfig()
         config.set_address()
 
+        # Tracks which databags changed since they were last applied
+        converge = CsConverge(config)
+
         logging.debug("Configuring ip addresses")
         config.address().compare()
         config.address().process()
 
-        if process_file in ["cmd_line.json", "guest_network.json"]:
+        if processing(["cmd_line.json", "guest_network.json"]):
             logging.debug("Configuring Guest Network")
             iptables_change = True
 
-        if process_file in ["cmd_line.json", "vm_password.json"]:
+        if processing(["cmd_line.json", "vm_password.json"]):
             logging.debug("Configuring vmpassword")
             password = CsPassword("vmpassword", config)
             password.process()
 
-        if process_file in ["cmd_line.json", "vm_metadata.json"]:
+        if processing(["cmd_line.json", "vm_metadata.json"]):
             logging.debug("Configuring vmdata")
-            metadata = CsVmMetadata('vmdata', config)
-            metadata.process()
+            if converge.begin("vmdata"):
+                metadata = CsVmMetadata('vmdata', config)
+                metadata.process()
+                converge.end("vmdata")
 
-        if process_file in ["cmd_line.json", "network_acl.json"]:
+        if processing(["cmd_line.json", "network_acl.json"]):
             logging.debug("Configuring networkacl")
             iptables_change = True
 
-        if process_file in ["cmd_line.json", "firewall_rules.json"]:
+        if processing(["cmd_line.json", "firewall_rules.json"]):
             logging.debug("Configuring firewall rules")
             iptables_change = True
 
-        if process_file in ["cmd_line.json", "forwarding_rules.json", "staticnat_rules.json"]:
+        if processing(["cmd_line.json", "forwarding_rules.json", "staticnat_rules.json"]):
             logging.debug("Configuring PF rules")
             iptables_change = True
 
-        if process_file in ["cmd_line.json", "site_2_site_vpn.json"]:
+        if processing(["cmd_line.json", "site_2_site_vpn.json"]):
             logging.debug("Configuring s2s vpn")
             iptables_change = True
 
-        if process_file in ["cmd_line.json", "remote_access_vpn.json"]:
+        if processing(["cmd_line.json", "remote_access_vpn.json"]):
             logging.debug("Configuring remote access vpn")
             iptables_change = True
 
-        if process_file in ["cmd_line.json", "vpn_user_list.json"]:
+        if processing(["cmd_line.json", "vpn_user_list.json"]):
             logging.debug("Configuring vpn users list")
-            vpnuser = CsVpnUser("vpnuserlist", config)
-            vpnuser.process()
+            if converge.begin("vpnuserlist"):
+                vpnuser = CsVpnUser("vpnuserlist", config)
+                vpnuser.process()
+                converge.end("vpnuserlist")
 
-        if process_file in ["cmd_line.json", "vm_dhcp_entry.json", "dhcp.json"]:
+        if processing(["cmd_line.json", "vm_dhcp_entry.json", "dhcp.json"]):
             logging.debug("Configuring dhcp entry")
-            dhcp = CsDhcp("dhcpentry", config)
-            dhcp.process()
+            if converge.begin("dhcpentry"):
+                dhcp = CsDhcp("dhcpentry", config)
+                dhcp.process()
+                converge.end("dhcpentry")
 
-        if process_file in ["cmd_line.json", "load_balancer.json"]:
+        if processing(["cmd_line.json", "load_balancer.json"]):
             logging.debug("Configuring load balancer")
             iptables_change = True
 
-        if process_file in ["cmd_line.json", "monitor_service.json"]:
+        if processing(["cmd_line.json", "monitor_service.json"]):
             logging.debug("Configuring monitor service")
-            mon = CsMonitor("monitorservice", config)
-            mon.process()
+            if converge.begin("monitorservice"):
+                mon = CsMonitor("monitorservice", config)
+                mon.process()
+                converge.end("monitorservice")
 
         # If iptable rules have changed, apply them.
         if iptables_change:
-            acls = CsAcl('networkacl', config)
-            acls.process()
-
-            acls = CsAcl('firewallrules', config)
-            acls.flushAllowAllEgressRules()
-            acls.process()
-
-            fwd = CsForwardingRules("forwardingrules", config)
-            fwd.process()
-
-            vpns = CsSite2SiteVpn("site2sitevpn", config)
-            vpns.process()
-
-            rvpn = CsRemoteAccessVpn("remoteaccessvpn", config)
-            rvpn.process()
-
-            lb = CsLoadBalancer("loadbalancer", config)
-            lb.process()
+            if converge.begin("networkacl"):
+                acls = CsAcl('networkacl', config)
+                acls.process()
+                converge.end("networkacl")
+
+            if converge.begin("firewallrules"):
+                acls = CsAcl('firewallrules', config)
+                acls.flushAllowAllEgressRules()
+                acls.process()
+                converge.end("firewallrules")
+
+            if converge.begin("forwardingrules"):
+                fwd = CsForwardingRules("forwardingrules", config)
+                fwd.process()
+                converge.end("forwardingrules")
+
+            if converge.begin("site2sitevpn"):
+                vpns = CsSite2SiteVpn("site2sitevpn", config)
+                vpns.process()
+                converge.end("site2sitevpn")
+
+            if converge.begin("remoteaccessvpn"):
+                rvpn = CsRemoteAccessVpn("remoteaccessvpn", config)
+                rvpn.process()
+                converge.end("remoteaccessvpn")
+
+            if converge.begin("loadbalancer"):
+                lb = CsLoadBalancer("loadbalancer", config)
+                lb.process()
+                converge.end("loadbalancer")
 
             logging.debug("Configuring iptables rules")
             nf = CsNetfilters()
@@ -1012,10 +1051,12 @@ def main(argv):
         red = CsRedundant(config)
         red.set()
 
-        if process_file in ["cmd_line.json", "static_routes.json"]:
+        if processing(["cmd_line.json", "static_routes.json"]):
             logging.debug("Configuring static routes")
             static_routes = CsStaticRoutes("staticroutes", config)
             static_routes.process()
+
+        converge.commit()
     except Exception:
         logging.exception("Exception while configuring router")
 
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+""" Converge daemon
+
+Keeps configure and the cs modules loaded and converges the router
+once for every burst of files queued through update_config.py, instead
+of starting a new process per file. update_config.py connects to the
+unix socket, sends the name of the file and waits for the exit code,
+so callers see the same results as before.
+"""
+
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from Queue import Queue, Empty
+
+import update_config
+from cs.CsConfig import CsConfig
+
+# Wait this long after a file arrives for more files to converge together
+COALESCE = 0.2
+
+
+class Request(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.returncode = None
+        self.event = threading.Event()
+
+    def done(self, returncode):
+        self.returncode = returncode
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        return self.returncode
+
+
+class ConvergeDaemon(object):
+
+    def __init__(self, path=update_config.convergedSocket):
+        self.path = path
+        self.queue = Queue()
+
+    def next_burst(self):
+        """ Block for a request, then collect everything queued shortly after """
+        burst = [self.queue.get()]
+        deadline = time.time() + COALESCE
+        while True:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    burst.append(self.queue.get(True, timeout))
+                else:
+                    burst.append(self.queue.get_nowait())
+            except Empty:
+                return burst
+
+    def converge(self, burst):
+        """ Merge every file of the burst, in order, then converge once """
+        started = time.time()
+        merged = []
+        for request in burst:
+            if not update_config.is_accessible(request.name):
+                request.done(1)
+                continue
+            try:
+                update_config.merge_file(request.name)
+            except Exception:
+                logging.exception("Converge daemon: could not merge %s", request.name)
+                request.done(1)
+                continue
+            merged.append(request)
+
+        if merged:
+            # The cmdline databag is cached on the class, it may have changed
+            CsConfig.cl = None
+            files = [request.name for request in merged]
+            try:
+                returncode = update_config.finish_config(files) or 0
+            except Exception:
+                logging.exception("Converge daemon: converging %s failed", files)
+                returncode = 1
+            for request in merged:
+                request.done(returncode)
+        logging.info("Converge daemon: converged %s files in %.3fs", len(burst), time.time() - started)
+
+    def work(self):
+        while True:
+            self.converge(self.next_burst())
+
+    def handle(self, conn):
+        try:
+            name = conn.makefile().readline().strip()
+            if name:
+                request = Request(name)
+                self.queue.put(request)
+                conn.sendall("%s\n" % request.wait())
+        except socket.error:
+            logging.exception("Converge daemon: lost client")
+        finally:
+            conn.close()
+
+    def serve(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0600)
+        server.listen(64)
+
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+
+        logging.info("Converge daemon: listening on %s", self.path)
+        while True:
+            conn = server.accept()[0]
+            handler = threading.Thread(target=self.handle, args=(conn,))
+            handler.daemon = True
+            handler.start()
+
+
+def main(argv):
+    ConvergeDaemon().serve()
+
+if __name__ == "__main__":
+    main(sys.argv)
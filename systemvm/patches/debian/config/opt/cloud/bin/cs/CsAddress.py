@@ -17,10 +17,11 @@
 # under the License.
 import logging
 from netaddr import IPAddress, IPNetwork
-import subprocess
 import time
 import CsHelper
+import CsKernel
 from CsDatabag import CsDataBag
+from CsIpBatch import CsIpBatch
 from CsApp import CsApache, CsDnsmasq, CsPasswdSvc
 from CsRoute import CsRoute
 from CsRule import CsRule
@@ -97,6 +98,12 @@ class CsAddress(CsDataBag):
         return None
 
     def process(self):
+        # The addresses of all devices are added and removed together,
+        # then configured further one by one with the routes and rules
+        # of all of them queued in a second batch
+        batch = CsIpBatch()
+        routes = CsIpBatch()
+        changed = []
         for dev in self.dbag:
             if dev == "id":
                 continue
@@ -110,13 +117,22 @@ class CsAddress(CsDataBag):
                     logging.info(
                         "Address %s on device %s already configured", ip.ip(), dev)
 
-                    ip.post_configure(address)
+                    ip.post_configure(address, routes)
                 else:
                     logging.info(
                         "Address %s on device %s not configured", ip.ip(), dev)
                     
                     if CsDevice(dev, self.config).waitfordevice():
-                        ip.configure(address)
+                        ip.configure(address, batch)
+                        changed.append((ip, address))
+
+        batch.commit()
+        for ip, address in changed:
+            ip.setAddress(address)
+            if not address["add"]:
+                ip.post_config_change("delete", routes)
+            ip.post_configure(address, routes)
+        routes.commit()
 
 
 class CsInterface:
@@ -267,27 +283,35 @@ class CsIP:
     def getAddress(self):
         return self.address
 
-    def configure(self, address):
+    def configure(self, address, batch=None):
+        """ Add or remove the address
+        With a batch the change is only queued, the caller commits the batch
+        and calls post_config_change for a removal and post_configure """
+        commit = batch is None
+        batch = batch or CsIpBatch()
         # When "add" is false, it means that the IP has to be removed.
         if address["add"]:
-            try:
-                logging.info("Configuring address %s on device %s", self.ip(), self.dev)
-                cmd = "ip addr add dev %s %s brd +" % (self.dev, self.ip())
-                CsHelper.execute(cmd)
-            except Exception as e:
-                logging.info("Exception occurred ==> %s" % e)
-
+            logging.info("Configuring address %s on device %s", self.ip(), self.dev)
+            batch.add_address(self.dev, self.ip())
         else:
-            self.delete(self.ip())
-        self.post_configure(address)
-
-    def post_configure(self, address):
-        """ The steps that must be done after a device is configured """
-        route = CsRoute()
+            self.delete(self.ip(), batch)
+        if commit:
+            batch.commit()
+            if not address["add"]:
+                self.post_config_change("delete")
+            self.post_configure(address)
+
+    def post_configure(self, address, batch=None):
+        """ The steps that must be done after a device is configured
+        With a batch the route and rule changes are only queued, the caller
+        commits the batch """
+        commit = batch is None
+        batch = batch or CsIpBatch()
+        route = CsRoute(batch)
         if not self.get_type() in ["control"]:
             route.add_table(self.dev)
 
-            CsRule(self.dev).addMark()
+            CsRule(self.dev).addMark(batch)
 
             interfaces = [CsInterface(address, self.config)]
             CsHelper.reconfigure_interfaces(self.cl, interfaces)
@@ -297,7 +321,7 @@ class CsIP:
                 self.arpPing()
 
             CsRpsrfs(self.dev).enable()
-            self.post_config_change("add")
+            self.post_config_change("add", batch)
 
         '''For isolated/redundant and dhcpsrvr routers, call this method after the post_config is complete '''
         if not self.config.is_vpc():
@@ -315,6 +339,8 @@ class CsIP:
             # is a default route and add if needed
             if(self.cl.get_gateway()):
                 route.add_defaultroute(self.cl.get_gateway())
+        if commit:
+            batch.commit()
 
     def set_mark(self):
         cmd = "-A PREROUTING -i %s -m state --state NEW -j CONNMARK --set-xmark %s/0xffffffff" % \
@@ -512,8 +538,8 @@ class CsIP:
         self.fw.append(["filter", "", "-P INPUT DROP"])
         self.fw.append(["filter", "", "-P FORWARD DROP"])
 
-    def post_config_change(self, method):
-        route = CsRoute()
+    def post_config_change(self, method, batch=None):
+        route = CsRoute(batch)
         if method == "add":
             route.add_table(self.dev)
             route.add_route(self.dev, str(self.address["network"]))
@@ -553,19 +579,14 @@ class CsIP:
 
     def list(self):
         self.iplist = {}
-        cmd = ("ip addr show dev " + self.dev)
-        for i in CsHelper.execute(cmd):
-            vals = i.lstrip().split()
-            if (vals[0] == 'inet'):
-                
-                cidr = vals[1]
-                for ip, device in self.iplist.iteritems():
-                    logging.info(
-                                 "Iterating over the existing IPs. CIDR to be configured ==> %s, existing IP ==> %s on device ==> %s",
-                                 cidr, ip, device)
+        for cidr, label in CsKernel.state.addresses(self.dev):
+            for ip, device in self.iplist.iteritems():
+                logging.info(
+                             "Iterating over the existing IPs. CIDR to be configured ==> %s, existing IP ==> %s on device ==> %s",
+                             cidr, ip, device)
 
-                    if cidr[0] != ip[0] and device != self.dev:
-                        self.iplist[cidr] = self.dev
+                if cidr[0] != ip[0] and device != self.dev:
+                    self.iplist[cidr] = self.dev
 
     def configured(self):
         if self.address['cidr'] in self.iplist.keys():
@@ -643,7 +664,12 @@ class CsIP:
             return True
         return False
 
-    def delete(self, ip):
+    def delete(self, ip, batch=None):
+        """ Remove the address, or all of them
+        With a batch the removal is only queued, the caller commits the batch
+        and calls post_config_change """
+        commit = batch is None
+        batch = batch or CsIpBatch()
         remove = []
         if ip == "all":
             logging.info("Removing addresses from device %s", self.dev)
@@ -651,10 +677,12 @@ class CsIP:
         else:
             remove.append(ip)
         for ip in remove:
-            cmd = "ip addr del dev %s %s" % (self.dev, ip)
-            subprocess.call(cmd, shell=True)
-            logging.info("Removed address %s from device %s", ip, self.dev)
-            self.post_config_change("delete")
+            batch.del_address(self.dev, ip)
+            logging.info("Removing address %s from device %s", ip, self.dev)
+        if commit:
+            batch.commit()
+            for ip in remove:
+                self.post_config_change("delete")
 
 
 class CsRpsrfs:
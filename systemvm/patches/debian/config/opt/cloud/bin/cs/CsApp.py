@@ -15,7 +15,10 @@
 # KIND, either express or implied.  See the License for the
 # specific language governing permissions and limitations
 # under the License.
+import fcntl
+import logging
 import os
+import signal
 import CsHelper
 from CsFile import CsFile
 from CsProcess import CsProcess
@@ -68,26 +71,81 @@ class CsApache(CsApp):
 
 class CsPasswdSvc():
     """
-      nohup bash /opt/cloud/bin/vpc_passwd_server $ip >/dev/null 2>&1 &
+      One password server listens on every address in ADDRESSES and
+      reads the file again on SIGHUP, see passwd_server_ip.py
     """
 
+    ADDRESSES = "/var/cache/cloud/passwd_server_addresses"
+    PIDFILE = "/var/run/passwd_server.pid"
+
     def __init__(self, ip):
         self.ip = ip
 
+    @classmethod
+    def addresses(cls):
+        if not os.path.isfile(cls.ADDRESSES):
+            return []
+        return [line.strip() for line in open(cls.ADDRESSES) if line.strip()]
+
+    @classmethod
+    def pid(cls):
+        """ The pid of the running server, None if it is not running.
+        The server holds a lock on PIDFILE, a pid file nobody locks or a
+        pid that is not the server's is not signalled """
+        try:
+            with open(cls.PIDFILE) as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    return None
+                except IOError:
+                    pass
+                pid = int(f.read().strip())
+            with open("/proc/%d/cmdline" % pid) as f:
+                if "passwd_server_ip" not in f.read():
+                    return None
+            return pid
+        except (IOError, ValueError):
+            return None
+
+    def set_address(self, listen):
+        """ Add or remove the address, returns True if the file changed """
+        addresses = self.addresses()
+        if (self.ip in addresses) == listen:
+            return False
+        if listen:
+            addresses.append(self.ip)
+        else:
+            addresses.remove(self.ip)
+        tmp = self.ADDRESSES + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("".join("%s\n" % address for address in addresses))
+        os.rename(tmp, self.ADDRESSES)
+        return True
+
+    def reload(self):
+        pid = self.pid()
+        if pid:
+            logging.info("Telling password server %s to reload its addresses" % pid)
+            os.kill(pid, signal.SIGHUP)
+        return pid
+
     def start(self):
+        changed = self.set_address(True)
+        if changed and self.reload():
+            return
         proc = CsProcess(["dummy"])
-        if proc.grep("passwd_server_ip %s" % self.ip) == -1:
+        if proc.grep("passwd_server_ip") == -1:
             proc.start("/opt/cloud/bin/passwd_server_ip %s >> /var/log/cloud.log 2>&1" % self.ip, "&")
 
     def stop(self):
+        if self.set_address(False):
+            self.reload()
         proc = CsProcess(["Password Service"])
-        pid = proc.grep("passwd_server_ip %s" % self.ip)
-        proc.kill(pid)
         pid = proc.grep("8080,reuseaddr,fork,crnl,bind=%s" % self.ip)
         proc.kill(pid)
 
     def restart(self):
-        self.stop()
+        """ The server takes the address without restarting """
         self.start()
 
 
@@ -0,0 +1,120 @@
+# -- coding: utf-8 --
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import hashlib
+import json
+import logging
+import time
+from merge import DataBag
+
+
+class CsConverge(object):
+    """ Remember which databag content was last applied
+
+    Every section is keyed by its databag. Its generation is a hash of
+    the databag and of the databags it depends on. A section whose
+    generation did not change since it was last applied is skipped and
+    the iptables rules it produced last time are replayed, so the
+    netfilter compare still sees the complete rule set.
+    """
+
+    KEY = "convergestate"
+    BOOT_ID = "/proc/sys/kernel/random/boot_id"
+
+    DEPENDS = {
+        "networkacl": ["cmdline", "ips", "guestnetwork"],
+        "firewallrules": ["cmdline", "ips", "guestnetwork"],
+        "forwardingrules": ["cmdline", "ips", "guestnetwork"],
+        "site2sitevpn": ["cmdline", "ips"],
+        "remoteaccessvpn": ["cmdline", "ips", "guestnetwork"],
+        "loadbalancer": ["cmdline", "ips"],
+        "vpnuserlist": ["cmdline", "remoteaccessvpn"],
+        "dhcpentry": ["cmdline", "ips", "guestnetwork"],
+        "vmdata": ["cmdline"],
+        "monitorservice": ["cmdline"]
+    }
+
+    def __init__(self, config):
+        self.fw = config.get_fw()
+        self.digests = {}
+        self.pending = {}
+        self.started = {}
+        self.applied = []
+        self.skipped = []
+        self.db = DataBag()
+        self.db.setKey(self.KEY)
+        self.db.load()
+        self.state = self.db.getDataBag()
+        if self.state.get("boot_id") != self.get_boot_id():
+            # Nothing that was applied before a reboot can be trusted
+            logging.info("Converge: no state for this boot, applying everything")
+            self.state = {"id": self.KEY, "boot_id": self.get_boot_id(), "bags": {}}
+
+    def get_boot_id(self):
+        try:
+            return open(self.BOOT_ID).read().strip()
+        except IOError:
+            return ""
+
+    def digest(self, key):
+        """ Hash of the content of a databag """
+        if key not in self.digests:
+            db = DataBag()
+            db.setKey(key)
+            db.load()
+            self.digests[key] = hashlib.md5(json.dumps(db.getDataBag(), sort_keys=True)).hexdigest()
+        return self.digests[key]
+
+    def generation(self, key):
+        """ Hash of a databag together with everything it depends on """
+        md5 = hashlib.md5()
+        md5.update(self.digest(key))
+        for dep in self.DEPENDS.get(key, []):
+            md5.update(self.generation(dep))
+        return md5.hexdigest()
+
+    def changed(self, key):
+        bag = self.state["bags"].get(key)
+        return bag is None or bag["generation"] != self.generation(key)
+
+    def begin(self, key):
+        """ Returns True if the section for key has to be processed
+        Otherwise the rules it added last time are added again """
+        if not self.changed(key):
+            self.fw.extend(self.state["bags"][key]["fw"])
+            self.skipped.append(key)
+            logging.info("Converge: %s unchanged, skipped", key)
+            return False
+        self.started[key] = (len(self.fw), time.time())
+        return True
+
+    def end(self, key):
+        if key not in self.started:
+            return
+        start, started = self.started.pop(key)
+        self.pending[key] = {"generation": self.generation(key), "fw": self.fw[start:]}
+        self.applied.append(key)
+        logging.info("Converge: %s applied in %.3fs", key, time.time() - started)
+
+    def commit(self):
+        """ Record the sections processed in this run as applied """
+        logging.info("Converge: applied %s, skipped %s", self.applied, self.skipped)
+        if not self.pending:
+            return
+        self.state["bags"].update(self.pending)
+        self.pending = {}
+        self.db.save(self.state)
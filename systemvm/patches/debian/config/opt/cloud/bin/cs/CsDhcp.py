@@ -16,15 +16,18 @@
 # under the License.
 import CsHelper
 import logging
+import os
+import zlib
 from netaddr import *
-from random import randint
 from CsGuestNetwork import CsGuestNetwork
 from cs.CsDatabag import CsDataBag
 from cs.CsFile import CsFile
+from cs_dhcp import INDEX
 
 LEASES = "/var/lib/misc/dnsmasq.leases"
 DHCP_HOSTS = "/etc/dhcphosts.txt"
 CLOUD_CONF = "/etc/dnsmasq.d/cloud.conf"
+DHCP_RELEASE = "/usr/bin/dhcp_release"
 
 
 class CsDhcp(CsDataBag):
@@ -40,23 +43,33 @@ class CsDhcp(CsDataBag):
 
         self.cloud.repopulate()
 
-        for item in self.dbag:
-            if item == "id":
+        # Sorted so the hosts file keeps the same order between runs
+        for item in sorted(self.dbag):
+            if item == "id" or item == INDEX:
                 continue
             self.add(self.dbag[item])
-        self.write_hosts()
+        hosts_changed = self.write_hosts()
 
-        if self.cloud.is_changed():
-            self.delete_leases()
+        changed = self.changed_entries()
+        if changed:
+            self.delete_leases(changed)
 
         self.configure_server()
 
+        restart = self.conf.is_changed()
         self.conf.commit()
+        hosts_changed = self.cloud.is_changed() or hosts_changed
         self.cloud.commit()
 
-        # We restart DNSMASQ every time the configure.py is called in order to avoid lease problems.
-        if not self.cl.is_redundant() or self.cl.is_master():
+        if self.cl.is_redundant() and not self.cl.is_master():
+            return
+        # dnsmasq rereads the hosts files on SIGHUP, its own configuration only on restart
+        if restart:
             CsHelper.service("dnsmasq", "restart")
+        elif hosts_changed:
+            CsHelper.hup_dnsmasq("dnsmasq", "dnsmasq")
+        else:
+            CsHelper.start_if_stopped("dnsmasq")
 
     def configure_server(self):
         # self.conf.addeq("dhcp-hostsfile=%s" % DHCP_HOSTS)
@@ -99,11 +112,59 @@ class CsDhcp(CsDataBag):
             self.conf.search(sline, line)
             idx += 1
 
-    def delete_leases(self):
+    def changed_entries(self):
+        """ Returns mac -> ip of the host entries that were removed or
+        now hand out a different address or name """
+        old = self.parse_hosts(self.cloud.config)
+        new = self.parse_hosts(self.cloud.new_config)
+        changed = {}
+        for mac in old:
+            if new.get(mac) != old[mac]:
+                changed[mac] = old[mac][0]
+        return changed
+
+    def parse_hosts(self, lines):
+        """ mac -> (ip, hostname) ignoring the lease time """
+        hosts = {}
+        for line in lines:
+            vals = line.strip().split(',')
+            if len(vals) < 3:
+                continue
+            hosts[vals[0]] = (vals[1], vals[2])
+        return hosts
+
+    def delete_leases(self, changed):
+        """ Forget the leases of the changed entries only """
+        logging.info("Deleting dhcp leases for %s", ", ".join(sorted(changed)))
         try:
-            open(LEASES, 'w').close()
+            lines = open(LEASES).readlines()
         except IOError:
+            lines = []
+        keep = [x for x in lines if len(x.split()) < 2 or x.split()[1] not in changed]
+        if len(keep) != len(lines):
+            try:
+                handle = open(LEASES, 'w')
+                handle.writelines(keep)
+                handle.close()
+            except IOError:
+                logging.error("Could not update %s", LEASES)
+        # A running dnsmasq keeps its leases in memory
+        if not os.path.isfile(DHCP_RELEASE):
             return
+        for mac, ip in changed.items():
+            device = self.get_device(ip)
+            if device:
+                CsHelper.execute("%s %s %s %s" % (DHCP_RELEASE, device, ip, mac))
+
+    def get_device(self, ip):
+        try:
+            i = IPAddress(ip)
+        except Exception:
+            return None
+        for v in self.devinfo:
+            if i in v['network']:
+                return v['dev']
+        return None
 
     def preseed(self):
         self.add_host("127.0.0.1", "localhost")
@@ -118,20 +179,22 @@ class CsDhcp(CsDataBag):
     def write_hosts(self):
         file = CsFile("/etc/hosts")
         file.repopulate()
-        for ip in self.hosts:
+        for ip in sorted(self.hosts):
             file.add("%s\t%s" % (ip, self.hosts[ip]))
         if file.is_changed():
             file.commit()
             logging.info("Updated hosts file")
-        else:
-            logging.debug("Hosts file unchanged")
+            return True
+        logging.debug("Hosts file unchanged")
+        return False
 
     def add(self, entry):
         self.add_host(entry['ipv4_adress'], entry['host_name'])
 
         # lease time boils down to once a month
         # with a splay of 60 hours to prevent storms
-        lease = randint(700, 760)
+        # the splay is derived from the mac so it is the same on every run
+        lease = 700 + zlib.crc32(entry['mac_address']) % 61
         self.cloud.add("%s,%s,%s,%sh" % (entry['mac_address'],
                                          entry['ipv4_adress'],
                                          entry['host_name'],
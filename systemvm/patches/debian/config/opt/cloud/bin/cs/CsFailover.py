@@ -0,0 +1,147 @@
+# -- coding: utf-8 --
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import json
+import logging
+import os
+import threading
+import time
+import Queue
+
+
+class CsFailoverStep(object):
+
+    def __init__(self, name, action, args, requires, critical):
+        self.name = name
+        self.action = action
+        self.args = args
+        self.requires = set(requires)
+        self.critical = critical
+        self.start = None
+        self.end = None
+        self.error = None
+
+
+class CsFailover(object):
+    """ The steps of a redundant router state transition
+
+    Steps are run as soon as the steps they require are done, each in
+    its own thread, so steps that do not depend on each other overlap.
+    Critical steps, the ones that let the router forward traffic, come
+    before all other steps. A failed step is logged and recorded, the
+    steps that require it still run, as in the sequence it replaces.
+
+    run() appends the timings of every step to STATE_FILE, which keeps
+    the last HISTORY transitions.
+    """
+
+    STATE_FILE = "/ramdisk/rrouter/transitions.json"
+    HISTORY = 20
+
+    def __init__(self, state):
+        self.state = state
+        self.steps = []
+        self.names = set()
+
+    def add(self, name, action, *args, **kwargs):
+        """ Add a step, requires= lists the names of the steps it waits for
+        and critical=True makes it one of the first steps """
+        if name in self.names:
+            raise ValueError("Duplicate failover step %s" % name)
+        self.names.add(name)
+        self.steps.append(CsFailoverStep(name, action, args, kwargs.get("requires", ()),
+                                         kwargs.get("critical", False)))
+        return name
+
+    def check(self):
+        critical = set(s.name for s in self.steps if s.critical)
+        for step in self.steps:
+            unknown = step.requires - self.names
+            if unknown:
+                raise ValueError("Failover step %s requires unknown steps %s" % (step.name, ", ".join(sorted(unknown))))
+            if step.critical and step.requires - critical:
+                raise ValueError("Critical failover step %s requires steps that are not critical" % step.name)
+            if not step.critical:
+                step.requires |= critical
+        done = set()
+        left = list(self.steps)
+        while left:
+            ready = [s for s in left if s.requires <= done]
+            if not ready:
+                raise ValueError("Failover steps %s require each other" % ", ".join(s.name for s in left))
+            done |= set(s.name for s in ready)
+            left = [s for s in left if s.name not in done]
+
+    def execute(self, step, finished):
+        step.start = time.time()
+        try:
+            step.action(*step.args)
+        except Exception, e:
+            logging.exception("Failover step %s failed" % step.name)
+            step.error = str(e) or e.__class__.__name__
+        step.end = time.time()
+        finished.put(step)
+
+    def run(self):
+        """ Run all steps, returns the record written to STATE_FILE """
+        self.check()
+        started = time.time()
+        finished = Queue.Queue()
+        done = set()
+        pending = list(self.steps)
+        running = 0
+        while pending or running:
+            ready = [s for s in pending if s.requires <= done]
+            for step in ready:
+                pending.remove(step)
+                thread = threading.Thread(target=self.execute, args=(step, finished), name=step.name)
+                thread.daemon = True
+                thread.start()
+                running += 1
+            step = finished.get()
+            running -= 1
+            done.add(step.name)
+            logging.debug("Failover step %s took %.3fs", step.name, step.end - step.start)
+
+        critical = [s.end for s in self.steps if s.critical]
+        record = {"state": self.state,
+                  "started": started,
+                  "critical": round(max(critical) - started, 3) if critical else 0.0,
+                  "total": round(time.time() - started, 3),
+                  "steps": dict((s.name, {"start": round(s.start - started, 3),
+                                          "duration": round(s.end - s.start, 3),
+                                          "critical": s.critical,
+                                          "error": s.error}) for s in self.steps)}
+        logging.info("Switched to %s in %.3fs, traffic was forwarded after %.3fs",
+                     self.state, record["total"], record["critical"])
+        self.save(record)
+        return record
+
+    def save(self, record):
+        history = []
+        try:
+            history = json.load(open(self.STATE_FILE))["transitions"]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+        history = (history + [record])[-self.HISTORY:]
+        try:
+            tmp = self.STATE_FILE + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"transitions": history}, f, indent=2, sort_keys=True)
+            os.rename(tmp, self.STATE_FILE)
+        except (IOError, OSError), e:
+            logging.error("Unable to save failover timings to %s: %s" % (self.STATE_FILE, e))
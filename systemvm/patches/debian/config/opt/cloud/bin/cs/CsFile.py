@@ -16,8 +16,24 @@
 # specific language governing permissions and limitations
 # under the License.
 import logging
+import os
 import re
 import copy
+import tempfile
+
+# Compiled search patterns, shared by all files. Searches embed addresses,
+# the cache is emptied once it holds MAX_PATTERNS so the converge daemon
+# does not keep every pattern it ever used
+PATTERNS = {}
+MAX_PATTERNS = 1000
+
+
+def pattern(search):
+    if search not in PATTERNS:
+        if len(PATTERNS) >= MAX_PATTERNS:
+            PATTERNS.clear()
+        PATTERNS[search] = re.compile(search)
+    return PATTERNS[search]
 
 
 class CsFile:
@@ -30,6 +46,8 @@ class CsFile:
     def load(self):
         self.new_config = []
         self.config = []
+        self.content = None
+        self.index = None
         try:
             for line in open(self.filename):
                 self.new_config.append(line)
@@ -38,35 +56,70 @@ class CsFile:
         else:
             logging.debug("Reading file %s" % self.filename)
             self.config = list(self.new_config)
+            self.content = "".join(self.config)
+
+    def get_index(self):
+        """ Count of each (stripped) line in the new configuration
+        Rebuilt only after the configuration was changed wholesale """
+        if self.index is None:
+            self.index = {}
+            for line in self.new_config:
+                key = line.strip()
+                self.index[key] = self.index.get(key, 0) + 1
+        return self.index
+
+    def set_config(self, config):
+        self.new_config = config
+        self.index = None
 
     def is_changed(self):
-        if set(self.config) != set(self.new_config):
-            return True
-        else:
-            return False
+        return self.config != self.new_config
 
     def __len__(self):
         return len(self.config)
 
     def empty(self):
         self.config = []
-        self.new_config = []
+        self.set_config([])
 
     def repopulate(self):
-        self.new_config = []
+        self.set_config([])
 
     def commit(self):
         if not self.is_changed():
             logging.info("Nothing to commit. The %s file did not change" % self.filename)
             return
-        handle = open(self.filename, "w+")
-        for line in self.new_config:
-            handle.write(line)
-        handle.close()
-        logging.info("Wrote edited file %s" % self.filename)
+        content = "".join(self.new_config)
+        if content != self.content:
+            self.write(content)
+            logging.info("Wrote edited file %s" % self.filename)
+        else:
+            logging.info("Content of %s did not change, not writing it" % self.filename)
+        self.content = content
         self.config = list(self.new_config)
         logging.info("Updated file in-cache configuration")
-        
+
+    def write(self, content):
+        """ Replace the file atomically, keeping its mode and owner """
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, temp = tempfile.mkstemp(dir=directory, prefix=".%s." % os.path.basename(self.filename))
+        try:
+            handle = os.fdopen(fd, "w")
+            handle.write(content)
+            handle.flush()
+            os.fsync(handle.fileno())
+            handle.close()
+            try:
+                stat = os.stat(self.filename)
+                os.chmod(temp, stat.st_mode & 07777)
+                os.chown(temp, stat.st_uid, stat.st_gid)
+            except OSError:
+                os.chmod(temp, 0644)
+            os.rename(temp, self.filename)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
 
     def dump(self):
         for line in self.new_config:
@@ -85,17 +138,25 @@ class CsFile:
             self.new_config.append("%s\n" % string)
         else:
             self.new_config.insert(where, "%s\n" % string)
+        if self.index is not None:
+            key = string.strip()
+            self.index[key] = self.index.get(key, 0) + 1
 
     def add(self, string, where=-1):
-        for index, line in enumerate(self.new_config):
-            if line.strip() == string:
-                return False
-        if where == -1:
-            self.new_config.append("%s\n" % string)
-        else:
-            self.new_config.insert(where, "%s\n" % string)
+        if string in self.get_index():
+            return False
+        self.append(string, where)
         return True
 
+    def add_all(self, strings):
+        """ Add every line that is not present yet
+        Returns the number of lines added """
+        added = 0
+        for string in strings:
+            if self.add(string):
+                added += 1
+        return added
+
     def section(self, start, end, content):
         sind = -1
         eind = -1
@@ -111,10 +172,11 @@ class CsFile:
             content.insert(0, start + "\n")
             content.append(end + "\n")
         self.new_config[sind:eind] = content
+        self.index = None
 
     def greplace(self, search, replace):
         logging.debug("Searching for %s and replacing with %s" % (search, replace))
-        self.new_config = [w.replace(search, replace) for w in self.new_config]
+        self.set_config([w.replace(search, replace) for w in self.new_config])
 
     def search(self, search, replace):
         found = False
@@ -122,15 +184,17 @@ class CsFile:
         if re.search("PSK \"", replace):
             replace_filtered = re.sub(r'".*"', '"****"', replace)
         logging.debug("Searching for %s and replacing with %s" % (search, replace_filtered))
+        matcher = pattern(search)
         for index, line in enumerate(self.new_config):
             if line.lstrip().startswith("#"):
                 continue
-            if re.search(search, line):
+            if matcher.search(line):
                 found = True
                 if replace not in line:
                     self.new_config[index] = replace + "\n"
+                    self.index = None
         if not found:
-            self.new_config.append(replace + "\n")
+            self.append(replace)
             return True
         return False
 
@@ -138,12 +202,13 @@ class CsFile:
     def searchString(self, search, ignoreLinesStartWith):
         found = False
         logging.debug("Searching for %s string " % search)
+        matcher = pattern(search)
 
         for index, line in enumerate(self.new_config):
             print ' line = ' +line
             if line.lstrip().startswith(ignoreLinesStartWith):
                 continue
-            if re.search(search, line):
+            if matcher.search(line):
                 found = True
                 break
 
@@ -153,17 +218,18 @@ class CsFile:
     def deleteLine(self, search):
         found = False
         logging.debug("Searching for %s to remove the line " % search)
+        matcher = pattern(search)
         temp_config = []
         for index, line in enumerate(self.new_config):
             if line.lstrip().startswith("#"):
                 continue
-            if not re.search(search, line):
+            if not matcher.search(line):
                 temp_config.append(line)
 
-        self.new_config = list(temp_config)
+        self.set_config(temp_config)
 
 
     def compare(self, o):
-        result = (isinstance(o, self.__class__) and set(self.config) == set(o.config))
+        result = (isinstance(o, self.__class__) and self.config == o.config)
         logging.debug("Comparison of CsFiles content is ==> %s" % result)
         return result
@@ -24,6 +24,7 @@ import logging
 import os.path
 import re
 import shutil
+import CsKernel
 from netaddr import *
 from pprint import pprint
 
@@ -34,23 +35,21 @@ STATE_COMMANDS = {"router" : "ip addr | grep eth0 | grep inet | wc -l | xargs ba
 
 def reconfigure_interfaces(router_config, interfaces):
     for interface in interfaces:
-        cmd = "ip link show %s | grep 'state DOWN'" % interface.get_device()
-        for device in execute(cmd):
-            if " DOWN " in device:
-                cmd = "ip link set %s up" % interface.get_device()
-                # If redundant only bring up public interfaces that are not eth1.
-                # Reason: private gateways are public interfaces.
-                # master.py and keepalived will deal with eth1 public interface.
-
-                if router_config.is_redundant() and interface.is_public():
-                    state_cmd = STATE_COMMANDS[router_config.get_type()]
-                    logging.info("Check state command => %s" % state_cmd)
-                    state = execute(state_cmd)[0]
-                    logging.info("Route state => %s" % state)
-                    if interface.get_device() != PUBLIC_INTERFACES[router_config.get_type()] and state == "MASTER":
-                        execute(cmd)
-                else:
+        if CsKernel.state.is_down(interface.get_device()):
+            cmd = "ip link set %s up" % interface.get_device()
+            # If redundant only bring up public interfaces that are not eth1.
+            # Reason: private gateways are public interfaces.
+            # master.py and keepalived will deal with eth1 public interface.
+
+            if router_config.is_redundant() and interface.is_public():
+                state_cmd = STATE_COMMANDS[router_config.get_type()]
+                logging.info("Check state command => %s" % state_cmd)
+                state = execute(state_cmd)[0]
+                logging.info("Route state => %s" % state)
+                if interface.get_device() != PUBLIC_INTERFACES[router_config.get_type()] and state == "MASTER":
                     execute(cmd)
+            else:
+                execute(cmd)
 
 def is_mounted(name):
     for i in execute("mount"):
@@ -111,15 +110,13 @@ def bool_to_yn(val):
 def get_device_info():
     """ Returns all devices on system with their ipv4 ip netmask """
     list = []
-    for i in execute("ip addr show"):
-        vals = i.strip().lstrip().rstrip().split()
-        if vals[0] == "inet":
-            to = {}
-            to['ip'] = vals[1]
-            to['dev'] = vals[-1]
-            to['network'] = IPNetwork(to['ip'])
-            to['dnsmasq'] = False
-            list.append(to)
+    for cidr, label in CsKernel.state.addresses():
+        to = {}
+        to['ip'] = cidr
+        to['dev'] = label
+        to['network'] = IPNetwork(to['ip'])
+        to['dnsmasq'] = False
+        list.append(to)
     return list
 
 
@@ -135,21 +132,16 @@ def get_device(ip):
     """ Returns the device which has a specific ip
     If the ip is not found returns an empty string
     """
-    for i in execute("ip addr show"):
-        vals = i.strip().lstrip().rstrip().split()
-        if vals[0] == "inet":
-            if vals[1].split('/')[0] == ip:
-                return vals[-1]
+    for cidr, label in CsKernel.state.addresses():
+        if cidr.split('/')[0] == ip:
+            return label
     return ""
 
 
 def get_ip(device):
     """ Return first ip on an interface """
-    cmd = "ip addr show dev %s" % device
-    for i in execute(cmd):
-        vals = i.lstrip().split()
-        if (vals[0] == 'inet'):
-            return vals[1]
+    for cidr, label in CsKernel.state.addresses(device):
+        return cidr
     return ""
 
 
@@ -184,6 +176,7 @@ def execute(command):
     logging.debug("Executing: %s" % command)
     p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
     result = p.communicate()[0]
+    CsKernel.state.executed(command)
     return result.splitlines()
 
 
@@ -205,9 +198,22 @@ def execute2(command):
     logging.debug("Executing: %s" % command)
     p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
     p.wait()
+    CsKernel.state.executed(command)
     return p
 
 
+def execute_stdin(command, data):
+    """ Execute command feeding data on its standard input
+    Returns the exit code of the command """
+    logging.debug("Executing: %s (%s bytes on stdin)" % (command, len(data)))
+    p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    result = p.communicate(data)
+    CsKernel.state.executed(command)
+    if p.returncode:
+        logging.error("Command %s failed with %s: %s" % (command, p.returncode, result[1].strip()))
+    return p.returncode
+
+
 def service(name, op):
     execute("service %s %s" % (name, op))
     logging.info("Service %s %s" % (name, op))
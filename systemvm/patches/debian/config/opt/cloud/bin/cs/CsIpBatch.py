@@ -0,0 +1,111 @@
+# -- coding: utf-8 --
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import logging
+import re
+import subprocess
+import CsHelper
+import CsKernel
+
+
+class CsIpBatch(object):
+    """ Address, route and rule changes applied by one ip -batch run
+
+    Every change is compared with the kernel state first and only
+    queued if it is needed, so a run that finds everything in place
+    does not start ip at all. commit() runs the queued changes, going
+    on after failed lines, and logs every failure with its command.
+    """
+
+    FAILED = re.compile(r"^Command failed -:(\d+)$")
+
+    def __init__(self):
+        self.lines = []
+        self.queued = set()
+        self.flush_cache = False
+
+    def queue(self, line):
+        if line not in self.queued:
+            self.queued.add(line)
+            self.lines.append(line)
+
+    def add_address(self, dev, cidr):
+        if cidr not in [a[0] for a in CsKernel.state.addresses(dev)]:
+            self.queue("addr add dev %s %s brd +" % (dev, cidr))
+
+    def del_address(self, dev, cidr):
+        if cidr in [a[0] for a in CsKernel.state.addresses(dev)]:
+            self.queue("addr del dev %s %s" % (dev, cidr))
+
+    def find_routes(self, selector):
+        routes = CsKernel.state.find_routes(selector)
+        if routes is None:
+            routes = CsHelper.execute("ip route show %s" % selector)
+        return routes
+
+    def add_route(self, selector, exists=None):
+        """ Adds the route unless ip route show would list something for
+        exists, the selector of the route by default """
+        if not self.find_routes(exists or selector):
+            self.queue("route add %s" % selector)
+
+    def del_route(self, selector):
+        if self.find_routes(selector):
+            self.queue("route del %s" % selector)
+
+    def flush_table(self, table):
+        self.queue("route flush table %s" % table)
+        self.flush_cache = True
+
+    def add_mark_rule(self, mark, table):
+        if not CsKernel.state.has_fwmark_rule(mark, table):
+            self.queue("rule add fwmark %s table %s" % (mark, table))
+
+    def commit(self):
+        """ Apply the queued changes
+        Returns the [line, error] of the lines that failed """
+        lines = self.lines + (["route flush cache"] if self.flush_cache else [])
+        self.lines = []
+        self.queued = set()
+        self.flush_cache = False
+        if not lines:
+            return []
+        logging.info("Applying %s address, route and rule changes with ip -batch", len(lines))
+        for line in lines:
+            logging.debug("ip -batch: %s" % line)
+        p = subprocess.Popen("ip -force -batch -", stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, shell=True)
+        err = p.communicate("\n".join(lines) + "\n")[1]
+        for line in lines:
+            CsKernel.state.executed("ip " + line)
+
+        failures = []
+        message = []
+        for out in err.splitlines():
+            match = self.FAILED.match(out.strip())
+            if not match:
+                message.append(out.strip())
+                continue
+            number = int(match.group(1))
+            failures.append([lines[number - 1], " ".join(message)])
+            message = []
+        for line, error in failures:
+            logging.error("Command ip %s failed: %s" % (line, error))
+        if p.returncode and not failures:
+            logging.error("ip -batch failed with %s: %s" % (p.returncode, err.strip()))
+            failures = [[line, err.strip()] for line in lines]
+        return failures
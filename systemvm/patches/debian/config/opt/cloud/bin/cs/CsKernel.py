@@ -0,0 +1,330 @@
+# -- coding: utf-8 --
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import glob
+import logging
+import os
+import socket
+import struct
+from netaddr import IPNetwork
+
+NETLINK_ROUTE = 0
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+
+RTM_GETLINK = 18
+RTM_GETADDR = 22
+RTM_GETROUTE = 26
+RTM_GETRULE = 34
+
+IFLA_IFNAME = 3
+IFLA_OPERSTATE = 16
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+FRA_FWMARK = 10
+FRA_TABLE = 15
+FRA_FWMASK = 16
+
+FR_ACT_TO_TBL = 1
+RT_TABLE_MAIN = 254
+RT_TABLES = "/etc/iproute2/rt_tables"
+
+NLMSGHDR = struct.Struct("=IHHII")
+IFINFOMSG = struct.Struct("=BxHiII")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTMSG = struct.Struct("=BBBBBBBBI")
+RTATTR = struct.Struct("=HH")
+
+KINDS = ("links", "addresses", "routes", "rules", "processes")
+
+# Commands that change none of the kinds of state
+UNRELATED_COMMANDS = ["arping", "cat", "conntrack", "grep", "iptables", "iptables-restore",
+                      "iptables-save", "ip6tables", "ipset", "mount", "ps", "rm", "tdbdump",
+                      "umount"]
+
+
+class CsNetlink(object):
+    """ Dumps of the rtnetlink tables """
+
+    def __init__(self):
+        self.seq = 0
+
+    def dump(self, msgtype, header, family=socket.AF_INET):
+        """ Returns (header fields, attributes) of every message of the dump """
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        try:
+            sock.bind((0, 0))
+            self.seq += 1
+            request = header.pack(family, *header.unpack("\0" * header.size)[1:])
+            sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(request), msgtype,
+                                    NLM_F_REQUEST | NLM_F_DUMP, self.seq, 0) + request)
+            messages = []
+            while True:
+                data = sock.recv(65536)
+                offset = 0
+                while offset < len(data):
+                    length, mtype, flags, seq, pid = NLMSGHDR.unpack_from(data, offset)
+                    if mtype == NLMSG_DONE:
+                        return messages
+                    if mtype == NLMSG_ERROR:
+                        error = struct.unpack_from("=i", data, offset + NLMSGHDR.size)[0]
+                        raise OSError(-error, os.strerror(-error))
+                    body = offset + NLMSGHDR.size
+                    fields = header.unpack_from(data, body)
+                    messages.append((fields, self.attributes(data, body + header.size, offset + length)))
+                    offset += (length + 3) & ~3
+        finally:
+            sock.close()
+
+    def attributes(self, data, offset, end):
+        attrs = {}
+        while offset + RTATTR.size <= end:
+            length, atype = RTATTR.unpack_from(data, offset)
+            if length < RTATTR.size:
+                break
+            attrs[atype] = data[offset + RTATTR.size:offset + length]
+            offset += (length + 3) & ~3
+        return attrs
+
+
+def string_attr(value):
+    return value.rstrip("\0")
+
+
+def u32_attr(value):
+    return struct.unpack("=I", value)[0]
+
+
+def ip_attr(value):
+    return socket.inet_ntoa(value)
+
+
+class CsKernelState(object):
+    """ What one configuration run knows about the kernel
+
+    Links, IPv4 addresses, routes and rules are read with one netlink
+    dump each and processes from /proc, the first time they are asked
+    for. They are then answered from memory until the run changes them,
+    see executed().
+    """
+
+    def __init__(self):
+        self.netlink = CsNetlink()
+        self.cache = {}
+        # bumped by every invalidate(), see get()
+        self.generation = 0
+
+    def invalidate(self, *kinds):
+        """ Forget the given kinds of state, or everything """
+        self.generation += 1
+        for kind in kinds or KINDS:
+            self.cache.pop(kind, None)
+
+    def executed(self, command):
+        """ Forget the state that command may have changed """
+        kinds = self.changed_by(command)
+        if kinds:
+            self.invalidate(*kinds)
+
+    def changed_by(self, command):
+        """ The kinds of state a shell command can change """
+        words = command.split()
+        if not words:
+            return ()
+        for separator in ("|", ";", "&", "`", "$("):
+            if separator in command:
+                return KINDS
+        program = os.path.basename(words[0])
+        if program == "ip":
+            args = [w for w in words[1:] if not w.startswith("-")]
+            if len(args) < 2 or args[1] in ("show", "list", "lst", "ls", "get"):
+                return ()
+            if "address".startswith(args[0]):
+                return ("addresses", "routes")
+            if "route".startswith(args[0]):
+                return ("routes",)
+            if "rule".startswith(args[0]):
+                return ("rules",)
+            if "link".startswith(args[0]):
+                return ("links", "addresses", "routes")
+            return KINDS
+        if program in UNRELATED_COMMANDS:
+            return ()
+        if program in ("kill", "killall", "pkill", "service"):
+            return ("processes",)
+        return KINDS
+
+    def get(self, kind):
+        value = self.cache.get(kind)
+        if value is None:
+            generation = self.generation
+            value = getattr(self, "load_" + kind)()
+            logging.debug("CsKernel:: Loaded %s", kind)
+            # another thread may have changed the kernel during the load
+            if generation == self.generation:
+                self.cache[kind] = value
+        return value
+
+    def load_links(self):
+        """ Device name and operational state by index """
+        links = {}
+        for fields, attrs in self.netlink.dump(RTM_GETLINK, IFINFOMSG, socket.AF_UNSPEC):
+            operstate = attrs.get(IFLA_OPERSTATE)
+            links[fields[2]] = {"name": string_attr(attrs.get(IFLA_IFNAME, "")),
+                                "operstate": operstate and ord(operstate[0])}
+        return links
+
+    def load_addresses(self):
+        """ The IPv4 addresses in the order ip addr show lists them """
+        addresses = []
+        for fields, attrs in self.netlink.dump(RTM_GETADDR, IFADDRMSG):
+            local = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            if local is None:
+                continue
+            addresses.append({"cidr": "%s/%s" % (ip_attr(local), fields[1]),
+                              "index": fields[4],
+                              "label": string_attr(attrs.get(IFA_LABEL, ""))})
+        return addresses
+
+    def load_routes(self):
+        routes = []
+        for fields, attrs in self.netlink.dump(RTM_GETROUTE, RTMSG):
+            dst = attrs.get(RTA_DST)
+            routes.append({"dst": IPNetwork("%s/%s" % (dst and ip_attr(dst) or "0.0.0.0", fields[1])),
+                           "table": RTA_TABLE in attrs and u32_attr(attrs[RTA_TABLE]) or fields[4],
+                           "oif": RTA_OIF in attrs and u32_attr(attrs[RTA_OIF]) or None,
+                           "gateway": RTA_GATEWAY in attrs and ip_attr(attrs[RTA_GATEWAY]) or None})
+        return routes
+
+    def load_rules(self):
+        rules = []
+        for fields, attrs in self.netlink.dump(RTM_GETRULE, RTMSG):
+            rules.append({"src_len": fields[2],
+                          "dst_len": fields[1],
+                          "action": fields[7],
+                          "table": FRA_TABLE in attrs and u32_attr(attrs[FRA_TABLE]) or fields[4],
+                          "fwmark": FRA_FWMARK in attrs and u32_attr(attrs[FRA_FWMARK]) or None,
+                          "fwmask": FRA_FWMASK in attrs and u32_attr(attrs[FRA_FWMASK]) or None})
+        return rules
+
+    def load_processes(self):
+        """ The arguments of every process by pid, [] for kernel threads """
+        processes = {}
+        for path in glob.glob("/proc/[0-9]*/cmdline"):
+            try:
+                cmdline = open(path).read()
+            except IOError:
+                # the process exited
+                continue
+            processes[path.split("/")[2]] = cmdline.rstrip("\0").split("\0") if cmdline else []
+        return processes
+
+    def device_name(self, index):
+        link = self.get("links").get(index)
+        return link and link["name"]
+
+    def device_index(self, name):
+        for index, link in self.get("links").iteritems():
+            if link["name"] == name:
+                return index
+        return None
+
+    def is_down(self, dev):
+        """ True if ip link show reports the device as state DOWN """
+        index = self.device_index(dev)
+        return index is not None and self.get("links")[index]["operstate"] == 2
+
+    def addresses(self, dev=None):
+        """ [cidr, label] of the IPv4 addresses of dev, or of all devices """
+        index = dev is not None and self.device_index(dev)
+        return [[a["cidr"], a["label"]] for a in self.get("addresses") if dev is None or a["index"] == index]
+
+    def table_id(self, name):
+        """ The number of a route table given by name or number, None if unknown """
+        if name.isdigit():
+            return int(name)
+        tables = {"main": RT_TABLE_MAIN, "local": 255, "default": 253}
+        for filename in [RT_TABLES] + sorted(glob.glob(RT_TABLES + ".d/*.conf")):
+            try:
+                for line in open(filename):
+                    vals = line.split()
+                    if len(vals) >= 2 and not vals[0].startswith("#") and vals[0].isdigit():
+                        tables[vals[1]] = int(vals[0])
+            except IOError:
+                continue
+        return tables.get(name)
+
+    def find_routes(self, selector):
+        """ The routes ip route show <selector> would list, for selectors made
+        of a prefix or default, dev, via and table. None for other selectors """
+        words = selector.split()
+        table = RT_TABLE_MAIN
+        dev = gateway = prefix = None
+        while words:
+            word = words.pop(0)
+            if word in ("dev", "via", "table", "to"):
+                if not words:
+                    return None
+                value = words.pop(0)
+                if word == "dev":
+                    dev = self.device_index(value)
+                    if dev is None:
+                        return []
+                elif word == "via":
+                    gateway = value
+                elif word == "table":
+                    table = self.table_id(value)
+                    if table is None:
+                        return []
+                else:
+                    words.insert(0, value)
+            elif prefix is None:
+                try:
+                    prefix = IPNetwork("0.0.0.0/0" if word == "default" else word).cidr
+                except Exception:
+                    return None
+            else:
+                return None
+        return [r for r in self.get("routes")
+                if r["table"] == table and
+                (prefix is None or r["dst"] == prefix) and
+                (dev is None or r["oif"] == dev) and
+                (gateway is None or r["gateway"] == gateway)]
+
+    def has_fwmark_rule(self, mark, table):
+        """ True if there is a rule from all fwmark mark lookup table """
+        table = self.table_id(table)
+        for rule in self.get("rules"):
+            if rule["src_len"] == 0 and rule["dst_len"] == 0 and rule["action"] == FR_ACT_TO_TBL \
+                    and rule["fwmark"] == mark and rule["fwmask"] in (None, 0xffffffff) \
+                    and rule["table"] == table:
+                return True
+        return False
+
+    def processes(self):
+        """ (pid, arguments) of every process """
+        return self.get("processes").items()
+
+
+state = CsKernelState()
@@ -15,6 +15,7 @@
 # specific language governing permissions and limitations
 # under the License.
 import logging
+import CsHelper
 from cs.CsDatabag import CsDataBag
 from CsFile import CsFile
 
@@ -39,5 +40,7 @@ class CsMonitor(CsDataBag):
         cron = CsFile("/etc/cron.d/process")
         cron.add("SHELL=/bin/bash", 0)
         cron.add("PATH=/usr/local/sbin:/usr/local/bin:/sbin:/bin:/usr/sbin:/usr/bin", 1)
+        # cron only restarts the watchdog should it die, start it right away
         cron.add("*/3 * * * * root /usr/bin/python /root/monitorServices.py", -1)
         cron.commit()
+        CsHelper.execute("/usr/bin/python /root/monitorServices.py")
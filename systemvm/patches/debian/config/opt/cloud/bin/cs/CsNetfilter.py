@@ -16,6 +16,7 @@
 # specific language governing permissions and limitations
 # under the License.
 import CsHelper
+import re
 from pprint import pprint
 from CsDatabag import CsDataBag, CsCmdLine
 import logging
@@ -77,12 +78,65 @@ class CsTable(object):
         return self.last_added
 
 
+class CsIptablesRestore(object):
+    """ Collect iptables commands and apply them per table
+    in a single iptables-restore --noflush transaction
+
+    Commands are kept in the order they were added, so inserts at a
+    given position behave exactly as they would when run one by one.
+    If a table fails to validate or to apply, the commands for that
+    table are run one at a time instead.
+    """
+
+    def __init__(self):
+        self.tables = []
+        self.commands = {}
+
+    def add(self, table, cmd):
+        if table not in self.commands:
+            self.tables.append(table)
+            self.commands[table] = []
+        self.commands[table].append(cmd.strip())
+
+    def get(self, table):
+        if table not in self.commands:
+            return []
+        return self.commands[table]
+
+    def render(self, table):
+        """ Render the commands for a table in iptables-restore format """
+        lines = ["*%s" % table]
+        for cmd in self.get(table):
+            # iptables-restore does not accept a table inside a rule
+            lines.append(re.sub(r'(^|\s)-t\s+\S+', '', cmd).strip())
+        lines.append("COMMIT")
+        return "\n".join(lines) + "\n"
+
+    def apply(self):
+        for table in self.tables:
+            data = self.render(table)
+            if CsHelper.execute_stdin("iptables-restore --noflush --test", data) == 0 and \
+               CsHelper.execute_stdin("iptables-restore --noflush", data) == 0:
+                logging.info("Applied %s commands to table %s in one transaction", len(self.get(table)), table)
+                continue
+            logging.warn("iptables-restore failed for table %s, applying %s commands one by one", table, len(self.get(table)))
+            for cmd in self.get(table):
+                CsHelper.execute("iptables -t %s %s" % (table, cmd))
+        self.tables = []
+        self.commands = {}
+
+
 class CsNetfilters(object):
 
-    def __init__(self, load=True):
+    def __init__(self, load=True, batch=True):
         self.rules = []
+        self.index = {}
+        self.deleted = set()
         self.table = CsTable()
         self.chain = CsChain()
+        self.batch = None
+        if batch:
+            self.batch = CsIptablesRestore()
         if load:
             self.get_all_rules()
 
@@ -103,10 +157,18 @@ class CsNetfilters(object):
 
     def save(self, rule):
         self.rules.append(rule)
+        self.index.setdefault(rule.get_chain_key(), {}).setdefault(rule.get_options(), []).append(rule)
 
     def get(self):
+        if self.deleted:
+            self.rules[:] = [x for x in self.rules if id(x) not in self.deleted]
+            self.deleted = set()
         return self.rules
 
+    def find(self, rule):
+        """ Return the saved rules equal to the given rule """
+        return self.index.get(rule.get_chain_key(), {}).get(rule.get_options(), [])
+
     def has_table(self, table):
         return table in self.table.get()
 
@@ -114,20 +176,26 @@ class CsNetfilters(object):
         return self.chain.has_chain(table, chain)
 
     def has_rule(self, new_rule):
-        for r in self.get():
-            if new_rule == r:
-                if new_rule.get_count() > 0:
-                    continue
-                r.mark_seen()
-                return True
-        return False
+        if new_rule.get_count() > 0:
+            return False
+        found = self.find(new_rule)
+        if not found:
+            return False
+        found[0].mark_seen()
+        return True
+
+    def execute(self, table, cmd):
+        """ Run an iptables command, or queue it when batching """
+        if self.batch is not None:
+            self.batch.add(table, cmd)
+        else:
+            CsHelper.execute("iptables -t %s %s" % (table, cmd))
 
     def get_unseen(self):
-        del_list = [x for x in self.rules if x.unseen()]
+        del_list = [x for x in self.get() if x.unseen()]
         for r in del_list:
-            cmd = "iptables -t %s %s" % (r.get_table(), r.to_str(True))
-            logging.debug("unseen cmd:  %s ", cmd)
-            CsHelper.execute(cmd)
+            logging.debug("unseen cmd:  iptables -t %s %s ", r.get_table(), r.to_str(True))
+            self.execute(r.get_table(), r.to_str(True))
             # print "Delete rule %s from table %s" % (r.to_str(True), r.get_table())
             logging.info("Delete rule %s from table %s", r.to_str(True), r.get_table())
 
@@ -155,6 +223,9 @@ class CsNetfilters(object):
                 new_rule.set_count(fw[1])
 
             rule_chain = new_rule.get_chain()
+            if new_rule.is_new_chain():
+                # Created in pass 1
+                continue
 
             logging.debug("Checking if the rule already exists: rule=%s table=%s chain=%s", new_rule.get_rule(), new_rule.get_table(), new_rule.get_chain())
             if self.has_rule(new_rule):
@@ -173,16 +244,18 @@ class CsNetfilters(object):
                         cpy = cpy.replace("-A %s" % new_rule.get_chain(), '-I %s %s' % (new_rule.get_chain(), rule_count))
                     else:
                         cpy = cpy.replace("-A %s" % new_rule.get_chain(), '-I %s %s' % (new_rule.get_chain(), fw[1]))
-                CsHelper.execute("iptables -t %s %s" % (new_rule.get_table(), cpy))
+                self.execute(new_rule.get_table(), cpy)
                 ruleSet.add(tupledFw)
                 self.chain.add_rule(rule_chain)
         self.del_standard()
         self.get_unseen()
+        if self.batch is not None:
+            self.batch.apply()
 
     def add_chain(self, rule):
         """ Add the given chain if it is not already present """
         if not self.has_chain(rule.get_table(), rule.get_chain()):
-            CsHelper.execute("iptables -t %s -N %s" % (rule.get_table(), rule.get_chain()))
+            self.execute(rule.get_table(), "-N %s" % rule.get_chain())
             self.chain.add(rule.get_table(), rule.get_chain())
 
     def del_standard(self):
@@ -212,7 +285,9 @@ class CsNetfilters(object):
     def delete(self, rule):
         """ Delete a rule from the list of configured rules
         The rule will not actually be removed on the host """
-        self.rules[:] = [x for x in self.rules if not x == rule]
+        chain = self.index.get(rule.get_chain_key(), {})
+        for r in chain.pop(rule.get_options(), []):
+            self.deleted.add(id(r))
 
 
 class CsNetfilter(object):
@@ -248,8 +323,14 @@ class CsNetfilter(object):
         rule = dict(zip(bits[0::2], bits[1::2]))
         if "-A" in rule.keys():
             self.chain = rule["-A"]
+        if "-N" in rule.keys():
+            self.chain = rule["-N"]
         return rule
 
+    def is_new_chain(self):
+        """ Is this a request to create a chain rather than a rule """
+        return "-N" in self.rule.keys()
+
     def set_table(self, table):
         if table == '':
             table = "filter"
@@ -293,14 +374,21 @@ class CsNetfilter(object):
         str = str.replace("--checksum fill", "--checksum-fill")
         return str
 
+    def get_chain_key(self):
+        return (self.get_table(), self.get_chain())
+
+    def get_options(self):
+        """ The rule options in a canonical, hashable form """
+        return tuple(sorted(self.rule.items()))
+
+    def get_key(self):
+        return self.get_chain_key() + (self.get_options(),)
+
+    def __hash__(self):
+        return hash(self.get_key())
+
     def __eq__(self, rule):
-        if rule.get_table() != self.get_table():
-            return False
-        if rule.get_chain() != self.get_chain():
-            return False
-        if len(rule.get_rule().items()) != len(self.get_rule().items()):
-            return False
-        common = set(rule.get_rule().items()) & set(self.get_rule().items())
-        if len(common) != len(rule.get_rule()):
-            return False
-        return True
+        return self.get_key() == rule.get_key()
+
+    def __ne__(self, rule):
+        return not self == rule
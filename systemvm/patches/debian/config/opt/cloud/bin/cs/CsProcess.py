@@ -16,8 +16,8 @@
 # specific language governing permissions and limitations
 # under the License.
 import os
-import re
 import CsHelper
+import CsKernel
 import logging
 
 
@@ -32,6 +32,7 @@ class CsProcess(object):
         #     cmd = cmd + " &"
         logging.info("Started %s", " ".join(self.search))
         os.system("%s %s %s" % (thru, " ".join(self.search), background))
+        CsKernel.state.invalidate("processes")
 
     def kill_all(self):
         pids = self.find_pid()
@@ -40,12 +41,12 @@ class CsProcess(object):
 
     def find_pid(self):
         self.pid = []
-        for i in CsHelper.execute("ps aux"):
-            items = len(self.search)
-            proc = re.split("\s+", i)[items*-1:]
+        items = len(self.search)
+        for pid, args in self.processes():
+            proc = " ".join(args).split()[items*-1:]
             matches = len([m for m in proc if m in self.search])
             if matches == items:
-                self.pid.append(re.split("\s+", i)[1])
+                self.pid.append(pid)
 
         logging.debug("CsProcess:: Searching for process ==> %s and found PIDs ==> %s", self.search, self.pid)
         return self.pid
@@ -59,7 +60,11 @@ class CsProcess(object):
             CsHelper.execute("kill -9 %s" % pid)
 
     def grep(self, str):
-        for i in CsHelper.execute("ps aux"):
-            if i.find(str) != -1:
-                return re.split("\s+", i)[1]
+        for pid, args in self.processes():
+            if " ".join(args).find(str) != -1:
+                return pid
         return -1
+
+    def processes(self):
+        """ (pid, arguments) of the running processes, ordered by pid """
+        return sorted(CsKernel.state.processes(), key=lambda p: int(p[0]))
@@ -36,6 +36,7 @@ import CsHelper
 from CsFile import CsFile
 from CsProcess import CsProcess
 from CsApp import CsPasswdSvc
+from CsFailover import CsFailover
 from CsAddress import CsDevice
 from CsRoute import CsRoute
 from CsStaticRoutes import CsStaticRoutes
@@ -231,19 +232,15 @@ class CsRedundant(object):
         self.set_lock()
         logging.info("Router switched to fault mode")
 
+        failover = CsFailover("FAULT")
         interfaces = [interface for interface in self.address.get_interfaces() if interface.is_public()]
         for interface in interfaces:
-            CsHelper.execute("ifconfig %s down" % interface.get_device())
-
-        cmd = "%s -C %s" % (self.CONNTRACKD_BIN, self.CONNTRACKD_CONF)
-        CsHelper.execute("%s -s" % cmd)
-        CsHelper.service("ipsec", "stop")
-        CsHelper.service("xl2tpd", "stop")
-        CsHelper.service("dnsmasq", "stop")
-
-        interfaces = [interface for interface in self.address.get_interfaces() if interface.needs_vrrp()]
-        for interface in interfaces:
-            CsPasswdSvc(interface.get_gateway()).stop()
+            dev = interface.get_device()
+            if "down %s" % dev not in failover.names:
+                failover.add("down %s" % dev, CsHelper.execute, "ifconfig %s down" % dev, critical=True)
+        failover.add("conntrackd -s", self._conntrackd, "-s", critical=True)
+        self._add_services(failover, "stop")
+        failover.run()
 
         self.cl.set_fault_state()
         self.cl.save()
@@ -262,25 +259,15 @@ class CsRedundant(object):
         self.set_lock()
         logging.debug("Setting router to backup")
 
-        dev = ''
+        failover = CsFailover("BACKUP")
         interfaces = [interface for interface in self.address.get_interfaces() if interface.is_public()]
         for interface in interfaces:
-            if dev == interface.get_device():
-                continue
-            logging.info("Bringing public interface %s down" % interface.get_device())
-            cmd2 = "ip link set %s down" % interface.get_device()
-            CsHelper.execute(cmd2)
             dev = interface.get_device()
-
-        cmd = "%s -C %s" % (self.CONNTRACKD_BIN, self.CONNTRACKD_CONF)
-        CsHelper.execute("%s -d" % cmd)
-        CsHelper.service("ipsec", "stop")
-        CsHelper.service("xl2tpd", "stop")
-
-        interfaces = [interface for interface in self.address.get_interfaces() if interface.needs_vrrp()]
-        for interface in interfaces:
-            CsPasswdSvc(interface.get_gateway()).stop()
-        CsHelper.service("dnsmasq", "stop")
+            if "down %s" % dev not in failover.names:
+                failover.add("down %s" % dev, self._link_down, dev, critical=True)
+        failover.add("conntrackd -d", self._conntrackd, "-d", critical=True)
+        self._add_services(failover, "stop")
+        failover.run()
 
         self.cl.set_master_state(False)
         self.cl.save()
@@ -291,7 +278,13 @@ class CsRedundant(object):
         logging.info("Router switched to backup mode")
 
     def set_master(self):
-        """ Set the current router to master """
+        """ Set the current router to master
+
+        Bringing up the public interfaces, announcing their addresses and
+        committing the connections synced by conntrackd come first, one
+        thread per interface. Static routes wait for all interfaces. The
+        restarts of the services follow, side by side.
+        """
         if not self.cl.is_redundant():
             logging.error("Set master called on non-redundant router")
             return
@@ -299,45 +292,21 @@ class CsRedundant(object):
         self.set_lock()
         logging.debug("Setting router to master")
 
-        dev = ''
+        failover = CsFailover("MASTER")
         interfaces = [interface for interface in self.address.get_interfaces() if interface.is_public()]
-        route = CsRoute()
+        links = []
         for interface in interfaces:
-            if dev == interface.get_device():
-                continue
             dev = interface.get_device()
-            logging.info("Will proceed configuring device ==> %s" % dev)
-            cmd = "ip link set %s up" % dev
-            if CsDevice(dev, self.config).waitfordevice():
-                CsHelper.execute(cmd)
-                logging.info("Bringing public interface %s up" % dev)
-
-                try:
-                    gateway = interface.get_gateway()
-                    logging.info("Adding gateway ==> %s to device ==> %s" % (gateway, dev))
-                    if dev == CsHelper.PUBLIC_INTERFACES[self.cl.get_type()]:
-                        route.add_defaultroute(gateway)
-                except:
-                    logging.error("ERROR getting gateway from device %s" % dev)
-            else:
-                logging.error("Device %s was not ready could not bring it up" % dev)
-
-        logging.debug("Configuring static routes")
-        static_routes = CsStaticRoutes("staticroutes", self.config)
-        static_routes.process()
+            if "up %s" % dev not in failover.names:
+                links.append(failover.add("up %s" % dev, self._link_up, dev, interface, critical=True))
+                ips = [i.get_ip() for i in interfaces if i.get_device() == dev]
+                failover.add("arping %s" % dev, self._arping, dev, ips, requires=["up %s" % dev], critical=True)
+        failover.add("static routes", self._static_routes, requires=links, critical=True)
+        failover.add("conntrackd -c", self._conntrackd, "-c", critical=True)
+        failover.add("conntrackd -f -R -B", self._conntrackd, "-f", "-R", "-B")
+        self._add_services(failover, "restart")
+        failover.run()
 
-        cmd = "%s -C %s" % (self.CONNTRACKD_BIN, self.CONNTRACKD_CONF)
-        CsHelper.execute("%s -c" % cmd)
-        CsHelper.execute("%s -f" % cmd)
-        CsHelper.execute("%s -R" % cmd)
-        CsHelper.execute("%s -B" % cmd)
-        CsHelper.service("ipsec", "restart")
-        CsHelper.service("xl2tpd", "restart")
-        interfaces = [interface for interface in self.address.get_interfaces() if interface.needs_vrrp()]
-        for interface in interfaces:
-            CsPasswdSvc(interface.get_gateway()).restart()
-
-        CsHelper.service("dnsmasq", "restart")
         self.cl.set_master_state(True)
         self.cl.save()
         self.release_lock()
@@ -346,6 +315,50 @@ class CsRedundant(object):
         CsHelper.reconfigure_interfaces(self.cl, interfaces)
         logging.info("Router switched to master mode")
 
+    def _add_services(self, failover, action):
+        for service in ["ipsec", "xl2tpd", "dnsmasq"]:
+            failover.add("%s %s" % (service, action), CsHelper.service, service, action)
+        failover.add("password server %s" % action, self._passwd_servers, action)
+
+    def _link_up(self, dev, interface):
+        logging.info("Will proceed configuring device ==> %s" % dev)
+        if not CsDevice(dev, self.config).waitfordevice():
+            logging.error("Device %s was not ready could not bring it up" % dev)
+            return
+        CsHelper.execute("ip link set %s up" % dev)
+        logging.info("Bringing public interface %s up" % dev)
+        try:
+            gateway = interface.get_gateway()
+            logging.info("Adding gateway ==> %s to device ==> %s" % (gateway, dev))
+            if dev == CsHelper.PUBLIC_INTERFACES[self.cl.get_type()]:
+                CsRoute().add_defaultroute(gateway)
+        except:
+            logging.error("ERROR getting gateway from device %s" % dev)
+
+    def _link_down(self, dev):
+        logging.info("Bringing public interface %s down" % dev)
+        CsHelper.execute("ip link set %s down" % dev)
+
+    def _arping(self, dev, ips):
+        """ Tell the neighbours that the addresses of dev moved here """
+        for ip in ips:
+            CsHelper.execute("arping -c 1 -I %s -A -U %s" % (dev, ip))
+
+    def _static_routes(self):
+        logging.debug("Configuring static routes")
+        CsStaticRoutes("staticroutes", self.config).process()
+
+    def _conntrackd(self, *flags):
+        cmd = "%s -C %s" % (self.CONNTRACKD_BIN, self.CONNTRACKD_CONF)
+        for flag in flags:
+            CsHelper.execute("%s %s" % (cmd, flag))
+
+    def _passwd_servers(self, action):
+        """ The servers share one address file, so this is one step """
+        interfaces = [interface for interface in self.address.get_interfaces() if interface.needs_vrrp()]
+        for interface in interfaces:
+            getattr(CsPasswdSvc(interface.get_gateway()), action)()
+
     def _collect_ignore_ips(self):
         """
         This returns a list of ip objects that should be ignored
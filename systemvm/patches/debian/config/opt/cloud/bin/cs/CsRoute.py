@@ -16,15 +16,27 @@
 # specific language governing permissions and limitations
 # under the License.
 import CsHelper
+import CsKernel
 import logging
+from CsIpBatch import CsIpBatch
 
 
 class CsRoute:
 
-    """ Manage routes """
+    """ Manage routes
+    The changes are queued in batch when one is given, the caller commits it
+    """
 
-    def __init__(self):
+    def __init__(self, batch=None):
         self.table_prefix = "Table_"
+        self.batch = batch
+
+    def apply(self, change, *args):
+        """ Queue a change of CsIpBatch, or make it right away without a batch """
+        batch = self.batch or CsIpBatch()
+        getattr(batch, change)(*args)
+        if batch is not self.batch:
+            batch.commit()
 
     def get_tablename(self, name):
         return self.table_prefix + name
@@ -39,8 +51,7 @@ class CsRoute:
         CsHelper.addifmissing(filename, str)
 
     def flush_table(self, tablename):
-        CsHelper.execute("ip route flush table %s" % (tablename))
-        CsHelper.execute("ip route flush cache")
+        self.apply("flush_table", tablename)
 
     def add_route(self, dev, address):
         """ Wrapper method that adds table name and device to route statement """
@@ -53,18 +64,10 @@ class CsRoute:
 
     def set_route(self, cmd, method="add"):
         """ Add a route if it is not already defined """
-        found = False
-        for i in CsHelper.execute("ip route show " + cmd):
-            found = True
-        if not found and method == "add":
-            logging.info("Add " + cmd)
-            cmd = "ip route add " + cmd
-        elif found and method == "delete":
-            logging.info("Delete " + cmd)
-            cmd = "ip route delete " + cmd
-        else:
-            return
-        CsHelper.execute(cmd)
+        if method == "add":
+            self.apply("add_route", cmd)
+        elif method == "delete":
+            self.apply("del_route", cmd)
 
     def add_defaultroute(self, gateway):
         """  Add a default route
@@ -74,7 +77,7 @@ class CsRoute:
         if not gateway:
             raise Exception("Gateway cannot be None.")
         
-        if self.defaultroute_exists():
+        if self.defaultroute_exists() or self.defaultroute_queued():
             return False
         else:
             cmd = "default via " + gateway
@@ -82,15 +85,19 @@ class CsRoute:
             self.set_route(cmd)
             return True
 
+    def defaultroute_queued(self):
+        """ Return True if the batch already adds a default route """
+        return self.batch is not None and any(line.startswith("route add default ") for line in self.batch.lines)
+
     def defaultroute_exists(self):
         """ Return True if a default route is present
         :return: bool
         """
         logging.info("Checking if default ipv4 route is present")
-        route_found = CsHelper.execute("ip -4 route list 0/0")
+        route_found = CsKernel.state.find_routes("default")
 
         if len(route_found) > 0:
-            logging.info("Default route found: " + route_found[0])
+            logging.info("Default route found: via %s" % route_found[0]["gateway"])
             return True
         else:
             logging.warn("No default route found!")
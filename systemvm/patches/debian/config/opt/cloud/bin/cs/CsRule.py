@@ -15,8 +15,9 @@
 # KIND, either express or implied.  See the License for the
 # specific language governing permissions and limitations
 # under the License.
-import CsHelper
+import CsKernel
 import logging
+from CsIpBatch import CsIpBatch
 
 
 class CsRule:
@@ -30,15 +31,14 @@ class CsRule:
         self.tableNo = int(dev[3:])
         self.table = "Table_%s" % (dev)
 
-    def addMark(self):
+    def addMark(self, batch=None):
         if not self.findMark():
-            cmd = "ip rule add fwmark %s table %s" % (self.tableNo, self.table)
-            CsHelper.execute(cmd)
+            commit = batch is None
+            batch = batch or CsIpBatch()
+            batch.add_mark_rule(self.tableNo, self.table)
+            if commit:
+                batch.commit()
             logging.info("Added fwmark rule for %s" % (self.table))
 
     def findMark(self):
-        srch = "from all fwmark %s lookup %s" % (hex(self.tableNo), self.table)
-        for i in CsHelper.execute("ip rule show"):
-            if srch in i.strip():
-                return True
-        return False
+        return CsKernel.state.has_fwmark_rule(self.tableNo, self.table)
@@ -18,6 +18,7 @@
 # under the License.
 
 from CsDatabag import CsDataBag
+from CsIpBatch import CsIpBatch
 from CsRedundant import *
 
 
@@ -25,18 +26,16 @@ class CsStaticRoutes(CsDataBag):
 
     def process(self):
         logging.debug("Processing CsStaticRoutes file ==> %s" % self.dbag)
+        batch = CsIpBatch()
         for item in self.dbag:
             if item == "id":
                 continue
-            self.__update(self.dbag[item])
+            self.__update(self.dbag[item], batch)
+        batch.commit()
 
-    def __update(self, route):
+    def __update(self, route, batch):
         if route['revoke']:
-            command = "ip route del %s via %s" % (route['network'], route['gateway'])
-            CsHelper.execute(command)
+            batch.del_route("%s via %s" % (route['network'], route['gateway']))
         else:
-            command = "ip route show | grep %s | awk '{print $1, $3}'" % route['network']
-            result = CsHelper.execute(command)
-            if not result:
-                route_command = "ip route add %s via %s" % (route['network'], route['gateway'])
-                CsHelper.execute(route_command)
\ No newline at end of file
+            # any route to the network counts, whatever its gateway
+            batch.add_route("%s via %s" % (route['network'], route['gateway']), route['network'])
\ No newline at end of file
@@ -19,31 +19,64 @@ from pprint import pprint
 from netaddr import *
 
 
+# Secondary indexes kept inside the databag, next to the entries keyed by ip
+INDEX = "index"
+
+
 def merge(dbag, data):
 
+    index = get_index(dbag)
     search(dbag, data['host_name'])
     # A duplicate ip address wil clobber the old value
     # This seems desirable ....
     if "add" in data and data['add'] is False and \
             "ipv4_adress" in data:
         if data['ipv4_adress'] in dbag:
-            del(dbag[data['ipv4_adress']])
+            remove(dbag, data['ipv4_adress'])
         return dbag
     else:
+        if data['ipv4_adress'] in dbag:
+            remove(dbag, data['ipv4_adress'])
         dbag[data['ipv4_adress']] = data
+        add_index(index, data)
     return dbag
 
 
+def get_index(dbag):
+    """ host_name -> [ip] and mac -> [ip], built once for older databags """
+    if INDEX not in dbag:
+        index = {"host_name": {}, "mac_address": {}}
+        for o in dbag:
+            if o == 'id':
+                continue
+            add_index(index, dbag[o])
+        dbag[INDEX] = index
+    return dbag[INDEX]
+
+
+def add_index(index, entry):
+    for key in index:
+        if key in entry:
+            index[key].setdefault(entry[key], []).append(entry['ipv4_adress'])
+
+
+def remove(dbag, ip):
+    index = get_index(dbag)
+    entry = dbag.pop(ip)
+    for key in index:
+        if key not in entry or entry[key] not in index[key]:
+            continue
+        ips = index[key][entry[key]]
+        if ip in ips:
+            ips.remove(ip)
+        if not ips:
+            del(index[key][entry[key]])
+
+
 def search(dbag, name):
     """
     Dirty hack because CS does not deprovision hosts
     """
-    hosts = []
-    for o in dbag:
-        if o == 'id':
-            continue
-        print "%s %s" % (dbag[o]['host_name'], name)
-        if dbag[o]['host_name'] == name:
-            hosts.append(o)
-    for o in hosts:
-        del(dbag[o])
+    for o in list(get_index(dbag)['host_name'].get(name, [])):
+        if o in dbag:
+            remove(dbag, o)
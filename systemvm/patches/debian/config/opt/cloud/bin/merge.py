@@ -42,6 +42,10 @@ from pprint import pprint
 class DataBag:
 
     DPATH = "/etc/cloudstack"
+    # Bags read by shell scripts, checkrouter.sh greps the type from
+    # cmdline.json. They keep one key per line, the others are written
+    # compactly.
+    PRETTY = ["cmdline"]
 
     def __init__(self):
         self.bdata = {}
@@ -63,15 +67,28 @@ class DataBag:
         self.dbag = data
 
     def save(self, dbag):
+        # Written to a temporary file and renamed over the old bag, so
+        # readers never see a partially written bag.
+        if self.key in self.PRETTY:
+            jsono = json.dumps(dbag, indent=4, sort_keys=True)
+        else:
+            jsono = json.dumps(dbag, separators=(',', ':'))
+        tmp = self.fpath + '.tmp'
         try:
-            handle = open(self.fpath, 'w')
-        except IOError:
-            logging.error("Could not write data bag %s", self.key)
+            handle = open(tmp, 'w')
+            try:
+                handle.write(jsono)
+                handle.flush()
+                os.fsync(handle.fileno())
+            finally:
+                handle.close()
+            os.rename(tmp, self.fpath)
+        except (IOError, OSError), e:
+            logging.error("Could not write data bag %s: %s", self.key, e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
         else:
             logging.debug("Writing data bag type %s", self.key)
-            logging.debug(dbag)
-        jsono = json.dumps(dbag, indent=4, sort_keys=True)
-        handle.write(jsono)
 
     def getDataBag(self):
         return self.dbag
@@ -76,6 +76,11 @@ fi
 
 
 logger -t cloud "deleted crontab entry for monitoring services"
+# the watchdog keeps running once started
+if [ -f /var/run/monitorServices.pid ]
+then
+    kill $(cat /var/run/monitorServices.pid) 2>/dev/null
+fi
 unlock_exit 0 $lock $locked
 fi
 
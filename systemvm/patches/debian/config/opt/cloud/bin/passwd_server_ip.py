@@ -24,29 +24,56 @@
 # Save password only from within router:
 #   /opt/cloud/bin/savepassword.sh -v <IP> -p <password>
 #   curl --header 'DomU_Request: save_password' http://localhost:8080/ -F ip=<IP> -F password=<passwd>
+#
+# One process serves every address listed in the address file, one event
+# loop accepts and answers the requests of all of them. SIGHUP makes it
+# read the address file again, so tiers are added and removed without a
+# restart. Starting it with addresses adds them to the file; if a server
+# is already running it is told to listen on them and the new process
+# waits to take over should the running one die.
 
 import binascii
 import cgi
+import errno
+import fcntl
+import glob
+import mimetools
 import os
+import select
+import signal
+import socket
 import sys
 import syslog
 import threading
-import urlparse
+import time
+
+from StringIO import StringIO
 
-from BaseHTTPServer   import BaseHTTPRequestHandler, HTTPServer
-from SocketServer     import ThreadingMixIn #, ForkingMixIn
 
+PORT = 8080
+CACHE_DIR = '/var/cache/cloud'
+ADDRESS_FILE = CACHE_DIR + '/passwd_server_addresses'
+PID_FILE = '/var/run/passwd_server.pid'
+# Changes in the journal that make it worth rewriting the password file
+COMPACT_ENTRIES = 1000
+# Seconds a client may take to send its request
+IDLE_TIMEOUT = 20
+MAX_REQUEST = 65536
+# Seconds between attempts to listen on an address that failed
+RETRY_INTERVAL = 5
+# Connections served at once, more are closed as they come in so the
+# server never runs out of file descriptors
+MAX_CONNECTIONS = 1000
+# Lets the backup of a redundant pair listen on its gateway addresses
+IP_FREEBIND = 15
 
-passMap = {}
 secureToken = None
-listeningAddress = '127.0.0.1'
-lock = threading.RLock()
 
 def getTokenFile():
     return '/tmp/passwdsrvrtoken'
 
 def getPasswordFile():
-    return '/var/cache/cloud/passwords-%s' % listeningAddress
+    return CACHE_DIR + '/passwords'
 
 def initToken():
     global secureToken
@@ -61,133 +88,516 @@ def initToken():
 def checkToken(token):
     return token == secureToken
 
-def loadPasswordFile():
+def readAddresses():
     try:
-        with file(getPasswordFile()) as f:
-            for line in f:
-                if '=' not in line: continue
-                key, value = line.strip().split('=', 1)
-                passMap[key] = value
+        with open(ADDRESS_FILE) as f:
+            return [line.strip() for line in f if line.strip()]
     except IOError:
-        pass
+        return []
+
+def writeAddresses(addresses):
+    tmp = ADDRESS_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(''.join('%s\n' % address for address in addresses))
+    os.rename(tmp, ADDRESS_FILE)
+
+def fsyncDir(path):
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PasswordStore(object):
+    """ The passwords waiting to be fetched, by VM IP
+
+    The password file holds a snapshot, the journal the changes made
+    since as '+ip=password' and '-ip' lines. Changes are queued and
+    written with one fsync per round of the event loop, see sync().
+    Once the journal holds COMPACT_ENTRIES changes it is rotated and a
+    thread writes the passwords to a new password file, which replaces
+    the old one with a rename, and then drops the rotated journal.
+    Replaying a journal over a snapshot that already has its changes
+    gives the same passwords, so a crash at any point loses nothing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journalPath = path + '.journal'
+        self.rotatedPath = self.journalPath + '.1'
+        self.passwords = {}
+        self.pending = []
+        self.entries = 0
+        self.journal = None
+        self.compactor = None
+
+    def load(self):
+        legacy = not [p for p in (self.path, self.journalPath, self.rotatedPath) if os.path.exists(p)]
+        # the password files of the servers that ran one per address
+        for path in (glob.glob(self.path + '-*') if legacy else [self.path]):
+            self.readSnapshot(path)
+        for path in (self.rotatedPath, self.journalPath):
+            self.entries += self.replay(path)
+        self.journal = open(self.journalPath, 'a')
+        if legacy and self.passwords:
+            self.compact()
+
+    def readSnapshot(self, path):
+        try:
+            with open(path) as f:
+                for line in f:
+                    if '=' not in line: continue
+                    key, value = line.strip().split('=', 1)
+                    self.passwords[key] = value
+        except IOError:
+            pass
+
+    def replay(self, path):
+        entries = 0
+        try:
+            with open(path) as f:
+                for line in f:
+                    # a line without its newline was cut short by a crash
+                    if not line.endswith('\n'): break
+                    line = line[:-1]
+                    if line.startswith('+') and '=' in line:
+                        key, value = line[1:].split('=', 1)
+                        self.passwords[key] = value
+                    elif line.startswith('-'):
+                        self.passwords.pop(line[1:], None)
+                    entries += 1
+        except IOError:
+            pass
+        return entries
+
+    def get(self, ip):
+        return self.passwords.get(ip, None)
+
+    def set(self, ip, password):
+        if not ip or not password:
+            return
+        self.passwords[ip] = password
+        self.pending.append('+%s=%s\n' % (ip, password))
+
+    def remove(self, ip):
+        if ip in self.passwords:
+            del self.passwords[ip]
+            self.pending.append('-%s\n' % ip)
 
-def savePasswordFile():
-    with lock:
+    def sync(self):
+        """ Write the queued changes to the journal and fsync it """
+        if not self.pending:
+            return
         try:
-            with file(getPasswordFile(), 'w') as f:
-                for ip in passMap:
-                    f.write('%s=%s\n' % (ip, passMap[ip]))
-            f.close()
-        except IOError, e:
+            self.journal.write(''.join(self.pending))
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        except (IOError, OSError), e:
+            syslog.syslog('serve_password: Unable to write to password journal %s' % e)
+        self.entries += len(self.pending)
+        self.pending = []
+        if self.entries >= COMPACT_ENTRIES and not self.compacting():
+            self.compact()
+
+    def compacting(self):
+        return self.compactor is not None and self.compactor.isAlive()
+
+    def compact(self):
+        self.journal.close()
+        try:
+            if os.path.exists(self.rotatedPath):
+                # the last compaction failed, its journal is still needed
+                with open(self.rotatedPath, 'a') as rotated:
+                    with open(self.journalPath) as journal:
+                        rotated.write(journal.read())
+                    rotated.flush()
+                    os.fsync(rotated.fileno())
+                os.unlink(self.journalPath)
+            else:
+                os.rename(self.journalPath, self.rotatedPath)
+        except (IOError, OSError), e:
+            syslog.syslog('serve_password: Unable to rotate password journal %s' % e)
+            self.journal = open(self.journalPath, 'a')
+            return
+        self.journal = open(self.journalPath, 'a')
+        self.entries = 0
+        self.compactor = threading.Thread(target=self.writeSnapshot, args=(dict(self.passwords),))
+        self.compactor.setDaemon(True)
+        self.compactor.start()
+
+    def writeSnapshot(self, passwords):
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                for ip in passwords:
+                    f.write('%s=%s\n' % (ip, passwords[ip]))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+            fsyncDir(self.path)
+            os.unlink(self.rotatedPath)
+        except (IOError, OSError), e:
             syslog.syslog('serve_password: Unable to save to password file %s' % e)
 
-def getPassword(ip):
-    return passMap.get(ip, None)
 
-def setPassword(ip, password):
-    if not ip or not password:
-        return
-    with lock:
-        passMap[ip] = password
+class Connection(object):
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.client = address[0]
+        self.input = ''
+        self.output = ''
+        self.continued = False
+        self.answered = False
+        self.last = time.time()
+
+    def respond(self, code, message, body):
+        self.output += 'HTTP/1.0 %s %s\r\nServer: CloudStack Password Server\r\n' \
+                       'Content-type: text/plain\r\n\r\n%s' % (code, message, body)
+        self.answered = True
 
-def removePassword(ip):
-    with lock:
-        if ip in passMap:
-            del passMap[ip]
 
+class PasswordServer(object):
+    """ Answers the requests of every address from one poll() loop """
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    pass
+    def __init__(self, store):
+        self.store = store
+        self.listeners = {}
+        self.listening = {}
+        self.failed = {}
+        self.connections = {}
+        self.poller = select.poll()
+        self.shedding = False
+        self.expired = time.time()
+        self.reload = True
+        self.running = True
+
+    def localAddresses(self):
+        return ['localhost', '127.0.0.1'] + self.listeners.keys()
+
+    def listen(self, address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.setsockopt(socket.SOL_IP, IP_FREEBIND, 1)
+            except socket.error:
+                pass
+            sock.bind((address, PORT))
+            sock.listen(128)
+            sock.setblocking(0)
+        except socket.error, e:
+            sock.close()
+            if address not in self.failed:
+                syslog.syslog('serve_password: unable to listen on %s:%s %s' % (address, PORT, e))
+            self.failed[address] = time.time()
+            return
+        self.failed.pop(address, None)
+        self.listeners[address] = sock
+        self.listening[sock.fileno()] = sock
+        self.poller.register(sock, select.POLLIN)
+        syslog.syslog('serve_password running on %s:%s' % (address, PORT))
 
+    def updateListeners(self):
+        addresses = readAddresses() or ['127.0.0.1']
+        for address in self.listeners.keys():
+            if address not in addresses:
+                sock = self.listeners.pop(address)
+                del self.listening[sock.fileno()]
+                self.poller.unregister(sock)
+                sock.close()
+                syslog.syslog('serve_password stopped listening on %s:%s' % (address, PORT))
+        for address in self.failed.keys():
+            if address not in addresses:
+                del self.failed[address]
+        for address in addresses:
+            if address not in self.listeners:
+                self.listen(address)
+        self.reload = False
 
-class PasswordRequestHandler(BaseHTTPRequestHandler):
-    server_version = 'CloudStack Password Server'
-    sys_version = '4.x'
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.send_header('Server', 'CloudStack Password Server')
-        self.end_headers()
-        requestType = self.headers.get('DomU_Request')
-        clientAddress = self.client_address[0]
+    def retryDue(self):
+        now = time.time()
+        return [a for a, last in self.failed.items() if now - last >= RETRY_INTERVAL]
+
+    def run(self):
+        while self.running:
+            if self.reload or self.retryDue():
+                self.updateListeners()
+            try:
+                events = self.poller.poll(1000)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            active = set()
+            for fd, event in events:
+                if fd in self.listening:
+                    self.accept(self.listening[fd])
+                elif fd in self.connections:
+                    connection = self.connections[fd]
+                    active.add(connection)
+                    # readable, or hung up and read to find out
+                    if event & ~select.POLLOUT:
+                        self.read(connection)
+            # nothing is acknowledged before it is on disk
+            self.store.sync()
+            for connection in active:
+                if connection.output and connection.fd in self.connections:
+                    self.write(connection)
+                if connection.fd in self.connections:
+                    self.watch(connection)
+            self.expire()
+        self.store.sync()
+
+    def accept(self, listener):
+        while True:
+            try:
+                sock, address = listener.accept()
+            except socket.error, e:
+                if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    syslog.syslog('serve_password: accept failed %s' % e)
+                return
+            if len(self.connections) >= MAX_CONNECTIONS:
+                if not self.shedding:
+                    syslog.syslog('serve_password: %s connections open, closing new ones' % MAX_CONNECTIONS)
+                    self.shedding = True
+                sock.close()
+                continue
+            self.shedding = False
+            sock.setblocking(0)
+            connection = Connection(sock, address)
+            self.connections[connection.fd] = connection
+            self.poller.register(sock, select.POLLIN)
+
+    def watch(self, connection):
+        """ Polls the connection for the request until it is answered,
+        and for room to send while the answer is not all sent """
+        events = 0
+        if not connection.answered:
+            events |= select.POLLIN
+        if connection.output:
+            events |= select.POLLOUT
+        self.poller.modify(connection.sock, events)
+
+    def read(self, connection):
+        try:
+            data = connection.sock.recv(8192)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self.close(connection)
+            return
+        connection.input += data
+        connection.last = time.time()
+        if len(connection.input) > MAX_REQUEST:
+            connection.respond(400, 'Bad Request', 'bad_request')
+            return
+        self.handle(connection)
+
+    def write(self, connection):
+        try:
+            sent = connection.sock.send(connection.output)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.close(connection)
+            return
+        connection.output = connection.output[sent:]
+        connection.last = time.time()
+        if not connection.output and connection.answered:
+            self.close(connection)
+
+    def close(self, connection):
+        if self.connections.pop(connection.fd, None):
+            self.poller.unregister(connection.fd)
+        connection.sock.close()
+
+    def expire(self):
+        now = time.time()
+        if now - self.expired < 1:
+            return
+        self.expired = now
+        deadline = now - IDLE_TIMEOUT
+        for connection in self.connections.values():
+            if connection.last < deadline:
+                self.close(connection)
+
+    def handle(self, connection):
+        head, separator, body = connection.input.partition('\r\n\r\n')
+        if not separator:
+            return
+        lines = head.split('\r\n')
+        request = lines[0].split()
+        headers = mimetools.Message(StringIO('\r\n'.join(lines[1:]) + '\r\n\r\n'))
+        if not request:
+            connection.respond(400, 'Bad Request', 'bad_request')
+        elif request[0] == 'GET':
+            self.get(connection, headers)
+        elif request[0] == 'POST':
+            try:
+                length = int(headers.get('Content-Length', 0))
+            except ValueError:
+                length = 0
+            if len(body) < length:
+                if headers.get('Expect', '').lower() == '100-continue' and not connection.continued:
+                    connection.output += 'HTTP/1.1 100 Continue\r\n\r\n'
+                    connection.continued = True
+                return
+            self.post(connection, headers, body[:length])
+        else:
+            connection.respond(501, 'Not Implemented', '')
+
+    def get(self, connection, headers):
+        requestType = headers.get('DomU_Request')
+        clientAddress = connection.client
         if requestType == 'send_my_password':
-            password = getPassword(clientAddress)
+            password = self.store.get(clientAddress)
             if not password:
-                self.wfile.write('saved_password')
+                connection.respond(200, 'OK', 'saved_password')
                 syslog.syslog('serve_password: requested password not found for %s' % clientAddress)
             else:
-                self.wfile.write(password)
+                connection.respond(200, 'OK', password)
                 syslog.syslog('serve_password: password sent to %s' % clientAddress)
         elif requestType == 'saved_password':
-            removePassword(clientAddress)
-            savePasswordFile()
-            self.wfile.write('saved_password')
+            self.store.remove(clientAddress)
+            connection.respond(200, 'OK', 'saved_password')
             syslog.syslog('serve_password: saved_password ack received from %s' % clientAddress)
         else:
-            self.send_response(400)
-            self.wfile.write('bad_request')
+            connection.respond(400, 'Bad Request', 'bad_request')
             syslog.syslog('serve_password: bad_request from IP %s' % clientAddress)
-        return
 
-    def do_POST(self):
+    def post(self, connection, headers, body):
         form = cgi.FieldStorage(
-                    fp=self.rfile,
-                    headers=self.headers,
+                    fp=StringIO(body),
+                    headers=headers,
                     environ={'REQUEST_METHOD':'POST',
-                             'CONTENT_TYPE':self.headers['Content-Type'],
+                             'CONTENT_TYPE':headers.get('Content-Type', ''),
                     })
-        self.send_response(200)
-        self.end_headers()
-        clientAddress = self.client_address[0]
-        if clientAddress not in ['localhost', '127.0.0.1', listeningAddress]:
+        clientAddress = connection.client
+        if clientAddress not in self.localAddresses():
             syslog.syslog('serve_password: non-localhost IP trying to save password: %s' % clientAddress)
-            self.send_response(403)
+            connection.respond(403, 'Forbidden', '')
             return
-        if 'ip' not in form or 'password' not in form or 'token' not in form or self.headers.get('DomU_Request') != 'save_password':
+        if 'ip' not in form or 'password' not in form or 'token' not in form or headers.get('DomU_Request') != 'save_password':
             syslog.syslog('serve_password: request trying to save password does not contain both ip and password')
-            self.send_response(403)
+            connection.respond(403, 'Forbidden', '')
             return
         token = form['token'].value
         if not checkToken(token):
             syslog.syslog('serve_password: invalid save_password token received from %s' % clientAddress)
-            self.send_response(403)
+            connection.respond(403, 'Forbidden', '')
             return
         ip = form['ip'].value
         password = form['password'].value
+        connection.respond(200, 'OK', '')
         if not ip or not password:
             syslog.syslog('serve_password: empty ip/password[%s/%s] received from savepassword' % (ip, password))
             return
         syslog.syslog('serve_password: password saved for VM IP %s' % ip)
-        setPassword(ip, password)
-        savePasswordFile()
-        return
+        self.store.set(ip, password)
 
-    def log_message(self, format, *args):
-            return
 
+def runningPid():
+    """ The pid of the running server, None if there is none. Only a pid
+    file locked by a process running this script is trusted, the pid left
+    by a server that died may belong to another process by now """
+    try:
+        with open(PID_FILE) as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                return None
+            except IOError:
+                pass
+            pid = int(f.read().strip())
+        with open('/proc/%d/cmdline' % pid) as f:
+            if 'passwd_server_ip' not in f.read():
+                return None
+        return pid
+    except (IOError, ValueError):
+        return None
+
+
+def lockPidFile(passwordServer, added):
+    """ Opens and locks the pid file, waiting for the running server to
+    exit first. Returns None if this server is stopped while it waits """
+    signalled = False
+    while passwordServer.running:
+        lock = open(PID_FILE, 'a+')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            pid = runningPid()
+            if pid and added and not signalled:
+                os.kill(pid, signal.SIGHUP)
+                signalled = True
+            # serve everything once the running server is gone
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            except IOError, e:
+                lock.close()
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+        # the server that held the lock removed the file as it exited
+        try:
+            if os.fstat(lock.fileno()).st_ino == os.stat(PID_FILE).st_ino:
+                return lock
+        except OSError:
+            pass
+        lock.close()
+    return None
+
+
+def serve():
+    addresses = readAddresses()
+    added = [a for a in sys.argv[1:] if a not in addresses]
+    if added:
+        writeAddresses(addresses + added)
+
+    store = PasswordStore(getPasswordFile())
+    passwordServer = PasswordServer(store)
+
+    def reload(signum, frame):
+        passwordServer.reload = True
 
-def serve(HandlerClass = PasswordRequestHandler,
-          ServerClass = ThreadedHTTPServer):
+    def shutdown(signum, frame):
+        passwordServer.running = False
 
-    global listeningAddress
-    if len(sys.argv) > 1:
-        listeningAddress = sys.argv[1]
+    # installed before the pid is published, a SIGHUP must not kill the server
+    signal.signal(signal.SIGHUP, reload)
+    signal.signal(signal.SIGTERM, shutdown)
 
-    server_address = (listeningAddress, 8080)
-    passwordServer = ServerClass(server_address, HandlerClass)
-    passwordServer.allow_reuse_address = True
-    sa = passwordServer.socket.getsockname()
-    initToken()
-    loadPasswordFile()
-    syslog.syslog('serve_password running on %s:%s' % (sa[0], sa[1]))
+    lock = lockPidFile(passwordServer, added)
+    if not lock:
+        return
     try:
-        passwordServer.serve_forever()
+        lock.truncate(0)
+        lock.write('%s\n' % os.getpid())
+        lock.flush()
+
+        initToken()
+        store.load()
+        passwordServer.run()
+        syslog.syslog('serve_password shutting down')
     except KeyboardInterrupt:
         syslog.syslog('serve_password shutting down')
-        passwordServer.socket.close()
+        store.sync()
     except Exception, e:
         syslog.syslog('serve_password hit exception %s -- died' % e)
-        passwordServer.socket.close()
+        store.sync()
+        sys.exit(1)
+    finally:
+        # removed while it is locked, a server waiting for the lock then
+        # finds out and locks the new file
+        try:
+            os.unlink(PID_FILE)
+        except OSError:
+            pass
+        lock.close()
 
 
 if __name__ == '__main__':
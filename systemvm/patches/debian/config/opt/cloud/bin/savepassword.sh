@@ -35,12 +35,11 @@ TOKEN=""
 if [ -f $TOKEN_FILE ]; then
     TOKEN=$(cat $TOKEN_FILE)
 fi
+# one password server listens on all the addresses in the file
+ADDRESS_FILE="/var/cache/cloud/passwd_server_addresses"
 ps aux | grep passwd_server_ip.py |grep -v grep 2>&1 > /dev/null
-if [ $? -eq 0 ]
+if [ $? -eq 0 ] && [ -s $ADDRESS_FILE ]
 then
-    ips=$(ip addr show | grep inet | awk '{print $2}')
-    for ip in $ips; do
-        server_ip=$(echo $ip | awk -F'/' '{print $1}')
-        curl --header "DomU_Request: save_password" "http://$server_ip:8080/" -F "ip=$VM_IP" -F "password=$PASSWORD" -F "token=$TOKEN" >/dev/null 2>/dev/null &
-    done
+    server_ip=$(head -n 1 $ADDRESS_FILE)
+    curl --header "DomU_Request: save_password" "http://$server_ip:8080/" -F "ip=$VM_IP" -F "password=$PASSWORD" -F "token=$TOKEN" >/dev/null 2>/dev/null &
 fi
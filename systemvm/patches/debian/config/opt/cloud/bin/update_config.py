@@ -16,45 +16,59 @@
 # specific language governing permissions and limitations
 # under the License.
 
+# merge and configure load most of cs, they are only imported when the
+# file is processed here instead of by the converge daemon
 import sys
-from merge import QueueFile
 import logging
-import subprocess
-from subprocess import PIPE, STDOUT
 import os
 import os.path
-import configure
 import json
+import socket
 
 logging.basicConfig(filename='/var/log/cloud.log', level=logging.DEBUG, format='%(asctime)s  %(filename)s %(funcName)s:%(lineno)d %(message)s')
 
-# first commandline argument should be the file to process
-if (len(sys.argv) != 2):
-    print "[ERROR]: Invalid usage"
-    sys.exit(1)
-
 # FIXME we should get this location from a configuration class
 jsonPath = "/var/cache/cloud/%s"
-jsonCmdConfigPath = jsonPath % sys.argv[1]
 currentGuestNetConfig = "/etc/cloudstack/guestnetwork.json"
-
-
-def finish_config():
+convergedSocket = "/var/run/cloud-converged.sock"
+
+
+def submit(name):
+    """ Hand a file to the converge daemon and wait for its result
+    Returns None if the daemon is not running """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(convergedSocket)
+    except socket.error:
+        sock.close()
+        return None
+    try:
+        print "[INFO] update_config.py :: Queued %s for the converge daemon" % name
+        sock.sendall(name + "\n")
+        reply = sock.makefile().readline().strip()
+    finally:
+        sock.close()
+    if not reply.isdigit():
+        print "[ERROR] update_config.py :: Converge daemon did not report a result for %s" % name
+        return 1
+    return int(reply)
+
+
+def finish_config(files):
     # Converge
-    returncode = configure.main(sys.argv)
-    sys.exit(returncode)
+    import configure
+    return configure.main([sys.argv[0]] + files)
 
 
-def process_file():
-    print "[INFO] Processing JSON file %s" % sys.argv[1]
+def process_file(name):
+    from merge import QueueFile
+    print "[INFO] Processing JSON file %s" % name
     qf = QueueFile()
-    qf.setFile(sys.argv[1])
+    qf.setFile(name)
     qf.load(None)
-    # Converge
-    finish_config()
 
 
-def is_guestnet_configured(guestnet_dict, keys):
+def is_guestnet_configured(guestnet_dict, keys, jsonCmdConfigPath):
 
     existing_keys = []
     new_eth_key = None
@@ -109,32 +123,62 @@ def is_guestnet_configured(guestnet_dict, keys):
 
     return exists
 
-if not (os.path.isfile(jsonCmdConfigPath) and os.access(jsonCmdConfigPath, os.R_OK)):
-    print "[ERROR] update_config.py :: You are telling me to process %s, but i can't access it" % jsonCmdConfigPath
-    sys.exit(1)
-
-# If the command line json file is unprocessed process it
-# This is important or, the control interfaces will get deleted!
-if os.path.isfile(jsonPath % "cmd_line.json"):
-    qf = QueueFile()
-    qf.setFile("cmd_line.json")
-    qf.load(None)
-
-# If the guest network is already configured and have the same IP, do not try to configure it again otherwise it will break
-if sys.argv[1] == "guest_network.json":
-    if os.path.isfile(currentGuestNetConfig):
-        file = open(currentGuestNetConfig)
-        guestnet_dict = json.load(file)
 
-        if not is_guestnet_configured(guestnet_dict, ['eth1', 'eth2', 'eth3', 'eth4', 'eth5', 'eth6', 'eth7', 'eth8', 'eth9']):
-            print "[INFO] update_config.py :: Processing Guest Network."
-            process_file()
+def is_accessible(name):
+    jsonCmdConfigPath = jsonPath % name
+    if not (os.path.isfile(jsonCmdConfigPath) and os.access(jsonCmdConfigPath, os.R_OK)):
+        print "[ERROR] update_config.py :: You are telling me to process %s, but i can't access it" % jsonCmdConfigPath
+        return False
+    return True
+
+
+def merge_file(name):
+    """ Merge a queued file into its databag, without converging """
+    from merge import QueueFile
+    jsonCmdConfigPath = jsonPath % name
+
+    # If the command line json file is unprocessed process it
+    # This is important or, the control interfaces will get deleted!
+    if os.path.isfile(jsonPath % "cmd_line.json"):
+        qf = QueueFile()
+        qf.setFile("cmd_line.json")
+        qf.load(None)
+
+    # If the guest network is already configured and have the same IP, do not try to configure it again otherwise it will break
+    if name == "guest_network.json":
+        if os.path.isfile(currentGuestNetConfig):
+            file = open(currentGuestNetConfig)
+            guestnet_dict = json.load(file)
+
+            if not is_guestnet_configured(guestnet_dict, ['eth1', 'eth2', 'eth3', 'eth4', 'eth5', 'eth6', 'eth7', 'eth8', 'eth9'], jsonCmdConfigPath):
+                print "[INFO] update_config.py :: Processing Guest Network."
+                process_file(name)
+            else:
+                print "[INFO] update_config.py :: No need to process Guest Network."
         else:
-            print "[INFO] update_config.py :: No need to process Guest Network."
-            finish_config()
+            print "[INFO] update_config.py :: No GuestNetwork configured yet. Configuring first one now."
+            process_file(name)
     else:
-        print "[INFO] update_config.py :: No GuestNetwork configured yet. Configuring first one now."
-        process_file()
-else:
-    print "[INFO] update_config.py :: Processing incoming file => %s" % sys.argv[1]
-    process_file()
+        print "[INFO] update_config.py :: Processing incoming file => %s" % name
+        process_file(name)
+
+
+def main(argv):
+    # first commandline argument should be the file to process
+    if (len(argv) != 2):
+        print "[ERROR]: Invalid usage"
+        sys.exit(1)
+
+    if not is_accessible(argv[1]):
+        sys.exit(1)
+
+    # Hand the file to the converge daemon when it is running
+    returncode = submit(argv[1])
+    if returncode is not None:
+        sys.exit(returncode)
+
+    merge_file(argv[1])
+    sys.exit(finish_config([argv[1]]))
+
+if __name__ == "__main__":
+    main(sys.argv)
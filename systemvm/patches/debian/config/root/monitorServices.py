@@ -16,16 +16,37 @@
 # specific language governing permissions and limitations
 # under the License.
 
-
-
-
+# Watches the services in /etc/monitor.conf and restarts the ones that die.
+#
+# Cron starts this every few minutes; it keeps running and the runs that
+# find it alive exit at once. Each service is tracked by a pidfd where the
+# kernel has them, which tells the moment the process exits, and by
+# reading /proc every second otherwise. Health checks and restarts run as
+# child processes with timeouts, so a hung service or init script only
+# holds up its own service. Failed restarts are retried with exponential
+# backoff. Detection to restart latencies are kept in Config.METRICS_FILE.
+#
+# A section of the config file looks like
+#   [ssh]
+#   processname=sshd
+#   servicename=ssh
+#   pidfile=/var/run/sshd.pid
+#   healthcheck=<optional command, exit status 0 when healthy>
 
 from ConfigParser import SafeConfigParser
-from subprocess import *
 from os import path
-import time
-import os
+import ctypes
+import errno
+import fcntl
+import json
 import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import syslog
+import time
 
 class StatusCodes:
     SUCCESS      = 0
@@ -42,15 +63,33 @@ class Log:
     NOTIF = 'NOTIF'
 
 class Config:
-    MONIT_AFTER_MINS = 30
+    CONFIG_FILE = '/etc/monitor.conf'
+    PID_FILE = '/var/run/monitorServices.pid'
+    METRICS_FILE = '/var/run/monitorServices.json'
+    MONITOR_LOG = '/var/log/routerServiceMonitor.log'
+    RESTART_COMMAND = 'service %s restart'
+    # Seconds between /proc checks of processes without a pidfd
     SLEEP_SEC = 1
-    RETRY_ITERATIONS = 10
-    RETRY_FOR_RESTART = 5
-    MONITOR_LOG = '/var/log/monitor.log'
-    UNMONIT_PS_FILE = '/etc/unmonit_psList.txt'
+    # A process found down is looked for again after this before a restart
+    CONFIRM_SEC = 1
+    PROBE_INTERVAL = 30
+    PROBE_TIMEOUT = 10
+    RESTART_TIMEOUT = 60
+    BACKOFF_MIN = 5
+    MONIT_AFTER_MINS = 30
+
+# Service states
+UNKNOWN = 'unknown'
+RUNNING = 'running'
+DOWN = 'down'
+RESTARTING = 'restarting'
+STARTING = 'starting'
+BACKOFF = 'backoff'
 
+NR_PIDFD_OPEN = 434
 
-def getConfig( config_file_path = "/etc/monitor.conf" ):
+
+def getConfig( config_file_path = Config.CONFIG_FILE ):
     """
     Reads the process configuration from the config file.
     Config file contains the processes to be monitored.
@@ -66,7 +105,6 @@ def getConfig( config_file_path = "/etc/monitor.conf" ):
 
         for name, value in parser.items(section):
             process_dict[section][name] = value
-#           printd (" %s = %r" % (name, value))
 
     return  process_dict
 
@@ -74,314 +112,362 @@ def printd (msg):
     """
     prints the debug messages
     """
-
-    #for debug
-    #print msg
-    return 0
-
-    f= open(Config.MONITOR_LOG,'r+')
-    f.seek(0, 2)
-    f.write(str(msg)+"\n")
-    f.close()
+    logging.debug(msg)
 
 def raisealert(severity, msg, process_name=None):
     """ Writes the alert message"""
 
-    #timeStr=str(time.ctime())
     if process_name is not None:
-        log = '['+severity +']'+" " + '['+process_name+']' + " " + msg +"\n"
+        log = '['+severity +']'+" " + '['+process_name+']' + " " + msg
     else:
-        log = '['+severity+']' + " " + msg +"\n"
+        log = '['+severity+']' + " " + msg
 
-    logging.basicConfig(level=logging.INFO,filename='/var/log/routerServiceMonitor.log',format='%(asctime)s %(message)s')
     logging.info(log)
-    msg = 'logger -t monit '+ log
-    pout = Popen(msg, shell=True, stdout=PIPE)
-
-
-def isPidMatchPidFile(pidfile, pids):
-    """ Compares the running process pid with the pid in pid file.
-        If a process with multiple pids then it matches with pid file
-    """
+    syslog.syslog(log)
 
-    if pids is None or isinstance(pids,list) != True or len(pids) == 0:
-        printd ("Invalid Arguments")
-        return StatusCodes.FAILED
-    if not path.isfile(pidfile):
-        #It seems there is no pid file for this service
-        printd("The pid file "+pidfile+" is not there for this process")
-        return StatusCodes.FAILED
 
-    fd=None
+def readPid(pidfile):
     try:
-        fd = open(pidfile,'r')
-    except:
-        printd("pid file: "+ pidfile +" open failed")
-        return StatusCodes.FAILED
-
-
-    inp = fd.read()
-
-    if not inp:
-        fd.close()
-        return StatusCodes.FAILED
-
-    printd("file content "+str(inp))
-    printd(pids)
-    tocheck_pid  =  inp.strip()
-    for item in pids:
-        if str(tocheck_pid) ==  item.strip():
-            printd("pid file matched")
-            fd.close()
-            return StatusCodes.SUCCESS
-
-    fd.close()
-    return StatusCodes.FAILED
-
-def checkProcessRunningStatus(process_name, pidFile):
-    printd("checking the process " + process_name)
-    cmd = ''
-    pids = []
-    cmd = 'pidof ' + process_name
-    printd(cmd)
-
-    #cmd = 'service ' + process_name + ' status'
-    pout = Popen(cmd, shell=True, stdout=PIPE)
-    exitStatus = pout.wait()
-    temp_out = pout.communicate()[0]
-
-    #check there is only one pid or not
-    if exitStatus == 0:
-        pids = temp_out.split(' ')
-        printd("pid(s) of process %s are %s " %(process_name, pids))
-
-        #there is more than one process so match the pid file
-        #if not matched set pidFileMatched=False
-        printd("Checking pid file")
-        if isPidMatchPidFile(pidFile, pids) == StatusCodes.SUCCESS:
-            return True,pids
-
-    printd("pid of exit status %s" %exitStatus)
-
-    return False,pids
-
-def restartService(service_name):
-
-    cmd = 'service ' + service_name + ' restart'
-    cout = Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-    return_val = cout.wait()
-
-    if return_val == 0:
-        printd("The service " + service_name +" recovered successfully ")
-        msg="The process " +service_name+" is recovered successfully "
-        raisealert(Log.INFO,msg,service_name)
-        return True
-    else:
-        printd("process restart failed ....")
-
-    return False
-
-
+        with open(pidfile) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError, TypeError):
+        return None
 
-def checkProcessStatus( process ):
-    """
-    Check the process running status, if not running tries to restart
-    """
-    process_name = process.get('processname')
-    service_name = process.get('servicename')
-    pidfile = process.get('pidfile')
-    #temp_out = None
-    restartFailed=False
-    pidFileMatched=False
-    pids=''
-    cmd=''
-    if process_name is None:
-        printd ("\n Invalid Process Name")
-        return StatusCodes.INVALID_INP
-
-    status, pids = checkProcessRunningStatus(process_name, pidfile)
-
-    if status == True:
-        printd("The process is running ....")
-        return  StatusCodes.RUNNING
-    else:
-        printd("Process %s is not running trying to recover" %process_name)
-        #Retry the process state for few seconds
-
-        for i in range(1, Config.RETRY_ITERATIONS):
-            time.sleep(Config.SLEEP_SEC)
-
-            if i < Config.RETRY_FOR_RESTART: # this is just for trying few more times
-
-                status, pids = checkProcessRunningStatus(process_name, pidfile)
-                if status == True:
-                    raisealert(Log.ALERT, "The process detected as running", process_name)
-                    break
-                else:
-                    printd("Process %s is not running checking the status again..." %process_name)
+def processMatches(pid, process_name):
+    """ True if pid is a process pidof process_name would report """
+    try:
+        with open('/proc/%s/cmdline' % pid) as f:
+            argv = f.read().split('\0')
+        with open('/proc/%s/stat' % pid) as f:
+            stat = f.read()
+    except IOError:
+        return False
+    # a zombie has exited already
+    if stat[stat.rfind(')') + 2:].startswith('Z'):
+        return False
+    comm = stat[stat.find('(') + 1:stat.rfind(')')]
+    return path.basename(argv[0]) == process_name or comm == process_name[:15]
+
+def pidsOf(process_name):
+    return [int(pid) for pid in os.listdir('/proc') if pid.isdigit() and processMatches(pid, process_name)]
+
+
+class PidTracker:
+    """ Opens pidfds, which become readable when their process exits """
+
+    def __init__(self):
+        self.syscall = None
+        try:
+            self.syscall = ctypes.CDLL(None, use_errno=True).syscall
+        except (OSError, AttributeError):
+            pass
+
+    def open(self, pid):
+        """ A pidfd of pid, None where the kernel has no pidfds """
+        if self.syscall is None:
+            return None
+        fd = self.syscall(NR_PIDFD_OPEN, pid, 0)
+        if fd < 0:
+            if ctypes.get_errno() in (errno.ENOSYS, errno.EPERM):
+                printd("No pidfds, watching /proc instead")
+                self.syscall = None
+            return None
+        return fd
+
+
+class Service:
+    """ The state of one monitored service """
+
+    def __init__(self, name, properties):
+        self.name = name
+        self.update(properties)
+        self.state = UNKNOWN
+        self.pid = None
+        self.pidfd = None
+        # time the service was found down, None while it is up
+        self.detected = None
+        self.due = 0
+        self.nextProbe = 0
+        self.failures = 0
+        # [kind, Popen, deadline] of the running check or restart
+        self.action = None
+        self.metrics = {'detections': 0, 'restarts': 0, 'failed_restarts': 0,
+                        'last_latency': None, 'max_latency': None, 'total_latency': 0.0}
+
+    def update(self, properties):
+        self.processName = properties.get('processname')
+        self.serviceName = properties.get('servicename')
+        self.pidFile = properties.get('pidfile')
+        self.healthCheck = properties.get('healthcheck')
+
+    def closePidfd(self):
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+
+class Watchdog:
+    """ Watches every configured service from one loop """
+
+    def __init__(self, configFile=None):
+        self.configFile = configFile or Config.CONFIG_FILE
+        self.configStamp = None
+        self.services = {}
+        self.tracker = PidTracker()
+        self.running = True
+
+    def loadConfig(self):
+        try:
+            stamp = os.stat(self.configFile).st_mtime
+        except OSError:
+            stamp = None
+        if stamp == self.configStamp:
+            return
+        self.configStamp = stamp
+        processes = getConfig(self.configFile) if stamp is not None else {}
+        for name in self.services.keys():
+            if name not in processes:
+                service = self.services.pop(name)
+                self.stopAction(service)
+                service.closePidfd()
+        for name, properties in processes.items():
+            if not properties.get('processname'):
+                printd("Invalid process name for %s" % name)
+                continue
+            if name in self.services:
+                self.services[name].update(properties)
+            else:
+                self.services[name] = Service(name, properties)
+        printd("Watching %s" % ", ".join(sorted(self.services)))
+
+    def run(self):
+        while self.running:
+            self.loadConfig()
+            now = time.time()
+            for service in self.services.values():
+                try:
+                    self.step(service, now)
+                except Exception:
+                    # one broken service must not stop the watch of the others
+                    logging.exception("Checking %s failed" % service.name)
+            pidfds = dict((s.pidfd, s) for s in self.services.values() if s.pidfd is not None)
+            timeout = Config.SLEEP_SEC
+            for service in self.services.values():
+                if service.action:
+                    timeout = min(timeout, 0.1)
+                elif service.state in (DOWN, STARTING, BACKOFF):
+                    timeout = min(timeout, max(service.due - now, 0))
+                elif service.state == RUNNING and service.healthCheck:
+                    timeout = min(timeout, max(service.nextProbe - now, 0))
+            try:
+                readable = select.select(pidfds.keys(), [], [], timeout)[0]
+            except select.error, e:
+                if e[0] == errno.EINTR:
                     continue
+                raise
+            for fd in readable:
+                self.lost(pidfds[fd], time.time(), 'exited')
+        for service in self.services.values():
+            self.stopAction(service)
+            service.closePidfd()
+
+    def step(self, service, now):
+        if service.action:
+            self.checkAction(service, now)
+        elif service.state == RUNNING:
+            if service.pidfd is None and not processMatches(service.pid, service.processName):
+                self.lost(service, now, 'is not running')
+            elif service.healthCheck and now >= service.nextProbe:
+                self.startAction(service, 'probe', service.healthCheck, Config.PROBE_TIMEOUT, now)
+        elif service.state == UNKNOWN:
+            if self.track(service):
+                printd("Process %s is running as %s" % (service.processName, service.pid))
             else:
-                msg="The process " +process_name+" is not running trying recover "
-                raisealert(Log.INFO,process_name,msg)
-
-                if service_name == 'apache2':
-                    # Killing apache2 process with this the main service will not start
-                    for pid in pids:
-                        cmd = 'kill -9 '+pid
-                        printd(cmd)
-                        Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-
-                if restartService(service_name) == True:
-                    break
+                self.lost(service, now, 'is not running')
+        elif now >= service.due:
+            state = service.state
+            if self.track(service):
+                if state == DOWN:
+                    raisealert(Log.ALERT, "The process detected as running", service.processName)
+                    service.detected = None
                 else:
-                    restartFailed = True
-                    continue
-        #for end here
-
-        if restartFailed == True:
-            msg="The process %s recover failed "%process_name
-            raisealert(Log.ALERT,process_name,msg)
-
-            printd("Restart failed after number of retries")
-            return StatusCodes.STOPPED
-
-    return  StatusCodes.RUNNING
-
-
-def monitProcess( processes_info ):
-    """
-    Monitors the processes which got from the config file
-    """
-    if len( processes_info ) == 0:
-        printd("Invalid Input")
-        return  StatusCodes.INVALID_INP
-
-    dict_unmonit={}
-    umonit_update={}
-    unMonitPs=False
-
-    if not path.isfile(Config.UNMONIT_PS_FILE):
-        printd('Unmonit File not exist')
-    else:
-        #load the dictionary with unmonit process list
-        dict_unmonit = loadPsFromUnMonitFile()
-
-    #time for noting process down time
-    csec = repr(time.time()).split('.')[0]
-
-    for process,properties in processes_info.items():
-        #skip the process it its time stamp less than Config.MONIT_AFTER_MINS
-        printd ("checking the service %s \n" %process)
-
-        if not is_emtpy(dict_unmonit):
-            if dict_unmonit.has_key(process):
-                ts = dict_unmonit[process]
-
-                if checkPsTimeStampForMonitor (csec, ts, properties) == False:
-                    unMonitPs = True
-                    continue
-
-        if checkProcessStatus( properties) != StatusCodes.RUNNING:
-            printd( "\n Service %s is not Running"%process)
-            #add this process into unmonit list
-            printd ("updating the service for unmonit %s\n" %process)
-            umonit_update[process]=csec
-
-    #if dict is not empty write to file else delete it
-    if not is_emtpy(umonit_update):
-        writePsListToUnmonitFile(umonit_update)
-    else:
-        if is_emtpy(umonit_update) and unMonitPs == False:
-            #delete file it is there
-            removeFile(Config.UNMONIT_PS_FILE)
-
-
-def checkPsTimeStampForMonitor(csec,ts, process):
-    printd("Time difference=%s" %str(int(csec) - int(ts)))
-    tmin = (int(csec) - int(ts) )/60
-
-    if ( int(csec) - int(ts) )/60 < Config.MONIT_AFTER_MINS:
-        raisealert(Log.ALERT, "The %s get monitor after %s minutes " %(process, Config.MONIT_AFTER_MINS))
-        printd('process will be monitored after %s min' %(str(int(Config.MONIT_AFTER_MINS) - tmin)))
-        return False
-
-    return  True
-
-def removeFile(fileName):
-    if path.isfile(fileName):
-        printd("Removing the file %s" %fileName)
-        os.remove(fileName)
-
-def loadPsFromUnMonitFile():
-
-    dict_unmonit = {}
-
-    try:
-        fd = open(Config.UNMONIT_PS_FILE)
-    except:
-        printd("Failed to open file %s " %(Config.UNMONIT_PS_FILE))
-        return StatusCodes.FAILED
-
-    ps = fd.read()
-
-    if not ps:
-        printd("File %s content is empty " %Config.UNMONIT_PS_FILE)
-        return StatusCodes.FAILED
-
-    printd(ps)
-    plist = ps.split(',')
-    plist.remove('')
-    for i in plist:
-        dict_unmonit[i.split(':')[0]] = i.split(':')[1]
-
-    fd.close()
-
-    return dict_unmonit
-
-
-def writePsListToUnmonitFile(umonit_update):
-    printd("Write updated unmonit list to file")
-    line=''
-    for i in umonit_update:
-        line+=str(i)+":"+str(umonit_update[i])+','
-    printd(line)
-    try:
-        fd=open(Config.UNMONIT_PS_FILE,'w')
-    except:
-        printd("Failed to open file %s " %Config.UNMONIT_PS_FILE)
-        return StatusCodes.FAILED
-
-    fd.write(line)
-    fd.close()
-
-
-def is_emtpy(struct):
-    """
-    Checks wether the given struct is empty or not
-    """
-    if struct:
-        return False
-    else:
+                    self.recovered(service, now)
+            elif state == STARTING:
+                self.failed(service, now, 'not running after the restart')
+            else:
+                self.restart(service, now)
+
+    def track(self, service):
+        """ Find the process of the service, True if it runs """
+        pid = readPid(service.pidFile)
+        if pid is None or not processMatches(pid, service.processName):
+            return False
+        if pid != service.pid or service.pidfd is None:
+            service.closePidfd()
+            service.pid = pid
+            service.pidfd = self.tracker.open(pid)
+            # the pid may have been reused before the pidfd was opened
+            if not processMatches(pid, service.processName):
+                service.closePidfd()
+                return False
+        service.state = RUNNING
+        service.nextProbe = time.time() + Config.PROBE_INTERVAL
         return True
 
+    def lost(self, service, now, reason):
+        service.closePidfd()
+        if service.state not in (UNKNOWN, RUNNING):
+            return
+        printd("Process %s %s" % (service.processName, reason))
+        service.state = DOWN
+        service.detected = now
+        service.due = now + Config.CONFIRM_SEC
+        service.metrics['detections'] += 1
+
+    def restart(self, service, now):
+        raisealert(Log.INFO, "The process " + service.processName + " is not running trying recover", service.name)
+        if service.serviceName == 'apache2':
+            # Killing apache2 process with this the main service will not start
+            for pid in pidsOf(service.processName):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        service.state = RESTARTING
+        self.startAction(service, 'restart', Config.RESTART_COMMAND % service.serviceName,
+                         Config.RESTART_TIMEOUT, now)
+
+    def recovered(self, service, now):
+        latency = now - service.detected
+        metrics = service.metrics
+        metrics['restarts'] += 1
+        metrics['last_latency'] = round(latency, 3)
+        metrics['max_latency'] = round(max(latency, metrics['max_latency'] or 0), 3)
+        metrics['total_latency'] += latency
+        raisealert(Log.INFO, "The process %s is recovered successfully %.2f seconds after it was found down"
+                   % (service.processName, latency), service.name)
+        service.detected = None
+        service.failures = 0
+        self.writeMetrics()
+
+    def failed(self, service, now, reason):
+        service.failures += 1
+        service.metrics['failed_restarts'] += 1
+        delay = min(Config.BACKOFF_MIN * 2 ** (service.failures - 1), Config.MONIT_AFTER_MINS * 60)
+        raisealert(Log.ALERT, "The process %s recover failed (%s), next attempt in %s seconds"
+                   % (service.processName, reason, delay), service.name)
+        service.state = BACKOFF
+        service.due = now + delay
+        self.writeMetrics()
+
+    def startAction(self, service, kind, command, timeout, now):
+        devnull = open(os.devnull, 'w')
+        try:
+            process = subprocess.Popen(command, shell=True, stdout=devnull, stderr=devnull,
+                                       close_fds=True, preexec_fn=os.setsid)
+        except OSError, e:
+            process = None
+            printd("Unable to run %s: %s" % (command, e))
+        finally:
+            devnull.close()
+        service.action = [kind, process, now + timeout]
+        if process is None:
+            service.action = None
+            self.finishAction(service, kind, 127, now)
+
+    def stopAction(self, service):
+        if service.action and service.action[1] and service.action[1].poll() is None:
+            try:
+                os.killpg(service.action[1].pid, signal.SIGKILL)
+            except OSError:
+                pass
+            service.action[1].wait()
+        service.action = None
+
+    def checkAction(self, service, now):
+        kind, process, deadline = service.action
+        status = process.poll()
+        if status is None:
+            if now < deadline:
+                return
+            printd("%s of %s timed out" % (kind, service.name))
+            self.stopAction(service)
+            status = 'timeout'
+        service.action = None
+        self.finishAction(service, kind, status, now)
+
+    def finishAction(self, service, kind, status, now):
+        if kind == 'probe':
+            if status == 0:
+                service.nextProbe = now + Config.PROBE_INTERVAL
+            else:
+                self.lost(service, now, 'failed its health check (%s)' % status)
+        elif status == 0 and self.track(service):
+            self.recovered(service, now)
+        elif status == 0:
+            # the process may still be starting, look again before giving up
+            service.state = STARTING
+            service.due = now + Config.CONFIRM_SEC
+        else:
+            self.failed(service, now, 'exit status %s' % status)
+
+    def writeMetrics(self):
+        metrics = {}
+        for name, service in self.services.items():
+            metrics[name] = dict(service.metrics)
+            metrics[name]['state'] = service.state
+            if service.metrics['restarts']:
+                metrics[name]['mean_latency'] = round(service.metrics['total_latency'] / service.metrics['restarts'], 3)
+        try:
+            tmp = Config.METRICS_FILE + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(metrics, f, indent=2, sort_keys=True)
+            os.rename(tmp, Config.METRICS_FILE)
+        except (IOError, OSError), e:
+            printd("Unable to write %s: %s" % (Config.METRICS_FILE, e))
+
+
+def daemonize():
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    os.chdir('/')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+
 def main():
     '''
-    Step1 : Get Config
+    Keeps one watchdog running, later runs from cron exit at once
     '''
+    lock = open(Config.PID_FILE, 'a+')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        return
+    if '--foreground' not in sys.argv[1:]:
+        daemonize()
+    lock.truncate(0)
+    lock.write('%s\n' % os.getpid())
+    lock.flush()
+
+    logging.basicConfig(level=logging.INFO, filename=Config.MONITOR_LOG, format='%(asctime)s %(message)s')
+    syslog.openlog('monit')
+    watchdog = Watchdog()
+
+    def stop(signum, frame):
+        watchdog.running = False
+
+    def reload(signum, frame):
+        watchdog.configStamp = None
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, reload)
     printd("monitoring started")
-    temp_dict  = getConfig()
-
-    '''
-    Step2: Monitor and Raise Alert
-    '''
-    monitProcess( temp_dict )
+    watchdog.run()
 
 if __name__ == "__main__":
     main()
-
-
-
-
-
-
-
@@ -0,0 +1,73 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import bz2
+import imp
+import os
+import unittest
+import zlib
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "../../../scripts/storage/secondary/cloud-install-sys-tmplt.py")
+installer = imp.load_source("cloud_install_sys_tmplt", SCRIPT)
+
+DATA = "".join(chr(i % 251) for i in xrange(200000)) + "\0" * 300000
+
+
+def gzip(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(extension, compressed, size=4096):
+    decompressor = installer.StreamDecompressor(extension)
+    output = []
+    for offset in xrange(0, len(compressed), size):
+        output.extend(decompressor.decompress(compressed[offset:offset + size]))
+    output.extend(decompressor.flush())
+    return "".join(output)
+
+
+class TestStreamDecompressor(unittest.TestCase):
+
+    def test_complete(self):
+        for extension, compress in (("gz", gzip), ("bz2", bz2.compress)):
+            self.assertEqual(decompress(extension, compress(DATA)), DATA)
+            self.assertEqual(decompress(extension, compress(DATA), 1 << 30), DATA)
+
+    def test_concatenated(self):
+        for extension, compress in (("gz", gzip), ("bz2", bz2.compress)):
+            compressed = compress(DATA) + compress(DATA) + "\0" * 512
+            self.assertEqual(decompress(extension, compressed), DATA + DATA)
+
+    def test_truncated(self):
+        for extension, compress in (("gz", gzip), ("bz2", bz2.compress)):
+            compressed = compress(DATA)
+            for end in (0, 100, len(compressed) / 2, len(compressed) - 1):
+                self.assertRaises(IOError, decompress, extension, compressed[:end])
+            concatenated = compressed + compressed
+            self.assertRaises(IOError, decompress, extension, concatenated[:-4])
+
+    def test_corrupt(self):
+        for extension, compress in (("gz", gzip), ("bz2", bz2.compress)):
+            compressed = compress(DATA)
+            corrupt = compressed[:-8] + "\xff" * 8
+            self.assertRaises((IOError, zlib.error), decompress, extension, corrupt)
+
+
+if __name__ == "__main__":
+    unittest.main()
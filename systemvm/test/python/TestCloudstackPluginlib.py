@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# Runs the VPC flow programming of the plugin library against fake xe,
+# ovs-vsctl and ovs-ofctl commands that keep the flow table in a file and
+# count the flows installed and removed.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../../scripts/vm/hypervisor/xenserver"))
+try:
+    import cloudstack_pluginlib as lib
+except ImportError:
+    # simplejson is part of the XenServer dom0 the plugins run in
+    lib = None
+
+FAKE_OFCTL = """#!%(python)s
+import json, os, re, sys
+
+STATE = %(state)r
+STATS = ("cookie", "duration", "n_packets", "n_bytes", "idle_age", "hard_age")
+PROTOCOLS = {"6": "tcp", "17": "udp", "1": "icmp"}
+
+def canonical(flow):
+    parts = flow.strip().split("actions=", 1)
+    table, priority, match = "0", "32768", []
+    for token in [t for t in re.split("[ ,]+", parts[0]) if t]:
+        name, _, value = token.partition("=")
+        if name in STATS or value == "*":
+            continue
+        if name == "table":
+            table = value
+        elif name == "priority":
+            priority = value
+        elif name in ("nw_src", "nw_dst") and value.endswith("/32"):
+            match.append(name + "=" + value[:-3])
+        else:
+            match.append(token.lower())
+    proto = [t for t in match if t.startswith("nw_proto=")]
+    if "ip" in match and proto and proto[0][9:] in PROTOCOLS:
+        match = [t for t in match if t not in ("ip", proto[0])] + [PROTOCOLS[proto[0][9:]]]
+    actions = ""
+    if len(parts) == 2:
+        actions = parts[1].strip().lower()
+    return [table, priority, sorted(match), actions]
+
+def key(flow):
+    return "%%s/%%s/%%s" %% (flow[0], flow[1], ",".join(flow[2]))
+
+state = json.load(open(STATE))
+flows = state["flows"]
+args = [a for a in sys.argv[1:] if a not in ("-O", "OpenFlow14")]
+if args[0] == "--bundle":
+    state["commands"].append("bundle")
+    if not state["bundle"]:
+        json.dump(state, open(STATE, "w"))
+        sys.stderr.write("OFPT_ERROR: bundles are not supported\\n")
+        sys.exit(1)
+    args = args[1:]
+strict = args[0] == "--strict"
+if strict:
+    args = args[1:]
+command = args[0]
+state["commands"].append(command)
+
+def install(flow):
+    flows[key(flow)] = flow
+    state["installed"] += 1
+
+def remove(k):
+    del flows[k]
+    state["removed"] += 1
+
+def fail(message):
+    json.dump(state, open(STATE, "w"))
+    sys.stderr.write("ovs-ofctl: %%s\\n" %% message)
+    sys.exit(1)
+
+if command == "dump-flows":
+    for flow in flows.values():
+        print " cookie=0x0, duration=1.5s, table=%%s, n_packets=0, n_bytes=0, idle_age=1, priority=%%s,%%s actions=%%s" %% (
+            flow[0], flow[1], ",".join(flow[2]), flow[3])
+elif command == "add-flows":
+    for line in open(args[2]):
+        if not line.strip():
+            continue
+        verb = "add"
+        if line.split()[0] in ("add", "delete_strict"):
+            verb, line = line.split(None, 1)
+        flow = canonical(line)
+        if verb == "add":
+            install(flow)
+        else:
+            remove(key(flow))
+elif command == "del-flows" and args[2] == "-":
+    # flows are only read from the standard input
+    for line in sys.stdin:
+        if line.strip():
+            remove(key(canonical(line)))
+elif command == "del-flows":
+    for token in args[2].split(","):
+        if "=" not in token:
+            fail("%%s: unknown keyword" %% token)
+    table = args[2].split("=")[1]
+    for k, flow in flows.items():
+        if flow[0] == table:
+            remove(k)
+json.dump(state, open(STATE, "w"))
+"""
+
+FAKE_XE = """#!/bin/sh
+cat %(vifs)s
+"""
+
+FAKE_VSCTL = """#!/bin/sh
+cat %(interfaces)s
+"""
+
+
+class FakeSwitch(object):
+
+    def __init__(self, vms):
+        self.folder = tempfile.mkdtemp()
+        self.state = os.path.join(self.folder, "state")
+        self.reset(True)
+
+        vifs = []
+        interfaces = []
+        for vm in range(vms):
+            vifs.append("uuid ( RO)         : vif-%d\n    MAC ( RO): %s\n    other-config (MRW): cloudstack-network-id: net%d\n" %
+                        (vm, mac(vm), vm % 4))
+            interfaces.append(["vif%d.0" % (vm + 1), vm + 10, ["map", [["xs-vif-uuid", "vif-%d" % vm]]], ["map", []]])
+        self.write("vifs", "\n\n".join(vifs))
+        self.write("interfaces", json.dumps({"headings": ["name", "ofport", "external_ids", "options"], "data": interfaces}))
+
+        paths = {"python": sys.executable, "state": self.state,
+                 "vifs": os.path.join(self.folder, "vifs"), "interfaces": os.path.join(self.folder, "interfaces")}
+        lib.OFCTL_PATH = self.write("ovs-ofctl", FAKE_OFCTL % paths, 0755)
+        lib.XE_PATH = self.write("xe", FAKE_XE % paths, 0755)
+        lib.VSCTL_PATH = self.write("ovs-vsctl", FAKE_VSCTL % paths, 0755)
+        lib.OFSPEC_DIR = self.folder
+
+    def write(self, name, data, mode=0644):
+        path = os.path.join(self.folder, name)
+        f = open(path, "w")
+        f.write(data)
+        f.close()
+        os.chmod(path, mode)
+        return path
+
+    def reset(self, bundle, flows=None):
+        state = {"flows": flows or {}, "installed": 0, "removed": 0, "commands": [], "bundle": bundle}
+        json.dump(state, open(self.state, "w"))
+
+    def get(self):
+        return json.load(open(self.state))
+
+    def cleanup(self):
+        shutil.rmtree(self.folder)
+
+
+def mac(vm):
+    return "06:00:00:00:%02x:%02x" % (vm / 256, vm % 256)
+
+
+def topology(vms):
+    tiers = [{"networkuuid": "net%d" % tier, "gatewaymac": "06:ff:00:00:00:%02x" % tier,
+              "cidr": "10.%d.0.0/16" % tier, "grekey": 100 + tier} for tier in range(4)]
+    nics = [{"hostid": 1, "nics": [{"macaddress": mac(vm), "ipaddress": "10.%d.%d.%d" % (vm % 4, vm / 256, vm % 256),
+                                    "networkuuid": "net%d" % (vm % 4)}]} for vm in vms]
+    return json.dumps({"vpc": {"cidr": "10.0.0.0/8", "hosts": [{"hostid": 1, "ipaddress": "192.168.0.1"}],
+                               "tiers": tiers, "vms": nics}})
+
+
+@unittest.skipIf(lib is None, "the plugin library needs simplejson")
+class TestVpcFlows(unittest.TestCase):
+
+    VMS = 1000
+
+    def setUp(self):
+        self.switch = FakeSwitch(self.VMS)
+
+    def tearDown(self):
+        self.switch.cleanup()
+
+    def configure(self, vms, sequence):
+        lib.configure_vpc_bridge_for_network_topology("xapi1", "1", topology(vms), str(sequence))
+        return self.switch.get()
+
+    def test_topology_update_applies_only_the_delta(self):
+        state = self.configure(range(self.VMS), 1)
+        # 4 flows per nic, 2 of them in the lookup tables, and 2 defaults
+        self.assertEqual(4 * self.VMS + 2, state["installed"])
+        self.assertEqual(0, state["removed"])
+
+        self.switch.reset(True, state["flows"])
+        state = self.configure(range(self.VMS), 2)
+        self.assertEqual(0, state["installed"])
+        self.assertEqual(0, state["removed"])
+        self.assertEqual(["dump-flows"], state["commands"])
+
+        # one vm moves away
+        self.switch.reset(True, state["flows"])
+        state = self.configure(range(1, self.VMS), 3)
+        self.assertEqual(0, state["installed"])
+        self.assertEqual(2, state["removed"])
+        self.assertTrue("bundle" in state["commands"])
+
+    def test_delta_without_bundles(self):
+        state = self.configure(range(10), 1)
+        flows = state["flows"]
+        for k, flow in flows.items():
+            if flow[0] == "1" and flow[3].startswith("output:11"):
+                flow[3] = "output:99"
+        self.switch.reset(True, flows)
+        bundled = self.configure(range(1, 10), 2)
+
+        self.switch.reset(False, flows)
+        state = self.configure(range(1, 10), 2)
+        self.assertEqual(["dump-flows", "bundle", "add-flows", "del-flows"], state["commands"])
+        # the changed flow is replaced by its add, only the flows of vm 0 are deleted
+        self.assertEqual(1, state["installed"])
+        self.assertEqual(2, state["removed"])
+        self.assertEqual(bundled["flows"], state["flows"])
+
+    def test_changed_flow_is_replaced(self):
+        state = self.configure(range(10), 1)
+        flows = state["flows"]
+        for k, flow in flows.items():
+            if flow[0] == "1" and flow[3].startswith("output:10"):
+                flow[3] = "output:99"
+        self.switch.reset(True, flows)
+        state = self.configure(range(10), 2)
+        self.assertEqual(1, state["installed"])
+        self.assertEqual(1, state["removed"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import importlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from mock import patch
+
+# update_config logs to /var/log/cloud.log unless logging is already set up
+null = logging.NullHandler()
+logging.getLogger().addHandler(null)
+update_config = importlib.import_module("update_config")
+converged = importlib.import_module("converged")
+logging.getLogger().removeHandler(null)
+
+
+class TestConverged(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.converged = []
+        self.merged = []
+        self.patches = [patch.object(update_config, "convergedSocket", os.path.join(self.tmpdir, "converged.sock")),
+                        patch.object(update_config, "is_accessible", side_effect=lambda name: name != "missing.json"),
+                        patch.object(update_config, "merge_file", side_effect=self.merge_file),
+                        patch.object(update_config, "finish_config", side_effect=self.finish_config)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.tmpdir, True)
+
+    def merge_file(self, name):
+        if name == "broken.json":
+            raise Exception("cannot merge " + name)
+        self.merged.append(name)
+
+    def finish_config(self, files):
+        self.converged.append(files)
+        return 3
+
+    def start_daemon(self):
+        daemon = converged.ConvergeDaemon(update_config.convergedSocket)
+        server = threading.Thread(target=daemon.serve)
+        server.daemon = True
+        server.start()
+        for i in range(100):
+            if os.path.exists(update_config.convergedSocket):
+                return
+            time.sleep(0.01)
+        self.fail("converge daemon did not start")
+
+    def submit_all(self, names):
+        results = {}
+
+        def submit(name):
+            results[name] = update_config.submit(name)
+        clients = [threading.Thread(target=submit, args=(name,)) for name in names]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join(10)
+        return results
+
+    def test_coalesce(self):
+        self.start_daemon()
+        names = ["ips.json", "guest_network.json", "firewall_rules.json", "vm_metadata.json"]
+        results = self.submit_all(names)
+        # every client gets the result of the one converge of the burst
+        self.assertEqual(results, dict((name, 3) for name in names))
+        self.assertEqual(len(self.converged), 1)
+        self.assertEqual(sorted(self.converged[0]), sorted(names))
+        self.assertEqual(sorted(self.merged), sorted(names))
+
+    def test_failed_files(self):
+        self.start_daemon()
+        results = self.submit_all(["ips.json", "missing.json", "broken.json"])
+        self.assertEqual(results, {"ips.json": 3, "missing.json": 1, "broken.json": 1})
+        self.assertEqual(self.converged, [["ips.json"]])
+
+    def test_bursts(self):
+        self.start_daemon()
+        self.assertEqual(update_config.submit("ips.json"), 3)
+        time.sleep(converged.COALESCE * 2)
+        self.assertEqual(update_config.submit("dhcp.json"), 3)
+        self.assertEqual(self.converged, [["ips.json"], ["dhcp.json"]])
+
+    def test_without_daemon(self):
+        # without the socket the file is converged in process
+        self.assertTrue(update_config.submit("ips.json") is None)
+        try:
+            update_config.main(["update_config.py", "ips.json"])
+        except SystemExit, e:
+            self.assertEqual(e.code, 3)
+        else:
+            self.fail("update_config.main did not exit")
+        self.assertEqual(self.merged, ["ips.json"])
+        self.assertEqual(self.converged, [["ips.json"]])
+
+if __name__ == '__main__':
+    unittest.main()
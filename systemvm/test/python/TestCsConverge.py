@@ -0,0 +1,67 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import unittest
+import shutil
+import tempfile
+from cs.CsConfig import CsConfig
+from cs.CsConverge import CsConverge
+import merge
+
+
+class TestCsConverge(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        merge.DataBag.DPATH = self.path
+
+    def tearDown(self):
+        merge.DataBag.DPATH = "."
+        shutil.rmtree(self.path, True)
+
+    def save_bag(self, key, data):
+        db = merge.DataBag()
+        db.setKey(key)
+        db.load()
+        db.save(data)
+
+    def test_skip_unchanged(self):
+        config = CsConfig()
+        converge = CsConverge(config)
+        self.assertTrue(converge.begin("loadbalancer"))
+        config.get_fw().append(["filter", "", "-A INPUT -j ACCEPT"])
+        converge.end("loadbalancer")
+        converge.commit()
+
+        config = CsConfig()
+        converge = CsConverge(config)
+        self.assertFalse(converge.begin("loadbalancer"))
+        self.assertEqual(config.get_fw(), [["filter", "", "-A INPUT -j ACCEPT"]])
+
+    def test_dependency_changed(self):
+        converge = CsConverge(CsConfig())
+        for key in ["loadbalancer", "vmdata"]:
+            converge.begin(key)
+            converge.end(key)
+        converge.commit()
+
+        self.save_bag("ips", {"id": "ips", "eth1": []})
+        converge = CsConverge(CsConfig())
+        self.assertTrue(converge.begin("loadbalancer"))
+        self.assertFalse(converge.changed("vmdata"))
+
+if __name__ == '__main__':
+    unittest.main()
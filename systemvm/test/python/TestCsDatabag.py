@@ -15,6 +15,9 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import json
+import shutil
+import tempfile
 import unittest
 from cs.CsDatabag import CsDataBag
 import merge
@@ -29,5 +32,26 @@ class TestCsDatabag(unittest.TestCase):
         csdatabag = CsDataBag("koffie")
         self.assertTrue(csdatabag is not None)
 
+    def save(self, key, dbag):
+        merge.DataBag.DPATH = tempfile.mkdtemp()
+        try:
+            bag = merge.DataBag()
+            bag.setKey(key)
+            bag.load()
+            bag.save(dbag)
+            text = open(bag.fpath).read()
+        finally:
+            shutil.rmtree(merge.DataBag.DPATH, True)
+        self.assertEqual(json.loads(text), dbag)
+        return text
+
+    def test_save_cmdline_one_key_per_line(self):
+        text = self.save("cmdline", {"id": "cmdline", "cmd_line": {"type": "router", "redundant_router": "false"}})
+        self.assertTrue('        "type": "router"\n' in text)
+
+    def test_save_compact(self):
+        text = self.save("dhcpentry", {"id": "dhcpentry", "0a010102": {"host_name": "vm1", "ipv4_adress": "10.1.1.2"}})
+        self.assertFalse("\n" in text or ", " in text or ": " in text)
+
 if __name__ == '__main__':
     unittest.main()
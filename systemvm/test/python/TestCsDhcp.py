@@ -19,6 +19,7 @@ import unittest
 import mock
 from cs.CsDhcp import CsDhcp
 from cs import CsHelper
+import cs_dhcp
 import merge
 
 
@@ -33,5 +34,44 @@ class TestCsDhcp(unittest.TestCase):
         csdhcp = CsDhcp("dhcpentry", {})
         self.assertTrue(csdhcp is not None)
 
+    def test_merge_index(self):
+        dbag = {"id": "dhcpentry"}
+        entry = {"host_name": "vm1", "mac_address": "02:00:00:00:00:01", "ipv4_adress": "10.1.1.2"}
+        cs_dhcp.merge(dbag, entry)
+        # Same host name on a new address evicts the old entry
+        moved = {"host_name": "vm1", "mac_address": "02:00:00:00:00:01", "ipv4_adress": "10.1.1.3"}
+        cs_dhcp.merge(dbag, moved)
+        self.assertEqual(sorted(dbag.keys()), ["10.1.1.3", "id", "index"])
+        self.assertEqual(dbag["index"]["host_name"], {"vm1": ["10.1.1.3"]})
+        self.assertEqual(dbag["index"]["mac_address"], {"02:00:00:00:00:01": ["10.1.1.3"]})
+        removed = {"host_name": "vm1", "mac_address": "02:00:00:00:00:01", "ipv4_adress": "10.1.1.3", "add": False}
+        cs_dhcp.merge(dbag, removed)
+        self.assertEqual(sorted(dbag.keys()), ["id", "index"])
+        self.assertEqual(dbag["index"], {"host_name": {}, "mac_address": {}})
+
+    def test_changed_entries(self):
+        csdhcp = CsDhcp("dhcpentry", {})
+        csdhcp.cloud = mock.Mock()
+        csdhcp.cloud.config = ["02:00:00:00:00:01,10.1.1.2,vm1,710h\n",
+                               "02:00:00:00:00:02,10.1.1.3,vm2,720h\n",
+                               "02:00:00:00:00:03,10.1.1.4,vm3,730h\n"]
+        csdhcp.cloud.new_config = ["02:00:00:00:00:01,10.1.1.2,vm1,740h\n",
+                                   "02:00:00:00:00:02,10.1.1.5,vm2,720h\n",
+                                   "02:00:00:00:00:04,10.1.1.4,vm4,730h\n"]
+        self.assertEqual(csdhcp.changed_entries(), {"02:00:00:00:00:02": "10.1.1.3",
+                                                    "02:00:00:00:00:03": "10.1.1.4"})
+
+    def test_stable_lease(self):
+        csdhcp = CsDhcp("dhcpentry", {})
+        csdhcp.hosts = {}
+        csdhcp.devinfo = []
+        csdhcp.cloud = mock.Mock()
+        entry = {"mac_address": "02:00:00:00:00:01", "ipv4_adress": "10.1.1.2", "host_name": "vm1", "default_gateway": "10.1.1.1"}
+        csdhcp.add(entry)
+        csdhcp.add(entry)
+        first, second = [x[0][0] for x in csdhcp.cloud.add.call_args_list]
+        self.assertEqual(first, second)
+        self.assertTrue(700 <= int(first.split(',')[3][:-1]) <= 760)
+
 if __name__ == '__main__':
     unittest.main()
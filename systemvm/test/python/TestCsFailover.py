@@ -0,0 +1,108 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from cs.CsFailover import CsFailover
+import merge
+
+
+class TestCsFailover(unittest.TestCase):
+
+    def setUp(self):
+        merge.DataBag.DPATH = "."
+        self.tmpdir = tempfile.mkdtemp()
+        self.state_file = CsFailover.STATE_FILE
+        CsFailover.STATE_FILE = os.path.join(self.tmpdir, "transitions.json")
+        self.lock = threading.Lock()
+        self.order = []
+
+    def tearDown(self):
+        CsFailover.STATE_FILE = self.state_file
+        shutil.rmtree(self.tmpdir, True)
+
+    def step(self, name, seconds=0.05):
+        time.sleep(seconds)
+        with self.lock:
+            self.order.append(name)
+
+    def test_independent_steps_overlap(self):
+        failover = CsFailover("MASTER")
+        for dev in ["eth1", "eth2", "eth3", "eth4"]:
+            failover.add("up %s" % dev, self.step, dev, 0.2, critical=True)
+        start = time.time()
+        record = failover.run()
+        self.assertTrue(time.time() - start < 0.6)
+        self.assertEqual(sorted(self.order), ["eth1", "eth2", "eth3", "eth4"])
+        self.assertEqual(sorted(record["steps"]), ["up eth1", "up eth2", "up eth3", "up eth4"])
+
+    def test_order(self):
+        failover = CsFailover("MASTER")
+        failover.add("dnsmasq", self.step, "dnsmasq", 0)
+        failover.add("up", self.step, "up", 0.1, critical=True)
+        failover.add("arping", self.step, "arping", 0.1, requires=["up"], critical=True)
+        failover.add("conntrack", self.step, "conntrack", 0, critical=True)
+        record = failover.run()
+        self.assertEqual(self.order, ["conntrack", "up", "arping", "dnsmasq"])
+        self.assertTrue(record["steps"]["dnsmasq"]["start"] >= record["critical"])
+        self.assertTrue(record["critical"] <= record["total"])
+
+    def test_failed_step(self):
+        def fail():
+            raise Exception("no such device")
+        failover = CsFailover("MASTER")
+        failover.add("up", fail, critical=True)
+        failover.add("dnsmasq", self.step, "dnsmasq")
+        record = failover.run()
+        self.assertEqual(self.order, ["dnsmasq"])
+        self.assertEqual(record["steps"]["up"]["error"], "no such device")
+        self.assertEqual(record["steps"]["dnsmasq"]["error"], None)
+
+    def test_invalid_graphs(self):
+        failover = CsFailover("MASTER")
+        failover.add("a", self.step, "a", requires=["b"])
+        failover.add("b", self.step, "b", requires=["a"])
+        self.assertRaises(ValueError, failover.run)
+        failover = CsFailover("MASTER")
+        failover.add("a", self.step, "a", requires=["c"])
+        self.assertRaises(ValueError, failover.run)
+        failover = CsFailover("MASTER")
+        failover.add("a", self.step, "a")
+        failover.add("b", self.step, "b", requires=["a"], critical=True)
+        self.assertRaises(ValueError, failover.run)
+        self.assertRaises(ValueError, failover.add, "a", self.step, "a")
+        self.assertEqual(self.order, [])
+
+    def test_state_file(self):
+        CsFailover.HISTORY = 2
+        try:
+            for state in ["MASTER", "BACKUP", "MASTER"]:
+                failover = CsFailover(state)
+                failover.add("step", self.step, state, 0)
+                failover.run()
+        finally:
+            CsFailover.HISTORY = 20
+        transitions = json.load(open(CsFailover.STATE_FILE))["transitions"]
+        self.assertEqual([t["state"] for t in transitions], ["BACKUP", "MASTER"])
+        self.assertEqual(sorted(transitions[1]["steps"]["step"]), ["critical", "duration", "error", "start"])
+
+if __name__ == '__main__':
+    unittest.main()
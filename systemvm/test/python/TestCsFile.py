@@ -15,7 +15,11 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
+from cs import CsFile as csfile_module
 from cs.CsFile import CsFile
 import merge
 
@@ -29,5 +33,42 @@ class TestCsFile(unittest.TestCase):
         csfile = CsFile("testfile")
         self.assertTrue(csfile is not None)
 
+    def test_add(self):
+        csfile = CsFile("testfile")
+        csfile.repopulate()
+        self.assertTrue(csfile.add("line1"))
+        self.assertFalse(csfile.add("line1"))
+        csfile.greplace("line1", "line2")
+        self.assertTrue(csfile.add("line1"))
+        self.assertEqual(csfile.add_all(["line1", "line2", "line3"]), 1)
+        self.assertEqual(csfile.new_config, ["line2\n", "line1\n", "line3\n"])
+
+    def test_pattern_cache_is_bounded(self):
+        csfile_module.PATTERNS.clear()
+        for i in range(csfile_module.MAX_PATTERNS + 10):
+            csfile_module.pattern("^10\\.1\\.%s\\.1 " % i)
+        self.assertTrue(len(csfile_module.PATTERNS) <= csfile_module.MAX_PATTERNS)
+        self.assertTrue(csfile_module.pattern("^a").match("a"))
+
+    def test_commit(self):
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, "file")
+            csfile = CsFile(filename)
+            csfile.add_all(["a", "b"])
+            self.assertTrue(csfile.is_changed())
+            csfile.commit()
+            self.assertEqual(open(filename).read(), "a\nb\n")
+
+            csfile = CsFile(filename)
+            csfile.repopulate()
+            csfile.add_all(["b", "a"])
+            self.assertTrue(csfile.is_changed())
+            csfile.commit()
+            self.assertEqual(open(filename).read(), "b\na\n")
+            self.assertEqual(os.listdir(path), ["file"])
+        finally:
+            shutil.rmtree(path, True)
+
 if __name__ == '__main__':
     unittest.main()
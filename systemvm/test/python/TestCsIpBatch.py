@@ -0,0 +1,135 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from mock import patch
+from netaddr import IPNetwork
+from cs import CsKernel
+# CsStaticRoutes and CsRedundant import each other, CsRedundant has to come first
+from cs.CsRedundant import CsRedundant
+from cs.CsAddress import CsIP
+from cs.CsConfig import CsConfig
+from cs.CsIpBatch import CsIpBatch
+from cs.CsRoute import CsRoute
+from cs.CsRule import CsRule
+from cs.CsStaticRoutes import CsStaticRoutes
+import merge
+
+# Records its input and fails the lines containing "bad" the way ip -force -batch does
+FAKE_IP = """#!/bin/sh
+echo run >> "$(dirname "$0")/runs"
+cat > "$(dirname "$0")/batch"
+grep -n bad "$(dirname "$0")/batch" | while IFS=: read n line; do
+    echo "RTNETLINK answers: Invalid argument" >&2
+    echo "Command failed -:$n" >&2
+done
+grep -q bad "$(dirname "$0")/batch" && exit 1
+exit 0
+"""
+
+
+class TestCsIpBatch(unittest.TestCase):
+
+    def setUp(self):
+        merge.DataBag.DPATH = "."
+        self.tmpdir = tempfile.mkdtemp()
+        fake = os.path.join(self.tmpdir, "ip")
+        open(fake, "w").write(FAKE_IP)
+        os.chmod(fake, stat.S_IRWXU)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = self.tmpdir + os.pathsep + self.path
+        CsKernel.state.cache = {
+            "links": {3: {"name": "eth1", "operstate": 6}},
+            "addresses": [{"cidr": "10.1.1.1/24", "index": 3, "label": "eth1"}],
+            "routes": [{"dst": IPNetwork("10.2.0.0/16"), "table": 254, "oif": 3, "gateway": "10.1.1.254"}],
+            "rules": []}
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        CsKernel.state.invalidate()
+        shutil.rmtree(self.tmpdir, True)
+
+    def applied(self):
+        path = os.path.join(self.tmpdir, "batch")
+        if not os.path.exists(path):
+            return None
+        return open(path).read().splitlines()
+
+    def test_nothing_to_do(self):
+        batch = CsIpBatch()
+        batch.add_address("eth1", "10.1.1.1/24")
+        batch.del_address("eth1", "10.1.1.2/24")
+        batch.add_route("10.2.0.0/16 via 10.1.1.254")
+        batch.del_route("10.3.0.0/16 via 10.1.1.254")
+        self.assertEqual(batch.commit(), [])
+        self.assertTrue(self.applied() is None)
+
+    def test_changes_in_one_run(self):
+        batch = CsIpBatch()
+        batch.add_address("eth1", "10.1.1.2/24")
+        batch.add_address("eth1", "10.1.1.2/24")
+        batch.del_address("eth1", "10.1.1.1/24")
+        batch.add_route("10.3.0.0/16 via 10.1.1.254")
+        batch.add_mark_rule(1, "Table_eth1")
+        self.assertEqual(batch.commit(), [])
+        self.assertEqual(self.applied(), ["addr add dev eth1 10.1.1.2/24 brd +",
+                                          "addr del dev eth1 10.1.1.1/24",
+                                          "route add 10.3.0.0/16 via 10.1.1.254",
+                                          "rule add fwmark 1 table Table_eth1"])
+        self.assertEqual(CsKernel.state.cache, {"links": {3: {"name": "eth1", "operstate": 6}}})
+
+    def test_routes_and_rules_in_one_run(self):
+        batch = CsIpBatch()
+        route = CsRoute(batch)
+        CsRule("eth2").addMark(batch)
+        route.add_route("eth2", "10.4.0.0/24")
+        self.assertTrue(route.add_defaultroute("10.1.1.254"))
+        self.assertFalse(route.add_defaultroute("10.1.1.253"))
+        self.assertTrue(self.applied() is None)
+        self.assertEqual(batch.commit(), [])
+        self.assertEqual(self.applied(), ["rule add fwmark 2 table Table_eth2",
+                                          "route add dev eth2 table Table_eth2 10.4.0.0/24",
+                                          "route add default via 10.1.1.254"])
+        self.assertEqual(len(open(os.path.join(self.tmpdir, "runs")).readlines()), 1)
+
+    def test_delete_before_config_change(self):
+        ip = CsIP("eth1", CsConfig())
+        seen = []
+        with patch.object(CsIP, "post_config_change", side_effect=lambda method: seen.append(self.applied())):
+            ip.delete("10.1.1.1/24")
+        self.assertEqual(seen, [["addr del dev eth1 10.1.1.1/24"]])
+
+    def test_failed_lines(self):
+        batch = CsIpBatch()
+        batch.add_route("10.3.0.0/16 via 10.1.1.254")
+        batch.add_route("10.4.0.0/16 via bad")
+        self.assertEqual(batch.commit(), [["route add 10.4.0.0/16 via bad", "RTNETLINK answers: Invalid argument"]])
+
+    def test_static_routes(self):
+        routes = CsStaticRoutes("staticroutes", None)
+        routes.dbag = {"id": "staticroutes",
+                       "10.2.0.0/16": {"network": "10.2.0.0/16", "gateway": "10.1.1.253", "revoke": False},
+                       "10.5.0.0/16": {"network": "10.5.0.0/16", "gateway": "10.1.1.254", "revoke": False},
+                       "10.6.0.0/16": {"network": "10.6.0.0/16", "gateway": "10.1.1.254", "revoke": True}}
+        routes.process()
+        self.assertEqual(self.applied(), ["route add 10.5.0.0/16 via 10.1.1.254"])
+
+if __name__ == '__main__':
+    unittest.main()
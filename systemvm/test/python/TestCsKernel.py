@@ -0,0 +1,94 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import os
+import shutil
+import tempfile
+import unittest
+from netaddr import IPNetwork
+from cs import CsKernel
+from cs.CsProcess import CsProcess
+from cs.CsRoute import CsRoute
+from cs.CsRule import CsRule
+import merge
+
+
+class TestCsKernel(unittest.TestCase):
+
+    def setUp(self):
+        merge.DataBag.DPATH = "."
+        self.tmpdir = tempfile.mkdtemp()
+        self.rt_tables = CsKernel.RT_TABLES
+        CsKernel.RT_TABLES = os.path.join(self.tmpdir, "rt_tables")
+        open(CsKernel.RT_TABLES, "w").write("255\tlocal\n254\tmain\n1 Table_eth1\n")
+        self.state = CsKernel.state
+        self.state.cache = {
+            "links": {1: {"name": "lo", "operstate": 0}, 3: {"name": "eth1", "operstate": 6},
+                      4: {"name": "eth2", "operstate": 2}},
+            "addresses": [{"cidr": "10.1.1.1/24", "index": 3, "label": "eth1"},
+                          {"cidr": "10.1.1.2/24", "index": 3, "label": "eth1:1"}],
+            "routes": [{"dst": IPNetwork("10.1.1.0/24"), "table": 1, "oif": 3, "gateway": None},
+                       {"dst": IPNetwork("0.0.0.0/0"), "table": 254, "oif": 3, "gateway": "10.1.1.254"}],
+            "rules": [{"src_len": 0, "dst_len": 0, "action": 1, "table": 1, "fwmark": 1, "fwmask": None}],
+            "processes": {"10": ["/usr/sbin/keepalived", "-D"], "2": [],
+                          "7": ["python", "/opt/cloud/bin/passwd_server_ip.py", "10.1.1.1"]}}
+
+    def tearDown(self):
+        CsKernel.RT_TABLES = self.rt_tables
+        self.state.invalidate()
+        shutil.rmtree(self.tmpdir, True)
+
+    def test_addresses(self):
+        self.assertEqual(self.state.addresses("eth1"), [["10.1.1.1/24", "eth1"], ["10.1.1.2/24", "eth1:1"]])
+        self.assertEqual(self.state.addresses("eth2"), [])
+        self.assertTrue(self.state.is_down("eth2"))
+        self.assertFalse(self.state.is_down("eth1"))
+
+    def test_find_routes(self):
+        self.assertEqual(len(self.state.find_routes("dev eth1 table Table_eth1 10.1.1.0/24")), 1)
+        self.assertEqual(self.state.find_routes("dev eth1 table Table_eth1 10.1.2.0/24"), [])
+        self.assertEqual(self.state.find_routes("dev eth1 table Table_eth9 10.1.1.0/24"), [])
+        self.assertEqual(len(self.state.find_routes("default via 10.1.1.254")), 1)
+        self.assertEqual(self.state.find_routes("default via 10.1.1.253"), [])
+        self.assertTrue(self.state.find_routes("10.1.1.0/24 proto static") is None)
+        self.assertTrue(CsRoute().defaultroute_exists())
+
+    def test_fwmark_rule(self):
+        self.assertTrue(CsRule("eth1").findMark())
+        self.assertFalse(CsRule("eth2").findMark())
+
+    def test_processes(self):
+        self.assertEqual(CsProcess(["/usr/sbin/keepalived"]).find_pid(), [])
+        self.assertEqual(CsProcess(["/usr/sbin/keepalived", "-D"]).find_pid(), ["10"])
+        self.assertEqual(CsProcess(["dummy"]).grep("passwd_server_ip.py 10.1.1.1"), "7")
+        self.assertEqual(CsProcess(["dummy"]).grep("passwd_server_ip.py 10.1.1.2"), -1)
+
+    def test_changed_by(self):
+        self.assertEqual(self.state.changed_by("ip route show table Table_eth1"), ())
+        self.assertEqual(self.state.changed_by("ip route add dev eth1 table Table_eth1 10.1.1.0/24"), ("routes",))
+        self.assertEqual(self.state.changed_by("ip addr del dev eth1 10.1.1.2/24"), ("addresses", "routes"))
+        self.assertEqual(self.state.changed_by("ip rule add fwmark 1 table Table_eth1"), ("rules",))
+        self.assertEqual(self.state.changed_by("kill -9 10"), ("processes",))
+        self.assertEqual(self.state.changed_by("iptables-save"), ())
+        self.assertEqual(self.state.changed_by("iptables-save | grep x | bash"), CsKernel.KINDS)
+
+    def test_executed(self):
+        self.state.executed("ip route flush table Table_eth1")
+        self.assertTrue("routes" not in self.state.cache)
+        self.assertTrue("addresses" in self.state.cache)
+
+if __name__ == '__main__':
+    unittest.main()
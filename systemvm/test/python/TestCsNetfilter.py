@@ -16,7 +16,8 @@
 # under the License.
 
 import unittest
-from cs.CsNetfilter import CsNetfilter
+import mock
+from cs.CsNetfilter import CsNetfilter, CsNetfilters, CsIptablesRestore
 import merge
 
 
@@ -29,5 +30,59 @@ class TestCsNetfilter(unittest.TestCase):
         csnetfilter = CsNetfilter()
         self.assertTrue(csnetfilter is not None)
 
+    def test_rule_key(self):
+        rule1 = CsNetfilter()
+        rule1.parse("-A INPUT -i eth0 -p tcp -j ACCEPT")
+        rule2 = CsNetfilter()
+        rule2.parse("-A INPUT -p tcp -i eth0 -j ACCEPT")
+        self.assertEqual(rule1, rule2)
+        self.assertEqual(hash(rule1), hash(rule2))
+        rule2.set_table("nat")
+        self.assertNotEqual(rule1, rule2)
+
+    def test_has_rule_and_delete(self):
+        csnetfilters = CsNetfilters(load=False)
+        for table, rule in [("filter", "-A INPUT -i eth0 -j ACCEPT"), ("filter", "-A INPUT -i eth1 -j ACCEPT")]:
+            existing = CsNetfilter()
+            existing.parse(rule)
+            existing.set_table(table)
+            csnetfilters.save(existing)
+        new_rule = CsNetfilter()
+        new_rule.parse("-A INPUT -i eth0 -j ACCEPT")
+        new_rule.set_table("filter")
+        self.assertTrue(csnetfilters.has_rule(new_rule))
+        new_rule.set_count(1)
+        self.assertFalse(csnetfilters.has_rule(new_rule))
+        csnetfilters.del_rule("filter", "-A INPUT -i eth1 -j ACCEPT")
+        self.assertEqual(len(csnetfilters.get()), 1)
+        self.assertEqual([x for x in csnetfilters.get() if x.unseen()], [])
+
+    def test_restore_render(self):
+        restore = CsIptablesRestore()
+        restore.add("nat", "-N TEST")
+        restore.add("nat", "-I POSTROUTING -t nat -o eth1 -j ACCEPT")
+        restore.add("filter", "-A INPUT -j DROP")
+        self.assertEqual(restore.render("nat"), "*nat\n-N TEST\n-I POSTROUTING -o eth1 -j ACCEPT\nCOMMIT\n")
+        self.assertEqual(restore.render("filter"), "*filter\n-A INPUT -j DROP\nCOMMIT\n")
+
+    @mock.patch('cs.CsNetfilter.CsHelper')
+    def test_restore_fallback(self, mock_helper):
+        mock_helper.execute_stdin.return_value = 1
+        restore = CsIptablesRestore()
+        restore.add("filter", "-A INPUT -j DROP")
+        restore.apply()
+        mock_helper.execute.assert_called_once_with("iptables -t filter -A INPUT -j DROP")
+
+    @mock.patch('cs.CsNetfilter.CsHelper')
+    def test_compare_batched(self, mock_helper):
+        mock_helper.execute_stdin.return_value = 0
+        csnetfilters = CsNetfilters(load=False)
+        csnetfilters.chain.add("filter", "INPUT")
+        csnetfilters.compare([["filter", "", "-A ACL_INBOUND_eth2 -j DROP"],
+                              ["filter", "front", "-A INPUT -i eth0 -j ACCEPT"]])
+        self.assertFalse(mock_helper.execute.called)
+        data = mock_helper.execute_stdin.call_args[0][1]
+        self.assertEqual(data, "*filter\n-N ACL_INBOUND_eth2\n-A ACL_INBOUND_eth2 -j DROP\n-I INPUT -i eth0 -j ACCEPT\nCOMMIT\n")
+
 if __name__ == '__main__':
     unittest.main()
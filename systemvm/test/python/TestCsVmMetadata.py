@@ -0,0 +1,114 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import base64
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from configure import CsVmMetadata
+import merge
+
+
+def vmdata(ip, userdata):
+    return [["userdata", "user-data", base64.b64encode(userdata)],
+            ["metadata", "instance-id", "i-2-%s-VM" % ip.split(".")[-1]],
+            ["metadata", "local-ipv4", ip]]
+
+
+class TestCsVmMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        merge.DataBag.DPATH = os.path.join(self.tmpdir, "bags")
+        self.www = os.path.join(self.tmpdir, "www")
+        self.saved = (CsVmMetadata.WWW, CsVmMetadata.HTACCESS)
+        CsVmMetadata.WWW = self.www
+        CsVmMetadata.HTACCESS = os.path.join(self.www, "latest", ".htaccess")
+        self.bag = {"id": "vmdata", "10.1.1.2": vmdata("10.1.1.2", "one"), "10.1.1.3": vmdata("10.1.1.3", "two")}
+        self.process()
+
+    def tearDown(self):
+        CsVmMetadata.WWW, CsVmMetadata.HTACCESS = self.saved
+        merge.DataBag.DPATH = "."
+        shutil.rmtree(self.tmpdir, True)
+
+    def process(self):
+        metadata = CsVmMetadata("vmdata")
+        metadata.dbag = self.bag
+        metadata.process()
+
+    def read(self, *path):
+        return open(os.path.join(self.www, *path)).read()
+
+    def write(self, text, *path):
+        open(os.path.join(self.www, *path), "w").write(text)
+
+    def digests(self):
+        return json.load(open(os.path.join(merge.DataBag.DPATH, "vmdatadigest.json")))
+
+    def test_published(self):
+        self.assertEqual(self.read("userdata", "10.1.1.2", "user-data"), "one")
+        self.assertEqual(self.read("metadata", "10.1.1.3", "local-ipv4"), "10.1.1.3")
+        self.assertEqual(self.read("metadata", "10.1.1.3", "meta-data"), "instance-id\nlocal-ipv4\n")
+        self.assertTrue("Allow from 10.1.1.2\n" in self.read("metadata", "10.1.1.2", ".htaccess"))
+        self.assertTrue("Allow from 10.1.1.3\n" in self.read("userdata", "10.1.1.3", ".htaccess"))
+        self.assertEqual(sorted(self.digests().keys()), ["10.1.1.2", "10.1.1.3", "id"])
+
+        rewrites = self.read("latest", ".htaccess").splitlines()
+        self.assertEqual(rewrites[:2], ["Options +FollowSymLinks", "RewriteEngine On"])
+        self.assertTrue("RewriteRule ^user-data$  ../userdata/%{REMOTE_ADDR}/user-data [L,NC,QSA]" in rewrites)
+        # one rule per file name and the two meta-data rules, the second vm adds none
+        self.assertEqual(len(rewrites), 3 + 3 + 2)
+
+    def test_unchanged_vm_skipped(self):
+        self.write("marker", "userdata", "10.1.1.2", "user-data")
+        self.write("marker", "latest", ".htaccess")
+        self.process()
+        self.assertEqual(self.read("userdata", "10.1.1.2", "user-data"), "marker")
+        self.assertEqual(self.read("latest", ".htaccess"), "marker")
+
+    def test_changed_vm_rewritten(self):
+        self.write("marker", "userdata", "10.1.1.2", "user-data")
+        self.write("marker", "userdata", "10.1.1.3", "user-data")
+        digest = self.digests()["10.1.1.3"]
+        self.bag["10.1.1.3"] = vmdata("10.1.1.3", "three")
+        self.process()
+        self.assertEqual(self.read("userdata", "10.1.1.2", "user-data"), "marker")
+        self.assertEqual(self.read("userdata", "10.1.1.3", "user-data"), "three")
+        self.assertNotEqual(self.digests()["10.1.1.3"], digest)
+
+    def test_unpublished_vm_rewritten(self):
+        # a vm whose files were removed is written again with unchanged data
+        shutil.rmtree(os.path.join(self.www, "userdata", "10.1.1.2"))
+        shutil.rmtree(os.path.join(self.www, "metadata", "10.1.1.2"))
+        self.process()
+        self.assertEqual(self.read("userdata", "10.1.1.2", "user-data"), "one")
+
+    def test_removed_vm_dropped(self):
+        del self.bag["10.1.1.3"]
+        self.process()
+        self.assertEqual(sorted(self.digests().keys()), ["10.1.1.2", "id"])
+
+        # it is published again when it comes back
+        self.write("marker", "userdata", "10.1.1.3", "user-data")
+        self.bag["10.1.1.3"] = vmdata("10.1.1.3", "two")
+        self.process()
+        self.assertEqual(self.read("userdata", "10.1.1.3", "user-data"), "two")
+
+if __name__ == '__main__':
+    unittest.main()
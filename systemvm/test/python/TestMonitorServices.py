@@ -0,0 +1,179 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import imp
+import json
+import os
+import shutil
+import signal
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+# /root/monitorServices.py on the router, not on the path of the cs modules
+monitorServices = imp.load_source("monitorServices", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  "../../patches/debian/config/root/monitorServices.py"))
+Config = monitorServices.Config
+Watchdog = monitorServices.Watchdog
+
+# A service daemon: writes its pid file and runs until it is killed
+FAKE_SERVICE = """#!/bin/sh
+echo $$ > "$(dirname "$0")/$(basename "$0").pid"
+while true; do sleep 1; done
+"""
+
+# Stands in for service(8): starts the fake daemon of the same name,
+# hangs for names starting with hung and fails for names starting with broken
+FAKE_INIT = """#!/bin/sh
+case "$1" in
+    hung*) sleep 1000 ;;
+    broken*) exit 1 ;;
+esac
+setsid "$(dirname "$0")/$1" > /dev/null 2>&1 < /dev/null &
+sleep 0.1
+"""
+
+
+class TestMonitorServices(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = dict(vars(Config))
+        Config.CONFIG_FILE = os.path.join(self.tmpdir, "monitor.conf")
+        Config.METRICS_FILE = os.path.join(self.tmpdir, "metrics.json")
+        Config.RESTART_COMMAND = self.script("service", FAKE_INIT) + " %s restart"
+        Config.SLEEP_SEC = 0.1
+        Config.CONFIRM_SEC = 0.2
+        Config.PROBE_INTERVAL = 0.2
+        Config.PROBE_TIMEOUT = 0.5
+        Config.RESTART_TIMEOUT = 1
+        Config.BACKOFF_MIN = 0.5
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread:
+            self.watchdog.running = False
+            self.thread.join()
+        for name in os.listdir(self.tmpdir):
+            if name.endswith(".pid"):
+                self.kill(name[:-4])
+        for name, value in self.saved.items():
+            if not name.startswith("__"):
+                setattr(Config, name, value)
+        shutil.rmtree(self.tmpdir, True)
+
+    def script(self, name, content):
+        filename = os.path.join(self.tmpdir, name)
+        open(filename, "w").write(content)
+        os.chmod(filename, stat.S_IRWXU)
+        return filename
+
+    def service(self, name, healthcheck=None):
+        """ Configure a fake service and start it """
+        self.script(name, FAKE_SERVICE)
+        config = "[%s]\nprocessname=%s\nservicename=%s\npidfile=%s/%s.pid\n" % (name, name, name, self.tmpdir, name)
+        if healthcheck:
+            config += "healthcheck=%s\n" % healthcheck
+        open(Config.CONFIG_FILE, "a").write(config)
+        os.system("setsid %s/%s > /dev/null 2>&1 < /dev/null &" % (self.tmpdir, name))
+        self.wait(lambda: self.pid(name))
+
+    def pid(self, name):
+        return monitorServices.readPid(os.path.join(self.tmpdir, name + ".pid"))
+
+    def kill(self, name):
+        pid = self.pid(name)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except (OSError, TypeError):
+            pass
+        return pid
+
+    def wait(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if condition():
+                return True
+            time.sleep(0.05)
+        self.fail("condition not met in %s seconds" % timeout)
+
+    def start(self, pidfds=True):
+        self.watchdog = Watchdog(Config.CONFIG_FILE)
+        if not pidfds:
+            self.watchdog.tracker.syscall = None
+        self.thread = threading.Thread(target=self.watchdog.run)
+        self.thread.start()
+        self.wait(lambda: self.watchdog.services and
+                  all(s.state == monitorServices.RUNNING for s in self.watchdog.services.values()))
+
+    def metrics(self):
+        if not os.path.exists(Config.METRICS_FILE):
+            return {}
+        return json.load(open(Config.METRICS_FILE))
+
+    def restarted(self, name, old_pid):
+        return self.pid(name) not in (None, old_pid) and monitorServices.processMatches(self.pid(name), name)
+
+    def test_restart_with_pidfd(self):
+        self.service("fakesvc")
+        self.start()
+        self.assertTrue(self.watchdog.services["fakesvc"].pidfd is not None)
+        pid = self.kill("fakesvc")
+        self.wait(lambda: self.restarted("fakesvc", pid))
+        self.wait(lambda: self.metrics().get("fakesvc", {}).get("restarts") == 1)
+        metrics = self.metrics()["fakesvc"]
+        self.assertEqual(metrics["detections"], 1)
+        self.assertTrue(Config.CONFIRM_SEC <= metrics["last_latency"] < 2)
+
+    def test_restart_with_proc_polling(self):
+        self.service("fakesvc")
+        self.start(pidfds=False)
+        self.assertTrue(self.watchdog.services["fakesvc"].pidfd is None)
+        pid = self.kill("fakesvc")
+        self.wait(lambda: self.restarted("fakesvc", pid))
+
+    def test_hung_restart_does_not_hold_up_others(self):
+        self.service("hungsvc")
+        self.service("fakesvc")
+        self.start()
+        self.kill("hungsvc")
+        time.sleep(0.3)
+        pid = self.kill("fakesvc")
+        self.wait(lambda: self.restarted("fakesvc", pid), timeout=Config.RESTART_TIMEOUT)
+        self.wait(lambda: self.metrics().get("hungsvc", {}).get("failed_restarts") == 1)
+        self.assertEqual(self.watchdog.services["hungsvc"].state, monitorServices.BACKOFF)
+
+    def test_backoff(self):
+        self.service("brokensvc")
+        self.start()
+        self.kill("brokensvc")
+        self.wait(lambda: self.metrics().get("brokensvc", {}).get("failed_restarts") == 2)
+        service = self.watchdog.services["brokensvc"]
+        self.assertEqual(service.failures, 2)
+        self.assertTrue(service.due - time.time() > Config.BACKOFF_MIN)
+
+    def test_failed_health_check(self):
+        self.service("fakesvc", healthcheck="sleep 10")
+        self.start()
+        pid = self.pid("fakesvc")
+        self.wait(lambda: self.watchdog.services["fakesvc"].metrics["detections"] == 1)
+        # the process is running, so it is not restarted
+        self.assertEqual(self.pid("fakesvc"), pid)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from cs.CsApp import CsPasswdSvc
+import merge
+import passwd_server_ip
+
+# Runs serve() on the files of a test, its command line names the script
+SERVER = """import sys
+import passwd_server_ip as server
+tmpdir, port = sys.argv[1:]
+server.CACHE_DIR = tmpdir
+server.ADDRESS_FILE = tmpdir + '/addresses'
+server.PID_FILE = tmpdir + '/passwd_server.pid'
+server.PORT = int(port)
+server.getTokenFile = lambda: tmpdir + '/token'
+sys.argv = [sys.argv[0], '127.0.0.1']
+server.serve()
+"""
+
+
+class TestPasswdServer(unittest.TestCase):
+
+    def setUp(self):
+        merge.DataBag.DPATH = "."
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "passwords")
+        self.saved = (passwd_server_ip.ADDRESS_FILE, passwd_server_ip.PORT, passwd_server_ip.secureToken,
+                      passwd_server_ip.COMPACT_ENTRIES, passwd_server_ip.MAX_CONNECTIONS, passwd_server_ip.PID_FILE,
+                      CsPasswdSvc.ADDRESSES, CsPasswdSvc.PIDFILE)
+        passwd_server_ip.ADDRESS_FILE = CsPasswdSvc.ADDRESSES = os.path.join(self.tmpdir, "addresses")
+        passwd_server_ip.PID_FILE = CsPasswdSvc.PIDFILE = os.path.join(self.tmpdir, "passwd_server.pid")
+        passwd_server_ip.secureToken = "token"
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        passwd_server_ip.PORT = listener.getsockname()[1]
+        listener.close()
+
+    def tearDown(self):
+        (passwd_server_ip.ADDRESS_FILE, passwd_server_ip.PORT, passwd_server_ip.secureToken,
+         passwd_server_ip.COMPACT_ENTRIES, passwd_server_ip.MAX_CONNECTIONS, passwd_server_ip.PID_FILE,
+         CsPasswdSvc.ADDRESSES, CsPasswdSvc.PIDFILE) = self.saved
+        shutil.rmtree(self.tmpdir, True)
+
+    def store(self):
+        store = passwd_server_ip.PasswordStore(self.path)
+        store.load()
+        return store
+
+    def test_journal(self):
+        store = self.store()
+        store.set("10.1.1.2", "one")
+        store.set("10.1.1.3", "two")
+        store.remove("10.1.1.2")
+        store.sync()
+        self.assertEqual(open(self.path + ".journal").read(), "+10.1.1.2=one\n+10.1.1.3=two\n-10.1.1.2\n")
+        # a change cut short by a crash is ignored
+        open(self.path + ".journal", "a").write("+10.1.1.4=thr")
+        self.assertEqual(self.store().passwords, {"10.1.1.3": "two"})
+
+    def test_compaction(self):
+        passwd_server_ip.COMPACT_ENTRIES = 3
+        store = self.store()
+        for i in range(4):
+            store.set("10.1.1.%s" % i, "pw%s=" % i)
+            store.sync()
+        store.compactor.join()
+        self.assertFalse(os.path.exists(self.path + ".journal.1"))
+        self.assertEqual(open(self.path + ".journal").read(), "+10.1.1.3=pw3=\n")
+        self.assertEqual(sorted(open(self.path).read().splitlines()), ["10.1.1.0=pw0=", "10.1.1.1=pw1=", "10.1.1.2=pw2="])
+        self.assertEqual(self.store().passwords, store.passwords)
+
+    def test_replay_rotated_journal(self):
+        # a crash after the rename of a compaction, before the rotated journal was removed
+        open(self.path, "w").write("10.1.1.2=one\n10.1.1.3=two\n")
+        open(self.path + ".journal.1", "w").write("+10.1.1.2=old\n+10.1.1.2=one\n+10.1.1.3=two\n-10.1.1.4\n")
+        open(self.path + ".journal", "w").write("-10.1.1.3\n")
+        self.assertEqual(self.store().passwords, {"10.1.1.2": "one"})
+
+    def test_legacy_files(self):
+        open(self.path + "-10.1.1.1", "w").write("10.1.1.2=one\n")
+        open(self.path + "-10.1.2.1", "w").write("10.1.2.2=two\n")
+        store = self.store()
+        store.compactor.join()
+        self.assertEqual(sorted(open(self.path).read().splitlines()), ["10.1.1.2=one", "10.1.2.2=two"])
+
+    def request(self, address, data, body=None):
+        sock = socket.create_connection((address, passwd_server_ip.PORT))
+        sock.sendall(data)
+        response = ""
+        if body is not None:
+            response = sock.recv(4096)
+            sock.sendall(body)
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        sock.close()
+        return response
+
+    def start(self):
+        open(passwd_server_ip.ADDRESS_FILE, "w").write("127.0.0.1\n")
+        server = passwd_server_ip.PasswordServer(self.store())
+        server.updateListeners()
+        thread = threading.Thread(target=server.run)
+        thread.start()
+        return server, thread
+
+    def test_server(self):
+        server, thread = self.start()
+        try:
+            body = "--x\r\nContent-Disposition: form-data; name=\"%s\"\r\n\r\n%s\r\n" * 3 % \
+                ("ip", "127.0.0.1", "password", "secret", "token", "token") + "--x--\r\n"
+            response = self.request("127.0.0.1", "POST / HTTP/1.1\r\nDomU_Request: save_password\r\n"
+                                    "Content-Type: multipart/form-data; boundary=x\r\n"
+                                    "Expect: 100-continue\r\nContent-Length: %s\r\n\r\n" % len(body), body)
+            self.assertTrue(response.startswith("HTTP/1.1 100 Continue\r\n\r\nHTTP/1.0 200 OK"))
+            get = "GET / HTTP/1.0\r\nDomU_Request: %s\r\n\r\n"
+            self.assertTrue(self.request("127.0.0.1", get % "send_my_password").endswith("\r\n\r\nsecret"))
+            self.assertTrue(self.request("127.0.0.1", get % "saved_password").endswith("\r\n\r\nsaved_password"))
+            self.assertTrue(self.request("127.0.0.1", get % "send_my_password").endswith("\r\n\r\nsaved_password"))
+            self.assertTrue(self.request("127.0.0.1", get % "other").startswith("HTTP/1.0 400"))
+            self.assertEqual(open(self.path + ".journal").read(), "+127.0.0.1=secret\n-127.0.0.1\n")
+        finally:
+            server.running = False
+            thread.join()
+
+    def test_connection_limit(self):
+        passwd_server_ip.MAX_CONNECTIONS = 2
+        server, thread = self.start()
+        idle = []
+        try:
+            idle = [socket.create_connection(("127.0.0.1", passwd_server_ip.PORT)) for i in range(2)]
+            get = "GET / HTTP/1.0\r\nDomU_Request: send_my_password\r\n\r\n"
+            # closed as soon as it is accepted
+            shed = socket.create_connection(("127.0.0.1", passwd_server_ip.PORT))
+            self.assertEqual(shed.recv(4096), "")
+            shed.close()
+            idle.pop().close()
+            time.sleep(0.2)
+            self.assertTrue(self.request("127.0.0.1", get).endswith("\r\n\r\nsaved_password"))
+        finally:
+            for sock in idle:
+                sock.close()
+            server.running = False
+            thread.join()
+
+    def test_stale_pid(self):
+        # the pid file of a server that died, the pid taken by another process
+        open(passwd_server_ip.PID_FILE, "w").write("%s\n" % os.getpid())
+        self.assertEqual(CsPasswdSvc.pid(), None)
+        self.assertEqual(passwd_server_ip.runningPid(), None)
+        # locked, but not by a password server
+        with open(passwd_server_ip.PID_FILE) as lock:
+            passwd_server_ip.fcntl.flock(lock, passwd_server_ip.fcntl.LOCK_EX)
+            self.assertEqual(CsPasswdSvc.pid(), None)
+
+    def wait(self, condition):
+        deadline = time.time() + 10
+        while not condition():
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.05)
+
+    def test_takeover(self):
+        path = os.path.dirname(os.path.abspath(passwd_server_ip.__file__))
+        env = dict(os.environ, PYTHONPATH=path)
+        command = [sys.executable, "-c", SERVER, self.tmpdir, str(passwd_server_ip.PORT)]
+        first = subprocess.Popen(command, env=env)
+        second = None
+        try:
+            self.wait(lambda: CsPasswdSvc.pid() == first.pid)
+            os.kill(first.pid, signal.SIGHUP)
+            second = subprocess.Popen(command, env=env)
+            time.sleep(0.5)
+            self.assertEqual(first.poll(), None)
+            self.assertEqual(CsPasswdSvc.pid(), first.pid)
+            # the waiting server takes over once the running one exits
+            os.kill(first.pid, signal.SIGTERM)
+            self.assertEqual(first.wait(), 0)
+            self.wait(lambda: CsPasswdSvc.pid() == second.pid)
+            os.kill(second.pid, signal.SIGTERM)
+            self.assertEqual(second.wait(), 0)
+            self.assertFalse(os.path.exists(passwd_server_ip.PID_FILE))
+            self.assertEqual(CsPasswdSvc.pid(), None)
+        finally:
+            for process in (first, second):
+                if process and process.poll() is None:
+                    process.kill()
+                    process.wait()
+
+    def test_addresses(self):
+        self.assertTrue(CsPasswdSvc("10.1.1.1").set_address(True))
+        self.assertTrue(CsPasswdSvc("10.1.2.1").set_address(True))
+        self.assertFalse(CsPasswdSvc("10.1.1.1").set_address(True))
+        self.assertTrue(CsPasswdSvc("10.1.1.1").set_address(False))
+        self.assertEqual(CsPasswdSvc.addresses(), ["10.1.2.1"])
+        self.assertEqual(passwd_server_ip.readAddresses(), ["10.1.2.1"])
+
+if __name__ == '__main__':
+    unittest.main()
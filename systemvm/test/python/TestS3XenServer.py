@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# Runs the plugin against a local S3 stand-in server.
+
+import BaseHTTPServer
+import SocketServer
+import imp
+import md5
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+PLUGINS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../../scripts/vm/hypervisor/xenserver")
+sys.path.append(PLUGINS)
+try:
+    s3xenserver = imp.load_source("s3xenserver", os.path.join(PLUGINS, "s3xenserver"))
+except ImportError:
+    # XenAPIPlugin and the sm util module are part of the XenServer dom0
+    s3xenserver = None
+
+PART_SIZE = 64 * 1024
+
+
+class FakeS3(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Just enough of the S3 REST API for s3xenserver """
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), FakeS3Handler)
+        self.objects = {}
+        self.uploads = {}
+        self.connections = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        # as returned for objects encrypted with SSE-KMS, not their MD5
+        self.etag = None
+
+    def handle_error(self, request, client_address):
+        # The client drops its connection after a failed request
+        pass
+
+    def end_point(self):
+        return "127.0.0.1:%s" % self.server_address[1]
+
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.lock.acquire()
+        self.server.connections += 1
+        self.server.lock.release()
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body="", headers={}):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def parse(self):
+        self.server.lock.acquire()
+        self.server.requests.append((self.command, self.path, self.headers.get("Range")))
+        self.server.lock.release()
+        path, _, query = self.path.partition("?")
+        params = dict(p.partition("=")[::2] for p in query.split("&") if p)
+        return path, params
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_PUT(self):
+        path, params = self.parse()
+        data = self.body()
+        if "Content-MD5" in self.headers:
+            if self.headers["Content-MD5"] != md5.new(data).digest().encode("base64").strip():
+                return self.reply(400, "<Error><Code>BadDigest</Code></Error>")
+        if "uploadId" in params:
+            self.server.uploads[params["uploadId"]][int(params["partNumber"])] = data
+        else:
+            self.server.objects[path] = data
+        self.reply(200, headers={"ETag": '"%s"' % (self.server.etag or md5.new(data).hexdigest())})
+
+    def do_POST(self):
+        path, params = self.parse()
+        data = self.body()
+        if "uploads" in params:
+            upload = "upload%s" % len(self.server.uploads)
+            self.server.uploads[upload] = {}
+            return self.reply(200, "<InitiateMultipartUploadResult><UploadId>%s</UploadId></InitiateMultipartUploadResult>" % upload)
+        parts = self.server.uploads.pop(params["uploadId"])
+        numbers = [int(n) for n in re.findall("<PartNumber>([0-9]+)</PartNumber>", data)]
+        self.server.objects[path] = "".join([parts[n] for n in numbers])
+        self.reply(200, "<CompleteMultipartUploadResult/>")
+
+    def do_HEAD(self):
+        path, params = self.parse()
+        if path not in self.server.objects:
+            return self.reply(404)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.server.objects[path])))
+        self.end_headers()
+
+    def do_GET(self):
+        path, params = self.parse()
+        if path not in self.server.objects:
+            return self.reply(404, "<Error><Code>NoSuchKey</Code></Error>")
+        data = self.server.objects[path]
+        match = re.match("bytes=([0-9]+)-([0-9]+)", self.headers.get("Range", ""))
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+            return self.reply(206, data[start:end + 1])
+        self.reply(200, data)
+
+    def do_DELETE(self):
+        path, params = self.parse()
+        if "uploadId" in params:
+            self.server.uploads.pop(params["uploadId"], None)
+        else:
+            self.server.objects.pop(path, None)
+        self.reply(204)
+
+
+@unittest.skipIf(s3xenserver is None, "s3xenserver needs XenAPIPlugin and the sm util module")
+class TestS3XenServer(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeS3()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, "source.vhd")
+        self.target = os.path.join(self.folder, "target.vhd")
+        self.data = os.urandom(10 * PART_SIZE + 1234)
+        f = open(self.source, "wb")
+        f.write(self.data)
+        f.close()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def client(self, concurrency=4):
+        return s3xenserver.S3Client("access", "secret", self.server.end_point(), "false",
+                                    part_size=PART_SIZE, concurrency=concurrency)
+
+    def read_target(self):
+        f = open(self.target, "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def test_single_put(self):
+        self.client().put("bucket", "key", self.source, len(self.data))
+        self.assertEqual(self.data, self.server.objects["/bucket/key"])
+
+    def test_single_put_other_etag(self):
+        self.server.etag = "0" * 32
+        self.client().put("bucket", "key", self.source, len(self.data))
+        self.assertEqual(self.data, self.server.objects["/bucket/key"])
+
+    def test_single_put_bad_digest(self):
+        original = s3xenserver.md5mod.md5
+        s3xenserver.md5mod.md5 = lambda data="": original(data + "x")
+        try:
+            self.assertRaises(Exception, self.client().put, "bucket", "key", self.source, len(self.data))
+        finally:
+            s3xenserver.md5mod.md5 = original
+        self.assertTrue("/bucket/key" not in self.server.objects)
+
+    def test_multipart_put(self):
+        self.client().put("bucket", "key", self.source, PART_SIZE)
+        self.assertEqual(self.data, self.server.objects["/bucket/key"])
+        parts = [r for r in self.server.requests if r[0] == "PUT"]
+        self.assertEqual(11, len(parts))
+        self.assertEqual({}, self.server.uploads)
+        # Four workers plus the connection of the calling thread
+        self.assertTrue(self.server.connections <= 5)
+
+    def test_multipart_put_sequential(self):
+        self.client(1).put("bucket", "key", self.source, PART_SIZE)
+        self.assertEqual(self.data, self.server.objects["/bucket/key"])
+        self.assertEqual(1, self.server.connections)
+
+    def test_ranged_get(self):
+        self.server.objects["/bucket/key"] = self.data
+        self.client().get("bucket", "key", self.target)
+        self.assertEqual(self.data, self.read_target())
+        ranges = [r for r in self.server.requests if r[0] == "GET"]
+        self.assertEqual(11, len(ranges))
+        self.assertTrue(None not in [r[2] for r in ranges])
+
+    def test_small_get(self):
+        self.server.objects["/bucket/key"] = "small"
+        self.client().get("bucket", "key", self.target)
+        self.assertEqual("small", self.read_target())
+
+    def test_get_missing(self):
+        self.assertRaises(Exception, self.client().get, "bucket", "missing", self.target)
+
+    def test_bad_digest_aborts_upload(self):
+        original = s3xenserver.md5mod.md5
+        s3xenserver.md5mod.md5 = lambda data="": original(data + "x")
+        try:
+            self.assertRaises(Exception, self.client().put, "bucket", "key", self.source, PART_SIZE)
+        finally:
+            s3xenserver.md5mod.md5 = original
+        self.assertEqual({}, self.server.uploads)
+        self.assertTrue("/bucket/key" not in self.server.objects)
+
+
+if __name__ == '__main__':
+    unittest.main()
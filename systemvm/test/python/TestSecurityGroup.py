@@ -0,0 +1,153 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# Checks the input security_group.py feeds to iptables-restore,
+# ebtables-restore and ipset restore for the rules of a vm.
+
+import os
+import sys
+import unittest
+from mock import patch
+
+base = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(base, "../../../python/lib"))
+sys.path.append(os.path.join(base, "../../../scripts/vm/network"))
+try:
+    import security_group as sg
+except ImportError:
+    # the libvirt bindings are only on KVM hosts
+    sg = None
+
+VM = "i-2-3-VM"
+RULES = ["I:tcp:22:22:10.1.0.0/16,10.2.0.0/16,", "I:udp:22:22:10.3.0.0/16,", "E:tcp:80:80:0.0.0.0/0,10.4.0.0/16,"]
+
+EBTABLES_SAVE = """# Generated by ebtables-save
+*filter
+:INPUT ACCEPT
+*nat
+:PREROUTING ACCEPT
+:OUTPUT ACCEPT
+:POSTROUTING ACCEPT
+:i-2-3-VM-in ACCEPT
+:i-2-3-VM-in-ips ACCEPT
+:i-2-4-VM-in ACCEPT
+-A PREROUTING -i vnet0 -j i-2-3-VM-in
+-A PREROUTING -i vnet1 -j i-2-4-VM-in
+-A i-2-3-VM-in -p ARP -j i-2-3-VM-in-ips
+-A i-2-3-VM-in-ips -j DROP
+-A i-2-4-VM-in -j ACCEPT
+"""
+
+
+@unittest.skipIf(sg is None, "security_group.py needs the libvirt python bindings")
+class TestSecurityGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.sets = []
+        self.patches = [patch.object(sg, "restore", side_effect=self.restore),
+                        patch.object(sg, "execute", side_effect=self.execute)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def restore(self, cmd, data):
+        self.calls.append((cmd, data.splitlines()))
+
+    def execute(self, cmd):
+        if cmd == "ipset list -n":
+            return "\n".join(self.sets)
+        if cmd == "ebtables-save":
+            return EBTABLES_SAVE
+        raise Exception("unexpected command " + cmd)
+
+    def render(self, lines):
+        return sg.render_network_rules(VM, lines, True)
+
+    def test_set_named_after_rule(self):
+        commands, ipsets, egress = self.render(RULES)
+        tcp = sg.rule_ipset_name(VM, "I", "tcp", "22", "22")
+        udp = sg.rule_ipset_name(VM, "I", "udp", "22", "22")
+        out = sg.rule_ipset_name(VM, "E", "tcp", "80", "80")
+        self.assertEqual(ipsets, {tcp: ["10.1.0.0/16", "10.2.0.0/16"], udp: ["10.3.0.0/16"], out: ["10.4.0.0/16"]})
+        self.assertEqual(commands, [
+            "-I i-2-3-VM -p tcp -m tcp --dport 22:22 -m state --state NEW -m set --match-set " + tcp + " src -j ACCEPT",
+            "-I i-2-3-VM -p udp -m udp --dport 22:22 -m state --state NEW -m set --match-set " + udp + " src -j ACCEPT",
+            "-I i-2-3-VM-eg -p tcp -m tcp --dport 80:80 -m state --state NEW -m set --match-set " + out + " dst -j RETURN",
+            "-I i-2-3-VM-eg -p tcp -m tcp --dport 80:80 -m state --state NEW -j RETURN"])
+        self.assertEqual(egress, 1)
+
+    def test_set_kept_when_other_rule_changes(self):
+        # dropping the first rule must not move the cidrs of the others
+        before = self.render(RULES)[1]
+        after = self.render(RULES[1:])[1]
+        for name, ips in after.items():
+            self.assertEqual(before[name], ips)
+
+    def test_same_match_shares_set(self):
+        commands, ipsets, egress = self.render(["I:tcp:22:22:10.1.0.0/16,", "I:tcp:22:22:10.2.0.0/16,"])
+        self.assertEqual(len(commands), 1)
+        self.assertEqual(ipsets.values(), [["10.1.0.0/16", "10.2.0.0/16"]])
+
+    def test_long_vm_name(self):
+        name = sg.rule_ipset_name("i-1234-567890-VM-with-a-long-name", "E", "icmp", "-1", "-1")
+        self.assertTrue(len(name + "t") <= 31)
+
+    def test_apply_network_rules(self):
+        stale = sg.rule_ipset_name(VM, "I", "tcp", "23", "23")
+        keep = sg.rule_ipset_name(VM, "I", "tcp", "22", "22")
+        self.sets = [stale, keep, "i-2-30-VM-I0", sg.egress_chain_name(VM)]
+        sg.apply_network_rules(VM, RULES)
+        self.assertEqual([cmd for cmd, data in self.calls], ["ipset restore", "iptables-restore --noflush", "ipset restore"])
+        load = self.calls[0][1]
+        self.assertEqual(load[:3], ["create %s hash:net -exist" % keep, "create %st hash:net -exist" % keep, "flush %st" % keep])
+        self.assertEqual(load[3:7], ["add %st 10.1.0.0/16 -exist" % keep, "add %st 10.2.0.0/16 -exist" % keep,
+                                     "swap %st %s" % (keep, keep), "destroy %st" % keep])
+        self.assertEqual(len(load), 19)
+        rules = self.calls[1][1]
+        self.assertEqual(rules[:3], ["*filter", "-F i-2-3-VM", "-F i-2-3-VM-eg"])
+        self.assertEqual(rules[-3:], ["-A i-2-3-VM-eg -j DROP", "-A i-2-3-VM -j DROP", "COMMIT"])
+        # the set of the rule that went away is destroyed once nothing matches on it
+        self.assertEqual(self.calls[2][1], ["destroy " + stale])
+
+    def test_render_ebtables_rules(self):
+        rules = sg.render_ebtables_rules(VM, "10.1.1.10", "06:00:00:00:00:01", "vnet0", ["10.1.1.11", "0", ""])
+        self.assertEqual(rules[:2], ["-A PREROUTING -i vnet0 -j i-2-3-VM-in", "-A POSTROUTING -o vnet0 -j i-2-3-VM-out"])
+        self.assertEqual([r for r in rules if r.startswith("-A i-2-3-VM-in-ips")], [
+            "-A i-2-3-VM-in-ips -p ARP --arp-ip-src 10.1.1.11 -j RETURN",
+            "-A i-2-3-VM-in-ips -p ARP --arp-ip-src 10.1.1.10 -j RETURN",
+            "-A i-2-3-VM-in-ips -j DROP"])
+        self.assertEqual(len(rules), 20)
+
+    def test_apply_ebtables_rules(self):
+        sg.apply_ebtables_rules(VM, "10.1.1.10", "06:00:00:00:00:01", "vnet0", [])
+        self.assertEqual(len(self.calls), 1)
+        cmd, data = self.calls[0]
+        self.assertEqual(cmd, "ebtables-restore")
+        # the chains of other vms stay, the old chains of this vm are replaced
+        self.assertEqual(data[:6], ["*nat", ":PREROUTING ACCEPT", ":OUTPUT ACCEPT", ":POSTROUTING ACCEPT",
+                                    ":i-2-4-VM-in ACCEPT", ":i-2-3-VM-in ACCEPT"])
+        self.assertEqual(data[9:12], ["-A PREROUTING -i vnet1 -j i-2-4-VM-in", "-A i-2-4-VM-in -j ACCEPT",
+                                      "-A PREROUTING -i vnet0 -j i-2-3-VM-in"])
+        self.assertEqual(data.count("-A i-2-3-VM-in-ips -j DROP"), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+
+""" Time merging sequential dhcp entries into the dhcpentry databag
+
+Usage: python bench_cs_dhcp_merge.py [count ...]
+
+Merges every entry into an in-memory databag through cs_dhcp.merge,
+then times saving the resulting databag once.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../../../patches/debian/config/opt/cloud/bin"))
+
+import cs_dhcp
+import merge
+
+
+def entry(i):
+    return {"host_name": "vm-%s" % i,
+            "mac_address": "02:00:%02x:%02x:%02x:%02x" % ((i >> 24) & 255, (i >> 16) & 255, (i >> 8) & 255, i & 255),
+            "ipv4_adress": "10.%s.%s.%s" % ((i >> 16) & 255, (i >> 8) & 255, i & 255),
+            "default_gateway": "10.0.0.1",
+            "add": True}
+
+
+def main(argv):
+    counts = [int(x) for x in argv[1:]] or [10000]
+    path = tempfile.mkdtemp()
+    try:
+        merge.DataBag.DPATH = path
+        print "%8s %12s %12s" % ("entries", "merge (s)", "save (s)")
+        for count in counts:
+            db = merge.DataBag()
+            db.setKey("dhcpentry")
+            db.load()
+            dbag = db.getDataBag()
+            start = time.time()
+            for i in range(count):
+                dbag = cs_dhcp.merge(dbag, entry(i))
+            merged = time.time() - start
+            start = time.time()
+            db.save(dbag)
+            print "%8d %12.3f %12.3f" % (count, merged, time.time() - start)
+    finally:
+        shutil.rmtree(path, True)
+
+if __name__ == "__main__":
+    main(sys.argv)
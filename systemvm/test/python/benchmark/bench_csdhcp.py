@@ -0,0 +1,81 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+
+""" Time building the dnsmasq hosts file through CsDhcp and CsFile
+
+Usage: python bench_csdhcp.py [count ...]
+
+Runs the CsDhcp.add loop for every entry and commits the file, first
+into an empty file and then again with unchanged content.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../../../patches/debian/config/opt/cloud/bin"))
+
+import merge
+from cs.CsDhcp import CsDhcp
+from cs.CsFile import CsFile
+
+
+def entries(count):
+    dbag = {"id": "dhcpentry"}
+    for i in range(count):
+        ip = "10.%s.%s.%s" % ((i >> 16) & 255, (i >> 8) & 255, i & 255)
+        dbag[ip] = {"host_name": "vm-%s" % i,
+                    "mac_address": "02:00:%02x:%02x:%02x:%02x" % ((i >> 24) & 255, (i >> 16) & 255, (i >> 8) & 255, i & 255),
+                    "ipv4_adress": ip,
+                    "default_gateway": "10.0.0.1"}
+    return dbag
+
+
+def build(dhcp, filename):
+    start = time.time()
+    dhcp.hosts = {}
+    dhcp.devinfo = []
+    dhcp.cloud = CsFile(filename)
+    dhcp.cloud.repopulate()
+    for item in sorted(dhcp.dbag):
+        if item == "id":
+            continue
+        dhcp.add(dhcp.dbag[item])
+    dhcp.cloud.commit()
+    return time.time() - start
+
+
+def main(argv):
+    counts = [int(x) for x in argv[1:]] or [5000]
+    path = tempfile.mkdtemp()
+    try:
+        merge.DataBag.DPATH = path
+        print "%8s %12s %12s" % ("entries", "first (s)", "again (s)")
+        for count in counts:
+            filename = os.path.join(path, "dhcphosts.%s" % count)
+            dhcp = CsDhcp("dhcpentry", None)
+            dhcp.dbag = entries(count)
+            print "%8d %12.3f %12.3f" % (count, build(dhcp, filename), build(dhcp, filename))
+    finally:
+        shutil.rmtree(path, True)
+
+if __name__ == "__main__":
+    main(sys.argv)
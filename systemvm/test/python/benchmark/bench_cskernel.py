@@ -0,0 +1,66 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+""" Time the kernel state queries of a router config run
+
+Usage: python bench_cskernel.py [count ...]
+
+Asks count times for the addresses of a device, a route, the ip rules
+and the processes, once by running ip and ps as the scripts used to
+and once from a CsKernel snapshot loaded through netlink and /proc.
+Only reads the state of the machine it runs on.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../../../patches/debian/config/opt/cloud/bin"))
+
+from cs import CsHelper
+from cs.CsKernel import CsKernelState
+
+
+def forked(count):
+    start = time.time()
+    for i in range(count):
+        CsHelper.execute("ip addr show dev lo")
+        CsHelper.execute("ip route show default")
+        CsHelper.execute("ip rule show")
+        CsHelper.execute("ps aux")
+    return time.time() - start
+
+
+def snapshot(count):
+    start = time.time()
+    state = CsKernelState()
+    for i in range(count):
+        state.addresses("lo")
+        state.find_routes("default")
+        state.has_fwmark_rule(1, "main")
+        state.processes()
+    return time.time() - start
+
+
+def main(argv):
+    counts = [int(x) for x in argv[1:]] or [10, 100]
+    print "%8s %12s %14s" % ("queries", "forked (s)", "snapshot (s)")
+    for count in counts:
+        print "%8d %12.3f %14.4f" % (count, forked(count), snapshot(count))
+
+if __name__ == "__main__":
+    main(sys.argv)
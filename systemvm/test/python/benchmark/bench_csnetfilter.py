@@ -0,0 +1,108 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+""" Time CsNetfilters.compare against fake iptables binaries
+
+Usage: python bench_csnetfilter.py [count ...]
+
+Every rule is new, so this measures a full convergence of an empty
+router, once applying every command through its own iptables process
+and once through iptables-restore.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../../../patches/debian/config/opt/cloud/bin"))
+
+import merge
+from cs.CsNetfilter import CsNetfilters
+
+IPTABLES_SAVE = """#!/bin/sh
+cat <<EOT
+*mangle
+:PREROUTING ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+COMMIT
+*nat
+:PREROUTING ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+COMMIT
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+COMMIT
+EOT
+"""
+
+FAKE = """#!/bin/sh
+cat > /dev/null
+exit 0
+"""
+
+
+def fake_binaries(path):
+    for name, script in [("iptables-save", IPTABLES_SAVE), ("iptables", "#!/bin/sh\nexit 0\n"), ("iptables-restore", FAKE)]:
+        fn = os.path.join(path, name)
+        handle = open(fn, "w")
+        handle.write(script)
+        handle.close()
+        os.chmod(fn, 0755)
+
+
+def rules(count):
+    fw = []
+    for i in range(count):
+        dev = "eth%s" % (2 + i % 8)
+        kind = i % 3
+        if kind == 0:
+            fw.append(["mangle", i / 3 + 1, "-A ACL_INBOUND_%s -s 10.%s.%s.0/24 -p tcp -m tcp --dport %s -j ACCEPT" % (dev, (i >> 16) & 255, (i >> 8) & 255, 1024 + i % 60000)])
+        elif kind == 1:
+            fw.append(["nat", "front", "-A PREROUTING -d 172.16.%s.%s/32 -j DNAT --to-destination 10.1.%s.%s" % ((i >> 8) & 255, i & 255, (i >> 8) & 255, i & 255)])
+        else:
+            fw.append(["filter", "", "-A FORWARD -d 10.1.%s.%s/32 -o %s -p tcp -m tcp --dport %s -j ACCEPT" % ((i >> 8) & 255, i & 255, dev, 1024 + i % 60000)])
+    return fw
+
+
+def converge(count, batch):
+    fw = rules(count)
+    start = time.time()
+    CsNetfilters(batch=batch).compare(fw)
+    return time.time() - start
+
+
+def main(argv):
+    counts = [int(x) for x in argv[1:]] or [100, 1000, 10000]
+    path = tempfile.mkdtemp()
+    try:
+        fake_binaries(path)
+        os.environ["PATH"] = "%s:%s" % (path, os.environ["PATH"])
+        merge.DataBag.DPATH = path
+        print "%8s %14s %14s" % ("rules", "per-rule (s)", "restore (s)")
+        for count in counts:
+            print "%8d %14.3f %14.3f" % (count, converge(count, False), converge(count, True))
+    finally:
+        shutil.rmtree(path, True)
+
+if __name__ == "__main__":
+    main(sys.argv)
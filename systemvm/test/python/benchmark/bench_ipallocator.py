@@ -0,0 +1,185 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+""" Time the ipallocator address pool on whole ranges
+
+Usage: python bench_ipallocator.py [prefixlen ...]
+
+Every address of the range is allocated and then released, once with
+the list the allocator used to keep (list.remove to allocate, a scan to
+find what was taken) and once with cloud_utils.IPPool writing its
+journal. The restart column replays the journal of a full pool. The
+augtool and dnsmasq restarts each request used to run are not counted.
+
+The second table fills the range through the allocateIP and releaseIP
+of cloud-external-ipallocator.py with its hosts file, which needs
+web.py. The rewrite column writes the whole hosts file again after every
+allocation as it used to be, the append column only adds the new line as
+allocateIP does now. Releases still rewrite the file, the release column
+is the time of one. The dnsmasq reloads are not counted, and ranges
+larger than a /20 are left out of this table.
+"""
+
+import imp
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "../../../../python/lib"))
+
+import cloud_utils
+
+ALLOCATOR = os.path.join(HERE, "../../../../python/bindir/cloud-external-ipallocator.py")
+RELEASES = 100
+# rewriting the hosts file on every allocation is quadratic, larger
+# ranges take hours
+REWRITE_PREFIXLEN = 20
+
+START = "10.0.0.1"
+
+
+def ip_range(prefixlen):
+    start = struct.unpack("!I", socket.inet_aton(START))[0]
+    end = start + (1 << (32 - prefixlen)) - 3
+    return START, socket.inet_ntoa(struct.pack("!I", end))
+
+
+def mac(i):
+    return "06:00:00:%02x:%02x:%02x" % ((i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+
+def legacy(start, end):
+    first = struct.unpack("!I", socket.inet_aton(start))[0]
+    last = struct.unpack("!I", socket.inet_aton(end))[0]
+    avail = []
+    for ip in range(first, last + 1):
+        avail.append(ip)
+    allocated = []
+    while len(avail) > 0:
+        ip = avail[0]
+        avail.remove(ip)
+        allocated.append(ip)
+    for ip in allocated:
+        if ip not in avail:
+            avail.append(ip)
+    return len(allocated)
+
+
+def bitmap(start, end, journal):
+    pool = cloud_utils.IPPool(start, end)
+    pool.open(journal)
+    allocated = []
+    ip = pool.allocate(mac(0))
+    while ip:
+        allocated.append(ip)
+        ip = pool.allocate(mac(len(allocated)))
+    full = time.time()
+    pool.close()
+    pool = cloud_utils.IPPool(start, end)
+    pool.open(journal)
+    restart = time.time() - full
+    assert pool.free == 0
+    for ip in allocated:
+        assert pool.release(ip)
+    pool.close()
+    return len(allocated), restart
+
+
+def allocator(start, end, folder):
+    """ A dhcp instance of the ipallocator on its own pool and hosts file,
+    without the augtool calls of its constructor or the dnsmasq reloads """
+    ipallocator = imp.load_source("ipallocator", ALLOCATOR)
+    ipallocator.HOSTSFILE = os.path.join(folder, "dhcp-hosts")
+
+    class Allocator(ipallocator.dhcp):
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.pool = cloud_utils.IPPool(start, end)
+            self.pool.open(os.path.join(folder, "allocations"))
+            self.writeHostsfile()
+
+        def reloadHosts(self):
+            pass
+
+    return Allocator(), ipallocator.HOSTSFILE
+
+
+def rewrite(dhcp):
+    ip = dhcp.getFreeIP(mac(0))
+    while ip:
+        dhcp.writeHostsfile()
+        ip = dhcp.getFreeIP(mac(dhcp.pool.size - dhcp.pool.free))
+
+
+def append(dhcp):
+    ip = dhcp.allocateIP(mac(0))
+    while ip:
+        ip = dhcp.allocateIP(mac(dhcp.pool.size - dhcp.pool.free))
+
+
+def release(dhcp, hostsfile):
+    for ip, owner in dhcp.pool.allocated()[:RELEASES]:
+        dhcp.releaseIP(ip)
+    hosts = sorted(line.strip() for line in file(hostsfile))
+    assert hosts == sorted("%s,%s" % (owner, ip) for ip, owner in dhcp.pool.allocated())
+
+
+def hostsfile(start, end, folder, fill):
+    os.mkdir(folder)
+    dhcp, path = allocator(start, end, folder)
+    elapsed = timed(fill, dhcp)[0]
+    assert dhcp.pool.free == 0
+    released = timed(release, dhcp, path)[0]
+    dhcp.pool.close()
+    return dhcp.pool.size, elapsed, released / RELEASES
+
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+
+def main(argv):
+    prefixes = [int(x) for x in argv[1:]] or [20, 16]
+    folder = tempfile.mkdtemp()
+    try:
+        print "%10s %14s %14s %14s" % ("addresses", "list (s)", "bitmap (s)", "restart (s)")
+        for prefixlen in prefixes:
+            start, end = ip_range(prefixlen)
+            old, count = timed(legacy, start, end)
+            new, result = timed(bitmap, start, end, os.path.join(folder, "journal%d" % prefixlen))
+            assert result[0] == count
+            print "%10d %14.3f %14.3f %14.3f" % (count, old, new - result[1], result[1])
+        print ""
+        print "%10s %14s %14s %14s" % ("addresses", "rewrite (s)", "append (s)", "release (ms)")
+        for prefixlen in [p for p in prefixes if p >= REWRITE_PREFIXLEN]:
+            start, end = ip_range(prefixlen)
+            old = hostsfile(start, end, os.path.join(folder, "rewrite%d" % prefixlen), rewrite)
+            new = hostsfile(start, end, os.path.join(folder, "append%d" % prefixlen), append)
+            print "%10d %14.3f %14.3f %14.3f" % (new[0], old[1], new[1], new[2] * 1000)
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,115 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+
+""" Time the perfmon rrd_updates parser on a synthetic document
+
+Usage: python bench_perfmon.py [vms ...]
+
+Every VM has 4 vcpus and the two memory counters, with 60 rows of
+samples. The cpu and memory averages of every VM are computed from the
+document, once the way perfmon used to (a minidom tree and a float()
+of toxml() per sample) and once with RRDData. Needs the XenAPI module.
+"""
+
+import os
+import random
+import sys
+import time
+from StringIO import StringIO
+from xml.dom import minidom
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../../../../scripts/vm/hypervisor/xenserver"))
+
+import perfmon
+
+ROWS = 60
+PARAMS = ["cpu0", "cpu1", "cpu2", "cpu3", "memory_target", "memory_internal_free"]
+
+
+def document(vms):
+    legend = []
+    for vm in range(vms):
+        for param in PARAMS:
+            legend.append("<entry>AVERAGE:vm:%08d-0000-0000-0000-000000000000:%s</entry>" % (vm, param))
+    rows = []
+    end = 1500000000
+    for row in range(ROWS):
+        values = "".join(["<v>%.4f</v>" % random.random() for i in range(len(legend))])
+        rows.append("<row><t>%d</t>%s</row>" % (end - row * 60, values))
+    return ("<xport><meta><start>%d</start><step>60</step><end>%d</end><rows>%d</rows><columns>%d</columns>"
+            "<legend>%s</legend></meta><data>%s</data></xport>") % (end - ROWS * 60, end, ROWS, len(legend), "".join(legend), "".join(rows))
+
+
+def legacy(source, vms):
+    data_node = minidom.parseString(source).firstChild.childNodes[1]
+
+    def lookup(col, row):
+        node = data_node.childNodes[ROWS - 1 - row].childNodes[col + 1]
+        return float(node.firstChild.toxml())
+
+    result = []
+    for vm in range(vms):
+        base = vm * len(PARAMS)
+        cpu = 0
+        for row in range(ROWS):
+            for col in range(4):
+                cpu += lookup(base + col, row)
+        memory = 0
+        for row in range(ROWS):
+            memory += lookup(base + 4, row) / 1048576 - lookup(base + 5, row) / 1024
+        result.append((cpu / (ROWS * 4), memory / ROWS))
+    return result
+
+
+def arrays(source, vms):
+    rrd_updates = perfmon.RRDUpdates()
+    rrd = perfmon.RRDData()
+    rrd.parse(StringIO(source))
+    rrd_updates.parse_rrd(rrd)
+    result = []
+    for vm in range(vms):
+        uuid = "%08d-0000-0000-0000-000000000000" % vm
+        cpu = 0
+        for col in range(4):
+            cpu += rrd_updates.get_vm_sum(uuid, "cpu%d" % col, 0, ROWS)
+        memory = rrd_updates.get_vm_sum(uuid, "memory_target", 0, ROWS) / 1048576 - \
+            rrd_updates.get_vm_sum(uuid, "memory_internal_free", 0, ROWS) / 1024
+        result.append((cpu / (ROWS * 4), memory / ROWS))
+    return result
+
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+
+def main(argv):
+    counts = [int(x) for x in argv[1:]] or [50, 500]
+    print "%8s %14s %14s" % ("vms", "minidom (s)", "arrays (s)")
+    for count in counts:
+        source = document(count)
+        old, expected = timed(legacy, source, count)
+        new, result = timed(arrays, source, count)
+        for a, b in zip(expected, result):
+            assert abs(a[0] - b[0]) < 1e-9 and abs(a[1] - b[1]) < 1e-9
+        print "%8d %14.3f %14.3f" % (count, old, new)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,123 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+
+""" Time security_group.py against fake iptables/ebtables/ipset binaries
+
+Usage: python bench_security_group.py [rules ...]
+
+Programs the default rules and then a rule set with 10 cidrs per rule
+for a new vm, once through one process per rule and once through the
+restore commands. Needs the libvirt python bindings of a KVM host.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+base = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(base, "../../../../python/lib"))
+sys.path.insert(0, os.path.join(base, "../../../../scripts/vm/network"))
+
+import security_group
+
+FAKE = """#!/bin/sh
+echo $0 >> %s
+exit 0
+"""
+
+RESTORE = """#!/bin/sh
+echo $0 >> %s
+cat > /dev/null
+exit 0
+"""
+
+IPSET = """#!/bin/sh
+echo $0 >> %s
+[ "$1" = "restore" ] && cat > /dev/null
+exit 0
+"""
+
+EBTABLES_SAVE = """#!/bin/sh
+echo $0 >> %s
+cat <<EOT
+*nat
+:PREROUTING ACCEPT
+:OUTPUT ACCEPT
+:POSTROUTING ACCEPT
+EOT
+"""
+
+BINARIES = ["iptables", "iptables-save", "ebtables", "sysctl", "brctl"]
+
+
+def fake_binaries(path, counter):
+    scripts = [(name, FAKE % counter) for name in BINARIES] + [("ebtables-save", EBTABLES_SAVE % counter), ("ipset", IPSET % counter)]
+    scripts += [(name, RESTORE % counter) for name in ["iptables-restore", "ebtables-restore"]]
+    for name, script in scripts:
+        fn = os.path.join(path, name)
+        handle = open(fn, "w")
+        handle.write(script)
+        handle.close()
+        os.chmod(fn, 0755)
+
+
+def rules(count):
+    lines = []
+    for i in range(count):
+        cidrs = "".join("10.%s.%s.0/24," % (i & 255, j) for j in range(10))
+        if i % 2:
+            lines.append("I:tcp:%s:%s:%s" % (1024 + i, 1024 + i, cidrs))
+        else:
+            lines.append("E:udp:%s:%s:%s" % (1024 + i, 1024 + i, cidrs))
+    return ";".join(lines) + ";"
+
+
+def program(count, batch, counter):
+    security_group.batch_rules = batch
+    open(counter, "w").close()
+    for log in [security_group.logpath + "i-2-3-VM.log", security_group.logpath + "i-2-3-VM.ip"]:
+        if os.path.exists(log):
+            os.remove(log)
+    start = time.time()
+    security_group.add_network_rules("i-2-3-VM", "3", "10.1.1.10", "sig", "1", "06:00:00:00:00:01",
+                                     rules(count), "vnet0", "cloudbr0", "0:")
+    elapsed = time.time() - start
+    return elapsed, len(open(counter).readlines())
+
+
+def main(argv):
+    counts = [int(x) for x in argv[1:]] or [10, 100, 500]
+    path = tempfile.mkdtemp()
+    try:
+        counter = os.path.join(path, "count")
+        fake_binaries(path, counter)
+        os.environ["PATH"] = "%s:%s" % (path, os.environ["PATH"])
+        security_group.logpath = path + "/"
+        security_group.getvmId = lambda vmName: "1"
+        print "%8s %14s %10s %14s %10s" % ("rules", "per-rule (s)", "processes", "restore (s)", "processes")
+        for count in counts:
+            legacy = program(count, False, counter)
+            batch = program(count, True, counter)
+            print "%8d %14.3f %10d %14.3f %10d" % (count, legacy[0], legacy[1], batch[0], batch[1])
+    finally:
+        shutil.rmtree(path, True)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -17,12 +17,15 @@
 
 import threading
 from marvin import cloudstackException
+from marvin.cloudstackAPI import queryAsyncJobResult
+from marvin.codes import JOB_INPROGRESS, JOB_SUCCEEDED
 import time
 import Queue
 import copy
 import sys
 import jsonHelper
 import datetime
+from marvin.jobWaiter import JobWaiter
 
 
 class job(object):
@@ -42,36 +45,75 @@ class jobStatus(object):
         self.duration = None
         self.jobId = None
         self.responsecls = None
+        # wall clock times of the request, its response and the
+        # completion of its job, used for the latency statistics
+        self.submitted = None
+        self.accepted = None
+        self.completed = None
 
     def __str__(self):
         return '{%s}' % str(', '.join('%s : %s' % (k, repr(v)) for (k, v)
                                       in self.__dict__.iteritems()))
 
 
+def queryJob(connection, job):
+    '''asks for the result of one job, job.completed stays None while
+    it is in progress'''
+    cmd = queryAsyncJobResult.queryAsyncJobResultCmd()
+    cmd.jobid = job.jobId
+    try:
+        response = connection.marvinRequest(
+            cmd, response_type=job.responsecls)
+        if response.jobstatus == JOB_INPROGRESS:
+            return job
+        job.result = response.jobresult
+        job.status = response.jobstatus == JOB_SUCCEEDED
+    except cloudstackException.CloudstackAPIException as e:
+        job.result = str(e)
+        job.status = False
+    job.completed = time.time()
+    return job
+
+
+class rateLimiter(object):
+
+    '''spaces the calls to wait() so that at most rate of them return
+    per second, across all the threads sharing it'''
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next = time.time()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
 class workThread(threading.Thread):
 
-    def __init__(self, in_queue, outqueue, apiClient, db=None, lock=None):
+    def __init__(self, in_queue, outqueue, apiClient, db=None, lock=None,
+                 limiter=None):
         threading.Thread.__init__(self)
         self.inqueue = in_queue
         self.output = outqueue
+        # every worker has a connection of its own, nothing is shared
+        # between requests running at the same time
         self.connection = apiClient.connection.__copy__()
         self.db = None
         self.lock = lock
+        self.limiter = limiter or rateLimiter()
 
     def queryAsynJob(self, job):
         if job.jobId is None:
             return job
-
-        try:
-            self.lock.acquire()
-            result = self.connection.poll(job.jobId, job.responsecls).jobresult
-        except cloudstackException.CloudstackAPIException as e:
-            result = str(e)
-        finally:
-            self.lock.release()
-
-        job.result = result
-        return job
+        return queryJob(self.connection, job)
 
     def executeCmd(self, job):
         cmd = job.cmd
@@ -79,19 +121,22 @@ class workThread(threading.Thread):
         jobstatus = jobStatus()
         jobId = None
         try:
-            self.lock.acquire()
+            self.limiter.wait()
+            jobstatus.submitted = time.time()
 
             if cmd.isAsync == "false":
                 jobstatus.startTime = datetime.datetime.now()
 
-                result = self.connection.marvin_request(cmd)
+                result = self.connection.marvinRequest(cmd)
                 jobstatus.result = result
                 jobstatus.endTime = datetime.datetime.now()
                 jobstatus.duration =\
                     time.mktime(jobstatus.endTime.timetuple()) - time.mktime(
                         jobstatus.startTime.timetuple())
+                jobstatus.accepted = jobstatus.completed = time.time()
             else:
-                result = self.connection.marvinRequest(cmd)
+                result = self.connection.marvinRequest(cmd, wait=False)
+                jobstatus.accepted = time.time()
                 if result is None:
                     jobstatus.status = False
                 else:
@@ -111,14 +156,15 @@ class workThread(threading.Thread):
         except:
             jobstatus.status = False
             jobstatus.result = sys.exc_info()
-        finally:
-            self.lock.release()
 
         return jobstatus
 
     def run(self):
-        while self.inqueue.qsize() > 0:
-            job = self.inqueue.get()
+        while True:
+            try:
+                job = self.inqueue.get_nowait()
+            except Queue.Empty:
+                break
             if isinstance(job, jobStatus):
                 jobstatus = self.queryAsynJob(job)
             else:
@@ -128,6 +174,68 @@ class workThread(threading.Thread):
             self.inqueue.task_done()
 
 
+class jobPoller(object):
+
+    '''
+    waits for many async jobs at once through the JobWaiter of the
+    connection, which checks the jobs due together in one listAsyncJobs
+    call. rounds counts the checks made while waiting.
+    '''
+
+    def __init__(self, apiClient, timeout=None):
+        self.waiter = JobWaiter.forConnection(apiClient.connection)
+        self.timeout = timeout or apiClient.connection.asyncTimeout
+        self.rounds = 0
+
+    def complete(self, jobstatus, future):
+        jobstatus.completed = future.completed
+        try:
+            response = future.result(0)
+        except Exception as e:
+            jobstatus.status = False
+            jobstatus.result = str(e)
+            return
+        jobstatus.status = response.jobstatus == JOB_SUCCEEDED
+        jobstatus.result = response.jobresult if jobstatus.status \
+            else str(response.jobresult)
+
+    def wait(self, jobs):
+        '''waits until every job in the list of jobStatus completed or
+        the timeout expired'''
+        rounds = self.waiter.rounds
+        outstanding = [(j, self.waiter.submit(j.jobId, j.responsecls))
+                       for j in jobs
+                       if j.jobId is not None and j.completed is None]
+        deadline = time.time() + self.timeout
+        for jobstatus, future in outstanding:
+            future.event.wait(max(deadline - time.time(), 0))
+            if future.done():
+                self.complete(jobstatus, future)
+            else:
+                self.waiter.cancel(future)
+                jobstatus.status = False
+                jobstatus.result = "Job %s timed out" % jobstatus.jobId
+        self.rounds = self.waiter.rounds - rounds
+
+
+def percentile(values, pct):
+    '''the pct percentile of a sorted list, None if it is empty'''
+    if not values:
+        return None
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+def latencyStats(values):
+    values = sorted(values)
+    stats = {"count": len(values)}
+    if values:
+        stats["mean"] = sum(values) / len(values)
+        stats["max"] = values[-1]
+    for pct in (50, 90, 95, 99):
+        stats["p%d" % pct] = percentile(values, pct)
+    return stats
+
+
 class jobThread(threading.Thread):
 
     def __init__(self, inqueue, interval):
@@ -156,12 +264,22 @@ class outputDict(object):
 
 class asyncJobMgr(object):
 
-    def __init__(self, apiClient, db):
+    '''
+    submits commands from concurrency worker threads, each with a
+    connection of its own, at most rate of them per second when rate
+    is set. The async jobs are then waited for together, see jobPoller.
+    The latencies of the last run are in self.stats, see getStats().
+    '''
+
+    def __init__(self, apiClient, db, concurrency=10, rate=None):
         self.inqueue = Queue.Queue()
         self.output = outputDict()
         self.outqueue = Queue.Queue()
         self.apiClient = apiClient
         self.db = db
+        self.concurrency = concurrency
+        self.limiter = rateLimiter(rate)
+        self.stats = None
 
     def submitCmds(self, cmds):
         if not self.inqueue.empty():
@@ -193,37 +311,67 @@ class asyncJobMgr(object):
                     delta = jobstatus.endTime - jobstatus.startTime
                     jobstatus.duration = delta.total_seconds()
 
-    def waitForComplete(self, workers=10):
+    def startWorkers(self, inqueue, outqueue, workers):
+        threads = []
+        for i in range(min(workers, max(inqueue.qsize(), 1))):
+            worker = workThread(inqueue, outqueue, self.apiClient,
+                                self.db, limiter=self.limiter)
+            worker.start()
+            threads.append(worker)
+        return threads
+
+    def waitForComplete(self, workers=None):
         self.inqueue.join()
-        lock = threading.Lock()
-        resultQueue = Queue.Queue()
         '''intermediate result is stored in self.outqueue'''
-        for i in range(workers):
-            worker = workThread(self.outqueue, resultQueue, self.apiClient,
-                                self.db, lock)
-            worker.start()
+        submitted = []
+        while self.outqueue.qsize() > 0:
+            submitted.append(self.outqueue.get())
+            self.outqueue.task_done()
 
-        self.outqueue.join()
+        poller = jobPoller(self.apiClient)
+        poller.wait(submitted)
 
         asyncJobResult = []
-        while resultQueue.qsize() > 0:
-            jobstatus = resultQueue.get()
+        for jobstatus in submitted:
             self.updateTimeStamp(jobstatus)
             asyncJobResult.append(jobstatus)
 
+        self.stats = self.getStats(asyncJobResult)
+        self.stats["pollRounds"] = poller.rounds
         return asyncJobResult
 
-    def submitCmdsAndWait(self, cmds, workers=10):
+    def getStats(self, jobs):
+        '''
+        submit latency is from sending a command to getting its job id,
+        complete latency from sending it to seeing its job complete. All
+        in seconds, with the mean, max and 50/90/95/99th percentiles
+        '''
+        submitted = [j for j in jobs if j.submitted is not None]
+        stats = {"jobs": len(jobs),
+                 "failed": len([j for j in jobs if not j.status]),
+                 "submit": latencyStats([j.accepted - j.submitted
+                                         for j in submitted
+                                         if j.accepted is not None]),
+                 "complete": latencyStats([j.completed - j.submitted
+                                           for j in submitted
+                                           if j.completed is not None])}
+        if submitted:
+            end = max([j.completed or j.accepted or j.submitted
+                       for j in submitted])
+            elapsed = end - min([j.submitted for j in submitted])
+            stats["elapsed"] = elapsed
+            stats["throughput"] = len(submitted) / elapsed if elapsed else None
+        return stats
+
+    def submitCmdsAndWait(self, cmds, workers=None):
         '''
             put commands into a queue at first, then start workers numbers
-            threads to execute this commands
+            threads to execute this commands, concurrency of them when
+            workers is not given
         '''
         self.submitCmds(cmds)
-        lock = threading.Lock()
-        for i in range(workers):
-            worker = workThread(self.inqueue, self.outqueue, self.apiClient,
-                                self.db, lock)
-            worker.start()
+        self.startWorkers(self.inqueue, self.outqueue,
+                          workers or self.concurrency)
 
         return self.waitForComplete(workers)
 
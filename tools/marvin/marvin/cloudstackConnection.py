@@ -21,19 +21,99 @@ import base64
 import hmac
 import hashlib
 import time
-from cloudstackAPI import queryAsyncJobResult
+import bisect
+import threading
+from requests.adapters import HTTPAdapter
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    Retry = None
 import jsonHelper
+from marvin.jobWaiter import JobWaiter, recordWait
 from marvin.codes import (
     FAILED,
-    JOB_FAILED,
-    JOB_CANCELLED,
-    JOB_SUCCEEDED
+    JOB_FAILED
 )
 from marvin.cloudstackException import (
     InvalidParameterException,
     GetDetailExceptionInfo)
 
 
+class RequestTimer(object):
+
+    '''
+    @Desc: Latency of the API commands sent through the connections
+           sharing it, as a histogram per command.
+           Hooks added with addHook are called after every request
+           with the command name, the seconds it took and the HTTP
+           status, None when no response came back
+    '''
+
+    BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.totals = {}
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+
+    def record(self, command, seconds, status):
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            if command not in self.histograms:
+                self.histograms[command] = [0] * (len(self.BUCKETS) + 1)
+            self.histograms[command][bucket] += 1
+            count, total, longest = self.totals.get(command, (0, 0.0, 0.0))
+            self.totals[command] = (count + 1, total + seconds,
+                                    max(longest, seconds))
+        for hook in self.hooks:
+            hook(command, seconds, status)
+
+    def histogram(self, command):
+        '''
+        @Desc: number of requests of command that took up to each of
+               BUCKETS seconds, the last count is for longer ones
+        '''
+        with self.lock:
+            return list(self.histograms.get(command, []))
+
+    def percentile(self, command, pct):
+        '''upper bound of the bucket holding the pct percentile'''
+        histogram = self.histogram(command)
+        wanted = pct / 100.0 * sum(histogram)
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if count and seen >= wanted:
+                if bucket < len(self.BUCKETS):
+                    return self.BUCKETS[bucket]
+                return self.totals[command][2]
+        return None
+
+    def report(self):
+        lines = ["%-40s %8s %9s %9s %9s %9s" %
+                 ("command", "count", "mean (s)", "p50 (s)", "p95 (s)",
+                  "max (s)")]
+        for command in sorted(self.totals):
+            count, total, longest = self.totals[command]
+            lines.append("%-40s %8d %9.3f %9.3f %9.3f %9.3f" %
+                         (command, count, total / count,
+                          self.percentile(command, 50),
+                          self.percentile(command, 95), longest))
+        return "\n".join(lines)
+
+
+# Shared by every connection that is not given a timer of its own
+REQUEST_TIMER = RequestTimer()
+
+
 class CSConnection(object):
 
     '''
@@ -44,7 +124,7 @@ class CSConnection(object):
     '''
 
     def __init__(self, mgmtDet, asyncTimeout=3600, logger=None,
-                 path='client/api'):
+                 path='client/api', timer=None):
         self.apiKey = mgmtDet.apiKey
         self.securityKey = mgmtDet.securityKey
         self.mgtSvr = mgmtDet.mgtSvrIp
@@ -68,48 +148,82 @@ class CSConnection(object):
         self.httpsFlag = True if self.protocol == "https" else False
         self.baseUrl = "%s://%s:%d/%s"\
                        % (self.protocol, self.mgtSvr, self.port, self.path)
+        '''
+        Optional settings of the management server in the config:
+        poolSize: connections kept open to the server
+        retries: attempts to connect before a request fails
+        timeout: seconds to wait for a response, forever by default
+        '''
+        self.poolSize = getattr(mgmtDet, "poolSize", None) or 10
+        self.retries = getattr(mgmtDet, "retries", None) or self.retries
+        self.timeout = getattr(mgmtDet, "timeout", None)
+        self.timer = timer or REQUEST_TIMER
+        self.session = self.__createSession()
 
     def __copy__(self):
+        '''
+        @Desc: A connection with a session of its own, for another
+               thread. Its requests are timed with the same timer
+        '''
         return CSConnection(self.mgtDetails,
                             self.asyncTimeout,
                             self.logger,
-                            self.path)
+                            self.path,
+                            self.timer)
+
+    def __createSession(self):
+        '''
+        @Name : __createSession
+        @Desc : A session keeps the connections to the server open
+                between requests, so they do not all pay a new TCP
+                and TLS handshake. Only failures to connect are
+                retried, the API commands are not idempotent
+        '''
+        if Retry is not None:
+            retries = Retry(total=self.retries, read=False,
+                            backoff_factor=0.5)
+        else:
+            retries = self.retries
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.poolSize,
+                              max_retries=retries)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.cert = self.certPath or None
+        session.verify = self.httpsFlag
+        return session
+
+    def close(self):
+        '''
+        @Name : close
+        @Desc : Closes the connections of the session
+        '''
+        self.session.close()
 
     def __poll(self, jobid, response_cmd):
         '''
         @Name : __poll
-        @Desc: polls for the completion of a given jobid
+        @Desc: waits for the completion of a given jobid, polled
+               along with the other jobs of the server by its JobWaiter
         @Input 1. jobid: Monitor the Jobid for CS
                2. response_cmd:response command for request cmd
         @return: FAILED if jobid is cancelled,failed
                  Else return async_response
         '''
         try:
-            cmd = queryAsyncJobResult.queryAsyncJobResultCmd()
-            cmd.jobid = jobid
-            timeout = self.asyncTimeout
             start_time = time.time()
-            end_time = time.time()
-            async_response = FAILED
             self.logger.debug("=== Jobid: %s Started ===" % (str(jobid)))
-            while timeout > 0:
-                async_response = self.\
-                    marvinRequest(cmd, response_type=response_cmd)
-                if async_response != FAILED:
-                    job_status = async_response.jobstatus
-                    if job_status in [JOB_CANCELLED,
-                                      JOB_SUCCEEDED]:
-                        break
-                    elif job_status == JOB_FAILED:
-                        raise Exception("Job failed: %s"\
-                                         % async_response)
-                time.sleep(5)
-                timeout -= 5
-                self.logger.debug("=== JobId:%s is Still Processing, "
-                                  "Will TimeOut in:%s ====" % (str(jobid),
-                                                               str(timeout)))
+            async_response = JobWaiter.forConnection(self).\
+                wait(jobid, response_cmd, self.asyncTimeout)
+            if async_response is None:
+                raise Exception("Job %s timed out after %s seconds" %
+                                (str(jobid), str(self.asyncTimeout)))
+            elif async_response.jobstatus == JOB_FAILED:
+                raise Exception("Job failed: %s" % async_response)
             end_time = time.time()
-            tot_time = int(start_time - end_time)
+            recordWait(end_time - start_time, 5)
+            tot_time = int(end_time - start_time)
             self.logger.debug(
                 "===Jobid:%s ; StartTime:%s ; EndTime:%s ; "
                 "TotalTime:%s===" %
@@ -161,10 +275,9 @@ class CSConnection(object):
                  else FAILED
         '''
         try:
-            response = requests.post(url,
-                                     params=payload,
-                                     cert=self.certPath,
-                                     verify=self.httpsFlag)
+            response = self.session.post(url,
+                                         params=payload,
+                                         timeout=self.timeout)
             return response
         except Exception as e:
             self.__lastError = e
@@ -183,10 +296,9 @@ class CSConnection(object):
                  else FAILED
         '''
         try:
-            response = requests.get(url,
-                                    params=payload,
-                                    cert=self.certPath,
-                                    verify=self.httpsFlag)
+            response = self.session.get(url,
+                                        params=payload,
+                                        timeout=self.timeout)
             return response
         except Exception as e:
             self.__lastError = e
@@ -218,14 +330,19 @@ class CSConnection(object):
             # request
             if self.protocol in ["http", "https"]:
                 self.logger.debug("Payload: %s" % str(payload))
+                start = time.time()
+                response = FAILED
                 if method == 'POST':
                     self.logger.debug("=======Sending POST Cmd : %s======="
                                       % str(command))
-                    return self.__sendPostReqToCS(self.baseUrl, payload)
+                    response = self.__sendPostReqToCS(self.baseUrl, payload)
                 if method == "GET":
                     self.logger.debug("========Sending GET Cmd : %s======="
                                       % str(command))
-                    return self.__sendGetReqToCS(self.baseUrl, payload)
+                    response = self.__sendGetReqToCS(self.baseUrl, payload)
+                self.timer.record(command, time.time() - start,
+                                  getattr(response, "status_code", None))
+                return response
             else:
                 self.logger.exception("__sendCmdToCS: Invalid Protocol")
                 return FAILED
@@ -326,13 +443,17 @@ class CSConnection(object):
                 exception("Exception:%s" % GetDetailExceptionInfo(e))
             return FAILED
 
-    def marvinRequest(self, cmd, response_type=None, method='GET', data=''):
+    def marvinRequest(self, cmd, response_type=None, method='GET', data='',
+                      wait=True):
         """
         @Name : marvinRequest
         @Desc: Handles Marvin Requests
         @Input  cmd: marvin's command from cloudstackAPI
                 response_type: response type of the command in cmd
                 method: HTTP GET/POST, defaults to GET
+                wait: poll an asynchronous command until its job
+                      completes, else return the response holding
+                      its jobid right away
         @Output: Response received from CS
                  Exception in case of Error\Exception
         """
@@ -369,7 +490,7 @@ class CSConnection(object):
             '''
             ret = self.__parseAndGetResponse(cmd_response,
                                              response_type,
-                                             is_async)
+                                             is_async if wait else "false")
             if ret == FAILED:
                 raise self.__lastError
             return ret
@@ -0,0 +1,239 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Waits for async jobs from a single thread per management server and
+account, instead of one polling loop per job. Every job is first
+checked a quarter of a second after it was submitted, then at
+doubling intervals up to 5 seconds. The jobs due at the same time are
+checked together with one listAsyncJobs when there are several.
+"""
+
+import math
+import threading
+import time
+import jsonHelper
+from marvin.cloudstackAPI import listAsyncJobs, queryAsyncJobResult
+from marvin.codes import JOB_INPROGRESS
+
+_savings = {"seconds": 0.0}
+_savingsLock = threading.Lock()
+
+
+def recordWait(elapsed, oldInterval):
+    '''
+    @Desc: adds how much later than after elapsed seconds a wait
+           checking every oldInterval seconds would have returned
+    '''
+    saved = math.ceil(elapsed / oldInterval) * oldInterval - elapsed
+    with _savingsLock:
+        _savings["seconds"] += saved
+
+
+def savedTime():
+    '''seconds of waiting saved so far, see recordWait'''
+    with _savingsLock:
+        return _savings["seconds"]
+
+
+class jobFuture(object):
+
+    '''the response of queryAsyncJobResult for a job, once it completed'''
+
+    def __init__(self, jobid, responsecls, interval):
+        self.jobid = jobid
+        self.responsecls = responsecls
+        self.submitted = time.time()
+        self.completed = None
+        self.interval = interval
+        self.due = self.submitted + interval
+        self.response = None
+        self.error = None
+        self.event = threading.Event()
+
+    def done(self):
+        return self.event.isSet()
+
+    def complete(self, response=None, error=None):
+        self.response = response
+        self.error = error
+        self.completed = time.time()
+        self.event.set()
+
+    def result(self, timeout=None):
+        '''
+        @Desc: waits for the job to complete, None when timeout seconds
+               passed before. Raises the error of the last check of the
+               job if it failed
+        '''
+        self.event.wait(timeout)
+        if not self.done():
+            return None
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class JobWaiter(object):
+
+    MIN_INTERVAL = 0.25
+    MAX_INTERVAL = 5
+    # jobs due together that are listed rather than queried one by one
+    BATCH = 2
+    PAGESIZE = 500
+    # allowance for the clocks of the client and the management server
+    CLOCK_SKEW = 300
+
+    __waiters = {}
+    __waitersLock = threading.Lock()
+
+    @classmethod
+    def forConnection(cls, connection):
+        '''the waiter of the server and account of connection'''
+        key = (connection.baseUrl, connection.apiKey)
+        with cls.__waitersLock:
+            if key not in cls.__waiters:
+                cls.__waiters[key] = cls(connection.__copy__())
+            return cls.__waiters[key]
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.futures = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.listable = True
+        self.rounds = 0
+
+    def submit(self, jobid, responsecls=None):
+        future = jobFuture(jobid, responsecls, self.MIN_INTERVAL)
+        with self.condition:
+            self.futures.append(future)
+            if self.thread is None or not self.thread.isAlive():
+                self.thread = threading.Thread(target=self.run,
+                                               name="JobWaiter")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def cancel(self, future):
+        with self.condition:
+            if future in self.futures:
+                self.futures.remove(future)
+
+    def wait(self, jobid, responsecls=None, timeout=None):
+        '''
+        @Desc: the queryAsyncJobResult response of the job once it is no
+               longer in progress, None if it still is after timeout
+        '''
+        future = self.submit(jobid, responsecls)
+        response = future.result(timeout)
+        if response is None:
+            self.cancel(future)
+        return response
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.time()
+                    due = [f for f in self.futures if f.due <= now]
+                    if due:
+                        break
+                    if self.futures:
+                        self.condition.wait(
+                            min([f.due for f in self.futures]) - now)
+                    else:
+                        self.condition.wait()
+            try:
+                self.poll(due)
+            except Exception as e:
+                # the jobs are checked again, the waiter must not die
+                self.connection.logger.exception(
+                    "JobWaiter: polling failed: %s" % e)
+                with self.condition:
+                    for future in due:
+                        future.due = time.time() + self.MAX_INTERVAL
+
+    def poll(self, due):
+        self.rounds += 1
+        jobids = set([f.jobid for f in due])
+        responses = {}
+        if len(jobids) >= self.BATCH and self.listable:
+            try:
+                responses = self.listJobs(min([f.submitted for f in due]))
+            except Exception as e:
+                # the account may not list jobs, query them one by one
+                self.listable = False
+                self.connection.logger.debug(
+                    "JobWaiter: listAsyncJobs failed: %s" % e)
+        for jobid in jobids:
+            if jobid not in responses:
+                try:
+                    responses[jobid] = self.queryJob(jobid)
+                except Exception as e:
+                    responses[jobid] = e
+
+        now = time.time()
+        with self.condition:
+            for future in due:
+                response = responses[future.jobid]
+                if isinstance(response, Exception):
+                    future.complete(error=response)
+                elif response.jobstatus != JOB_INPROGRESS:
+                    future.complete(response=self.finalize(response,
+                                                           future))
+                else:
+                    future.interval = min(future.interval * 2,
+                                          self.MAX_INTERVAL)
+                    future.due = now + future.interval
+                    continue
+                self.futures.remove(future)
+
+    def finalize(self, response, future):
+        '''the job result as an object of the response class'''
+        response = jsonHelper.jsonLoader(response.__dict__)
+        if response.jobresult is not None and \
+                future.responsecls is not None:
+            response.jobresult = jsonHelper.finalizeResultObj(
+                response.jobresult, None, future.responsecls)
+        return response
+
+    def queryJob(self, jobid):
+        cmd = queryAsyncJobResult.queryAsyncJobResultCmd()
+        cmd.jobid = jobid
+        return self.connection.marvinRequest(cmd)
+
+    def listJobs(self, since):
+        '''all the jobs started after since, by job id'''
+        jobs = {}
+        page = 1
+        while True:
+            cmd = listAsyncJobs.listAsyncJobsCmd()
+            cmd.listall = True
+            cmd.startdate = time.strftime(
+                "%Y-%m-%dT%H:%M:%S+0000",
+                time.gmtime(since - self.CLOCK_SKEW))
+            cmd.page = page
+            cmd.pagesize = self.PAGESIZE
+            response = self.connection.marvinRequest(
+                cmd, response_type=listAsyncJobs.listAsyncJobsResponse())
+            for job in response or []:
+                jobs[job.jobid] = job
+            if not response or len(response) < self.PAGESIZE:
+                return jobs
+            page += 1
@@ -26,7 +26,7 @@ from marvin.codes import (FAILED, FAIL, PASS, RUNNING, STOPPED,
                           STOPPING, BACKED_UP, BACKING_UP,
                           HOST_RS_MAINTENANCE)
 from marvin.cloudstackException import GetDetailExceptionInfo, CloudstackAPIException
-from marvin.lib.utils import validateList, is_server_ssh_ready, random_gen, wait_until
+from marvin.lib.utils import validateList, is_server_ssh_ready, random_gen, wait_until, wait_for_state
 # Import System modules
 import time
 import hashlib
@@ -679,28 +679,18 @@ class VirtualMachine:
                        to expected state in given time else PASS
                        2) Reason - Reason for failure"""
 
-        returnValue = [FAIL, "VM state not trasited to %s,\
-                        operation timed out" % state]
+        def fetch():
+            projectid = None
+            if hasattr(self, "projectid"):
+                projectid = self.projectid
+            vms = VirtualMachine.list(apiclient, projectid=projectid,
+                    id=self.id, listAll=True)
+            validationresult = validateList(vms)
+            if validationresult[0] == FAIL:
+                raise Exception("VM list validation failed: %s" % validationresult[2])
+            return str(vms[0].state).decode("string_escape")
 
-        while timeout > 0:
-            try:
-                projectid = None
-                if hasattr(self, "projectid"):
-                    projectid = self.projectid
-                vms = VirtualMachine.list(apiclient, projectid=projectid,
-                        id=self.id, listAll=True)
-                validationresult = validateList(vms)
-                if validationresult[0] == FAIL:
-                    raise Exception("VM list validation failed: %s" % validationresult[2])
-                elif str(vms[0].state).lower().decode("string_escape") == str(state).lower():
-                    returnValue = [PASS, None]
-                    break
-            except Exception as e:
-                returnValue = [FAIL, e]
-                break
-            time.sleep(60)
-            timeout -= 60
-        return returnValue
+        return wait_for_state(fetch, state, timeout)
 
     def resetSshKey(self, apiclient, **kwargs):
         """Resets SSH key"""
@@ -1128,24 +1118,13 @@ class Snapshot:
                           else FAIL
                  @Reason: Reason for failure in case Result is FAIL
         """
-        isSnapshotInRequiredState = False
-        try:
-            while timeout >= 0:
-                snapshots = Snapshot.list(apiclient, id=self.id)
-                assert validateList(snapshots)[0] == PASS, "snapshots list\
-                        validation failed"
-                if str(snapshots[0].state).lower() == snapshotstate:
-                    isSnapshotInRequiredState = True
-                    break
-                timeout -= 60
-                time.sleep(60)
-            #end while
-            if isSnapshotInRequiredState:
-                return[PASS, None]
-            else:
-                raise Exception("Snapshot not in required state")
-        except Exception as e:
-            return [FAIL, e]
+        def fetch():
+            snapshots = Snapshot.list(apiclient, id=self.id)
+            assert validateList(snapshots)[0] == PASS, "snapshots list\
+                    validation failed"
+            return snapshots[0].state
+
+        return wait_for_state(fetch, snapshotstate, timeout)
 
 
 class Template:
@@ -2648,25 +2627,16 @@ class Host:
                        to expected state in given time else PASS
                        2) Reason - Reason for failure"""
 
-        returnValue = [FAIL, "VM state not trasited to %s,\
-                        operation timed out" % state]
+        def fetch():
+            hosts = Host.list(apiclient,
+                      id=hostid, listall=True)
+            validationresult = validateList(hosts)
+            if validationresult[0] == FAIL:
+                raise Exception("Host list validation failed: %s" % validationresult[2])
+            return (str(hosts[0].state).decode("string_escape"),
+                    str(hosts[0].resourcestate).decode("string_escape"))
 
-        while timeout > 0:
-            try:
-                hosts = Host.list(apiclient,
-                          id=hostid, listall=True)
-                validationresult = validateList(hosts)
-                if validationresult[0] == FAIL:
-                    raise Exception("Host list validation failed: %s" % validationresult[2])
-                elif str(hosts[0].state).lower().decode("string_escape") == str(state).lower() and str(hosts[0].resourcestate).lower().decode("string_escape") == str(resourcestate).lower():
-                    returnValue = [PASS, None]
-                    break
-            except Exception as e:
-                returnValue = [FAIL, e]
-                break
-            time.sleep(60)
-            timeout -= 60
-        return returnValue
+        return wait_for_state(fetch, (state, resourcestate), timeout)
 
 class StoragePool:
     """Manage Storage pools (Primary Storage)"""
@@ -2796,25 +2766,15 @@ class StoragePool:
                        to expected state in given time else PASS
                        2) Reason - Reason for failure"""
 
-        returnValue = [FAIL, "VM state not trasited to %s,\
-                        operation timed out" % state]
+        def fetch():
+            pools = StoragePool.list(apiclient,
+                      id=poolid, listAll=True)
+            validationresult = validateList(pools)
+            if validationresult[0] == FAIL:
+                raise Exception("Pool list validation failed: %s" % validationresult[2])
+            return str(pools[0].state).decode("string_escape")
 
-        while timeout > 0:
-            try:
-                pools = StoragePool.list(apiclient,
-                          id=poolid, listAll=True)
-                validationresult = validateList(pools)
-                if validationresult[0] == FAIL:
-                    raise Exception("Pool list validation failed: %s" % validationresult[2])
-                elif str(pools[0].state).lower().decode("string_escape") == str(state).lower():
-                    returnValue = [PASS, None]
-                    break
-            except Exception as e:
-                returnValue = [FAIL, e]
-                break
-            time.sleep(60)
-            timeout -= 60
-        return returnValue
+        return wait_for_state(fetch, state, timeout)
 
 class Network:
     """Manage Network pools"""
@@ -19,7 +19,11 @@
 
 import marvin
 import os
+import sys
+import copy
 import time
+import threading
+import Queue
 import logging
 import string
 import random
@@ -32,6 +36,7 @@ from marvin.cloudstackAPI import cloudstackAPIClient, listHosts, listRouters
 from platform import system
 from marvin.cloudstackException import GetDetailExceptionInfo
 from marvin.sshClient import SshClient
+from marvin.jobWaiter import recordWait
 from marvin.codes import (
                           SUCCESS,
                           FAIL,
@@ -152,10 +157,218 @@ def random_gen(id=None, size=6, chars=string.ascii_uppercase + string.digits):
     return randomstr
 
 
-def cleanup_resources(api_client, resources):
-    """Delete resources"""
+# The lib.base types that have to be deleted after the ones listed, when
+# objects of both are given to cleanup_resources
+CLEANUP_DEPENDS = {
+    "NATRule": ["Tag"],
+    "StaticNATRule": ["Tag"],
+    "FireWallRule": ["Tag"],
+    "EgressFireWallRule": ["Tag"],
+    "LoadBalancerRule": ["Tag"],
+    "ApplicationLoadBalancer": ["Tag"],
+    "NetworkACL": ["Tag"],
+    "StaticRoute": ["Tag"],
+    "VpnUser": ["Tag"],
+    "SnapshotPolicy": ["Tag"],
+    "RolePermission": ["Tag"],
+    "ProjectInvitation": ["Tag"],
+    "VirtualMachine": ["Tag", "NATRule", "StaticNATRule", "FireWallRule",
+                       "EgressFireWallRule", "LoadBalancerRule",
+                       "ApplicationLoadBalancer", "SnapshotPolicy"],
+    "InstanceGroup": ["VirtualMachine"],
+    "AffinityGroup": ["VirtualMachine"],
+    "SecurityGroup": ["VirtualMachine"],
+    "SSHKeyPair": ["VirtualMachine"],
+    "Snapshot": ["VirtualMachine", "SnapshotPolicy"],
+    "Volume": ["VirtualMachine"],
+    "Template": ["VirtualMachine"],
+    "Iso": ["VirtualMachine"],
+    "Vpn": ["VpnUser"],
+    "PublicIPAddress": ["VirtualMachine", "NATRule", "StaticNATRule",
+                        "FireWallRule", "EgressFireWallRule",
+                        "LoadBalancerRule", "Vpn"],
+    "PrivateGateway": ["VirtualMachine", "StaticRoute"],
+    "Network": ["VirtualMachine", "PublicIPAddress", "LoadBalancerRule",
+                "ApplicationLoadBalancer", "Vpn"],
+    "NetworkACLList": ["NetworkACL", "Network", "PrivateGateway"],
+    "VPC": ["Network", "PrivateGateway", "PublicIPAddress", "NetworkACLList",
+            "StaticRoute", "Vpn"],
+    "VpnCustomerGateway": ["VPC"],
+    "NetworkOffering": ["Network"],
+    "VpcOffering": ["VPC"],
+    "ServiceOffering": ["VirtualMachine"],
+    "DiskOffering": ["VirtualMachine", "Volume"],
+    "User": ["VirtualMachine", "SSHKeyPair"],
+    "Project": ["VirtualMachine", "Volume", "Snapshot", "Template", "Iso",
+                "PublicIPAddress", "Network", "VPC", "ProjectInvitation"],
+    "Account": ["VirtualMachine", "Volume", "Snapshot", "Template", "Iso",
+                "PublicIPAddress", "Network", "VPC", "VpnCustomerGateway",
+                "SecurityGroup", "AffinityGroup", "SSHKeyPair",
+                "InstanceGroup", "User", "Project"],
+    "Domain": ["Account", "Project", "ServiceOffering", "DiskOffering",
+               "NetworkOffering"],
+    "Role": ["Account", "RolePermission"],
+    "StoragePool": ["VirtualMachine", "Volume"],
+    "Host": ["VirtualMachine", "StoragePool"],
+    "Cluster": ["Host", "StoragePool"],
+    "Pod": ["Cluster"],
+    "ImageStore": ["Template", "Iso", "Snapshot"],
+    "SecondaryStagingStore": ["Template", "Iso", "Snapshot"],
+    "PublicIpRange": ["PublicIPAddress"],
+    "PortablePublicIpRange": ["PublicIPAddress"],
+    "NetworkServiceProvider": ["Network"],
+    "PhysicalNetwork": ["Network", "NetworkServiceProvider"],
+    "Zone": ["Pod", "PhysicalNetwork", "ImageStore", "SecondaryStagingStore",
+             "StoragePool", "PublicIpRange", "Network", "VPC"],
+}
+
+# Parts of the messages of failed deletes that are worth trying again
+CLEANUP_TRANSIENT_ERRORS = ("in use", "being used", "in progress",
+                            "try again", "timed out", "lock", "busy",
+                            "connection", "not all user vms are expunged")
+
+CLEANUP_WORKERS = 8
+
+
+def _cleanup_type(obj):
+    """ The name of the type of obj in CLEANUP_DEPENDS, None if it has none """
+    known = set(CLEANUP_DEPENDS)
+    for deps in CLEANUP_DEPENDS.values():
+        known.update(deps)
+    for cls in type(obj).__mro__:
+        if cls.__name__ in known:
+            return cls.__name__
+    return None
+
+
+def _cleanup_layers(resources):
+    """ Orders resources into layers of [type names, chains], every chain
+        being a list of objects to delete one after the other while the
+        other chains of the layer are deleted. The objects of unknown
+        types make up a single chain, deleted first in the given order """
+    types = {}
+    unknown = []
     for obj in resources:
-        obj.delete(api_client)
+        name = _cleanup_type(obj)
+        if name is None:
+            unknown.append(obj)
+        else:
+            types.setdefault(name, []).append(obj)
+
+    depths = {}
+    def depth(name, path=()):
+        if name in path:
+            raise Exception("Dependency cycle in CLEANUP_DEPENDS: %s" % " -> ".join(path + (name,)))
+        if name not in depths:
+            deps = [d for d in CLEANUP_DEPENDS.get(name, []) if d in types]
+            depths[name] = max([depth(d, path + (name,)) + 1 for d in deps] or [0])
+        return depths[name]
+
+    by_depth = {}
+    for name in types:
+        by_depth.setdefault(depth(name), []).append(name)
+
+    layers = []
+    if unknown:
+        layers.append([sorted(set([type(obj).__name__ for obj in unknown])), [unknown]])
+    for level in sorted(by_depth):
+        names = by_depth[level]
+        layers.append([sorted(names), [[obj] for obj in resources if _cleanup_type(obj) in names]])
+    return layers
+
+
+def _cleanup_delete(api_client, obj, retries, retry_interval):
+    """ Deletes obj, trying again after transient failures.
+        Returns None, or the sys.exc_info() of the last failure """
+    for attempt in range(retries + 1):
+        try:
+            obj.delete(api_client)
+            return None
+        except Exception as e:
+            error = sys.exc_info()
+            message = str(e).lower()
+            if not [t for t in CLEANUP_TRANSIENT_ERRORS if t in message]:
+                break
+            if attempt < retries:
+                time.sleep(retry_interval * 2 ** attempt)
+    return error
+
+
+def _cleanup_client(api_client):
+    """ A copy of api_client with a connection of its own """
+    client = copy.copy(api_client)
+    for k, v in api_client.__dict__.items():
+        if k != "connection":
+            setattr(client, k, v)
+    return client
+
+
+def _cleanup_layer(api_client, chains, workers, retries, retry_interval):
+    """ Deletes the chains of a layer with up to workers threads.
+        Returns the failures, by index of their chain """
+    queue = Queue.Queue()
+    for i, chain in enumerate(chains):
+        queue.put((i, chain))
+    errors = {}
+
+    def work(client):
+        while True:
+            try:
+                i, chain = queue.get_nowait()
+            except Queue.Empty:
+                return
+            for obj in chain:
+                error = _cleanup_delete(client, obj, retries, retry_interval)
+                if error is not None:
+                    errors[i] = error
+                    break
+
+    if len(chains) == 1 or workers <= 1:
+        work(api_client)
+        return errors
+    threads = [threading.Thread(target=work, args=(_cleanup_client(api_client),))
+               for n in range(min(workers, len(chains)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def cleanup_resources(api_client, resources, parallel=True, workers=None, retries=2, retry_interval=5):
+    """Delete resources
+
+    The resources are deleted in layers, every type after the types it
+    depends on in CLEANUP_DEPENDS, and the objects of a layer by up to
+    workers threads at once. Deletes failing with one of
+    CLEANUP_TRANSIENT_ERRORS are tried again retries times. The first
+    failure of a layer is raised once the layer is done, the next layers
+    are not deleted.
+    With parallel=False the resources are deleted one by one in the given
+    order instead, stopping at the first failure.
+    Returns the type names, number of objects and seconds of every layer"""
+
+    if not parallel:
+        start = time.time()
+        for obj in resources:
+            obj.delete(api_client)
+        return [{"types": sorted(set([type(obj).__name__ for obj in resources])),
+                 "count": len(resources), "seconds": time.time() - start}]
+
+    logger = logging.getLogger("testClient")
+    timings = []
+    for names, chains in _cleanup_layers(resources):
+        start = time.time()
+        errors = _cleanup_layer(api_client, chains, workers or CLEANUP_WORKERS,
+                                retries, retry_interval)
+        timing = {"types": names, "count": sum([len(chain) for chain in chains]),
+                  "seconds": time.time() - start}
+        timings.append(timing)
+        logger.debug("cleanup_resources: deleted %(count)d %(types)s in %(seconds).1fs" % timing)
+        if errors:
+            error = errors[min(errors)]
+            raise error[0], error[1], error[2]
+    return timings
 
 
 def is_server_ssh_ready(ipaddress, port, username, password, retries=20, retryinterv=30, timeout=10.0, keyPairFileLocation=None):
@@ -541,3 +754,34 @@ def wait_until(retry_interval=2, no_of_times=2, callback=None, *callback_args):
 
     return wait_result, return_val
 
+
+def _lower_state(state):
+    if isinstance(state, (tuple, list)):
+        return tuple([str(s).lower() for s in state])
+    return str(state).lower()
+
+def wait_for_state(fetch, state, timeout=600, interval=1, max_interval=30):
+    """ Calls fetch until the state it returns is state, compared case insensitively,
+        or timeout seconds passed. fetch may also return a tuple of states, compared
+        with a tuple. The interval between the calls starts at interval seconds and
+        doubles up to max_interval. An exception raised by fetch ends the wait.
+        Returns [PASS, None] or [FAIL, reason] """
+
+    start = time.time()
+    deadline = start + timeout
+    expected = _lower_state(state)
+    while True:
+        try:
+            current = fetch()
+        except Exception as e:
+            return [FAIL, e]
+        if _lower_state(current) == expected:
+            # the waits this replaces checked once a minute
+            recordWait(time.time() - start, 60)
+            return [PASS, None]
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return [FAIL, "State not transited to %s, operation timed out, it is %s" % (state, current)]
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
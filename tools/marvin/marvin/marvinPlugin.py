@@ -21,6 +21,8 @@ import time
 import os
 import nose.core
 from marvin.cloudstackTestCase import cloudstackTestCase
+from marvin.cloudstackConnection import REQUEST_TIMER
+from marvin.jobWaiter import savedTime
 from marvin.marvinInit import MarvinInit
 from nose.plugins.base import Plugin
 from marvin.codes import (SUCCESS,
@@ -60,6 +62,7 @@ class MarvinPlugin(Plugin):
         self.__testRunner = None
         self.__testResult = SUCCESS
         self.__startTime = None
+        self.__savedAtStart = 0
         self.__testName = None
         self.__tcRunLogger = None
         self.__testModName = ''
@@ -184,6 +187,7 @@ class MarvinPlugin(Plugin):
             self.__tcRunLogger.debug("::::::::::::STARTED : TC: " +
                                      str(self.__testName) + " :::::::::::")
         self.__startTime = time.time()
+        self.__savedAtStart = savedTime()
 
     def printMsg(self, status, tname, err):
         if status in [FAILED, EXCEPTION] and self.__tcRunLogger:
@@ -270,6 +274,11 @@ class MarvinPlugin(Plugin):
                            str(time.ctime(self.__startTime)),
                            str(time.ctime(endTime)),
                            self.__testResult))
+                self.__tcRunLogger.\
+                    debug("TestCaseName: %s; Time Saved Waiting For "
+                          "Jobs And States: %.1f Seconds" %
+                          (self.__testName,
+                           savedTime() - self.__savedAtStart))
 
     def _injectClients(self, test):
         setattr(test, "debug", self.__tcRunLogger.debug)
@@ -289,6 +298,9 @@ class MarvinPlugin(Plugin):
 
     def finalize(self, result):
         try:
+            if self.__tcRunLogger:
+                self.__tcRunLogger.info("=== API request latencies ===\n%s" %
+                                        REQUEST_TIMER.report())
             src = self.__logFolderPath
             tmp = ''
             if not self.__userLogPath: